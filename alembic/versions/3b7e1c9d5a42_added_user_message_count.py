@@ -0,0 +1,27 @@
+"""added user message count
+
+Revision ID: 3b7e1c9d5a42
+Revises: 2fbb48c337bc
+Create Date: 2024-06-03 10:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b7e1c9d5a42'
+down_revision: Union[str, None] = '2fbb48c337bc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing users keep NULL and are backfilled from their zep history on their next message
+    op.add_column('users', sa.Column('message_count', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'message_count')
@@ -0,0 +1,26 @@
+"""added user chat history version
+
+Revision ID: 8e2d4a6c1f37
+Revises: 3b7e1c9d5a42
+Create Date: 2024-06-24 14:37:09.512840
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e2d4a6c1f37'
+down_revision: Union[str, None] = '3b7e1c9d5a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('chat_history_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'chat_history_version')
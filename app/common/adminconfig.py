@@ -14,9 +14,12 @@ class AdminConfig:
     DISCLAIMERS: str
     GDRIVE_ENABLED: str
     LOGO_LINK: str
+    # bumped on every reload so caches built from the config can detect changes
+    VERSION: int = 0
 
     @classmethod
     def update_config(cls):
+        cls.VERSION += 1
         try:
             session = SessionLocal()
             admin_config = session.query(AdminConfigModel).first()
@@ -0,0 +1,114 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from opentelemetry import metrics
+from app.common.mmr import normalize_rows
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+meter = metrics.get_meter(__name__)
+_lookups = meter.create_counter("chat.answer_cache.lookups", description="Semantic answer cache lookups by result")
+
+# Answers to knowledge-base-only questions asked without chat history, found again by the similarity of the
+# question's embedding. Entries are only valid for the version they were answered under (kb doc-set version and
+# admin config version), a lookup or store under a new version drops the others. Entries expire after the ttl and
+# the least recently used one is evicted beyond maxsize.
+class SemanticAnswerCache:
+
+    def __init__(self, maxsize, ttl, threshold):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # entry id -> {"vector", "answer", "context", "expires_at"}, least recently used first
+        self._entries = OrderedDict()
+        self._ids = itertools.count()
+        self._version = None
+        # (entry ids, vectors) of the entries, rebuilt after a change
+        self._matrix = None
+        self._lock = threading.Lock()
+
+    def lookup(self, vector, version):
+        # (answer, context, similarity) of the most similar question above the threshold, or None
+        query = normalize_rows(vector)
+        with self._lock:
+            self._set_version(version)
+            self._expire()
+            if len(self._entries) == 0:
+                return self._miss()
+            if self._matrix is None:
+                self._matrix = (list(self._entries), np.stack([entry["vector"] for entry in self._entries.values()]))
+            entry_ids, vectors = self._matrix
+            similarities = vectors @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return self._miss()
+            entry = self._entries[entry_ids[best]]
+            self._entries.move_to_end(entry_ids[best])
+            self.hits += 1
+        _lookups.add(1, {"result": "hit"})
+        return entry["answer"], entry["context"], float(similarities[best])
+
+    def store(self, vector, version, answer, context):
+        with self._lock:
+            self._set_version(version)
+            self._entries[next(self._ids)] = {
+                "vector": normalize_rows(vector),
+                "answer": answer,
+                "context": dict(context),
+                "expires_at": time.monotonic() + self.ttl if self.ttl else None,
+            }
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def purge(self):
+        with self._lock:
+            purged = len(self._entries)
+            self._entries.clear()
+            self._matrix = None
+            return purged
+
+    def _miss(self):
+        # caller must hold self._lock
+        self.misses += 1
+        _lookups.add(1, {"result": "miss"})
+        return None
+
+    def _set_version(self, version):
+        # caller must hold self._lock
+        if version != self._version:
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def _expire(self):
+        # caller must hold self._lock
+        now = time.monotonic()
+        expired = [entry_id for entry_id, entry in self._entries.items() if entry["expires_at"] is not None and entry["expires_at"] < now]
+        for entry_id in expired:
+            del self._entries[entry_id]
+        if len(expired) > 0:
+            self.expirations += len(expired)
+            self._matrix = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+answer_cache = SemanticAnswerCache(settings.ANSWER_CACHE_SIZE, settings.ANSWER_CACHE_TTL_SECONDS, settings.ANSWER_CACHE_SIMILARITY_THRESHOLD)
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""a an and are as at be but by can do does for from has have how i if in into is it its my
+    of on or our so than that the their them then there these they this to was we what when where which who will
+    with you your""".split())
+
+def tokenize(text):
+    # lowercased words and numbers, so "Housing Act 2004, s.213" matches "section 213 of the housing act"
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+# Okapi BM25 over the chunk texts of the documents it holds. Every document is tokenized once when it is added and
+# kept on disk as <dir>/<sha1 of the name>.json (ids, metadata and term frequencies of its chunks), so a restart
+# reads the postings back instead of fetching and tokenizing the chunks again. Documents are held by the key they
+# are synced as (see app.common.kbindex.kb_document_key), a re-uploaded document comes in as a new key and replaces
+# the old one. Removed documents mask their rows, the rows are dropped once they outnumber the live ones.
+class BM25Index:
+
+    def __init__(self, directory, k1=1.2, b=0.75):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        self.hits = 0
+        self.misses = 0
+        self.syncs = 0
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.documents = frozenset()
+        self._ids = []
+        self._metadatas = []
+        self._doc_rows = []
+        self._lengths = []
+        self._alive = []
+        self._doc_numbers = {}
+        # term -> ([rows], [term frequencies]), rows ascending
+        self._postings = {}
+        # numpy views of the lists above, rebuilt after a change
+        self._arrays = None
+
+    def load(self):
+        with self._lock:
+            self._reset()
+            for entry in sorted(os.listdir(self.directory)):
+                if not entry.endswith(".json"):
+                    continue
+                with open(os.path.join(self.directory, entry)) as document_file:
+                    document = json.load(document_file)
+                self._add_rows(document["document"], document["chunks"])
+            self.loaded = True
+            logger.info(f"BM25 index loaded | documents: {len(self.documents)} | chunks: {len(self._ids)} | terms: {len(self._postings)}")
+
+    def query(self, text, top_k, file_names):
+        # pinecone style matches (without values) over the chunks of file_names, None when a document is not held
+        if not self.loaded or not file_names <= self.documents:
+            self.misses += 1
+            return None
+        self.hits += 1
+        terms = set(tokenize(text))
+        with self._lock:
+            if self._arrays is None:
+                self._arrays = (np.asarray(self._doc_rows, dtype=np.int32), np.asarray(self._lengths, dtype=np.float32),
+                                np.asarray(self._alive, dtype=bool), {})
+            doc_rows, lengths, alive, term_arrays = self._arrays
+            postings = {}
+            for term in terms:
+                if term not in self._postings:
+                    continue
+                if term not in term_arrays:
+                    rows, frequencies = self._postings[term]
+                    term_arrays[term] = (np.asarray(rows, dtype=np.int32), np.asarray(frequencies, dtype=np.float32))
+                postings[term] = term_arrays[term]
+            if len(postings) == 0:
+                return []
+            allowed_documents = np.zeros(len(self._doc_numbers), dtype=bool)
+            allowed_documents[[self._doc_numbers[file_name] for file_name in file_names]] = True
+
+        # corpus statistics are those of the live chunks in scope, like a pinecone filter would see them
+        in_scope = alive & allowed_documents[doc_rows]
+        chunk_count = int(in_scope.sum())
+        if chunk_count == 0:
+            return []
+        average_length = float(lengths[in_scope].mean()) or 1.0
+        scores = np.zeros(len(doc_rows), dtype=np.float32)
+        for rows, frequencies in postings.values():
+            live = in_scope[rows]
+            rows, frequencies = rows[live], frequencies[live]
+            if len(rows) == 0:
+                continue
+            idf = math.log(1 + (chunk_count - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + self.k1 * (1 - self.b + self.b * lengths[rows] / average_length))
+
+        matched = np.flatnonzero(scores > 0)
+        top = matched[np.argsort(-scores[matched])[:top_k]]
+        return [{"id": self._ids[row], "score": float(scores[row]), "metadata": self._metadatas[row]} for row in top]
+
+    def sync(self, file_names, fetch_document, text_key="text"):
+        # fetch_document(file_name) returns the document's pinecone matches with metadata
+        removed = self.documents - file_names
+        added = file_names - self.documents
+        for file_name in removed:
+            with self._lock:
+                self._remove(file_name)
+        for file_name in sorted(added):
+            chunks = []
+            for match in fetch_document(file_name):
+                metadata = dict(match["metadata"])
+                terms = tokenize(metadata.get(text_key, ""))
+                chunks.append({"id": match["id"], "metadata": metadata, "length": len(terms), "terms": dict(Counter(terms))})
+            self._write_document(file_name, chunks)
+            with self._lock:
+                self._add_rows(file_name, chunks)
+        with self._lock:
+            live_rows = sum(self._alive)
+            if len(self._alive) - live_rows > live_rows:
+                self._compact()
+        if len(added) > 0 or len(removed) > 0:
+            self.syncs += 1
+            logger.info(f"BM25 index synced | added: {len(added)} | removed: {len(removed)}")
+
+    def _add_rows(self, file_name, chunks):
+        # caller must hold self._lock
+        doc_number = self._doc_numbers.setdefault(file_name, len(self._doc_numbers))
+        for chunk in chunks:
+            row = len(self._ids)
+            self._ids.append(chunk["id"])
+            self._metadatas.append(chunk["metadata"])
+            self._doc_rows.append(doc_number)
+            self._lengths.append(chunk["length"])
+            self._alive.append(True)
+            for term, frequency in chunk["terms"].items():
+                rows, frequencies = self._postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+        self.documents = self.documents | {file_name}
+        self._arrays = None
+
+    def _compact(self):
+        # caller must hold self._lock, the held documents are read back from disk without the removed rows
+        documents = self.documents
+        self._reset()
+        for file_name in sorted(documents):
+            with open(self._document_path(file_name)) as document_file:
+                self._add_rows(file_name, json.load(document_file)["chunks"])
+
+    def _remove(self, file_name):
+        # caller must hold self._lock
+        doc_number = self._doc_numbers[file_name]
+        for row, row_doc_number in enumerate(self._doc_rows):
+            if row_doc_number == doc_number:
+                self._alive[row] = False
+        self.documents = self.documents - {file_name}
+        self._arrays = None
+        path = self._document_path(file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _write_document(self, file_name, chunks):
+        path = self._document_path(file_name)
+        with open(path + ".tmp", "w") as document_file:
+            json.dump({"document": file_name, "chunks": chunks}, document_file)
+        os.replace(path + ".tmp", path)
+
+    def _document_path(self, file_name):
+        return os.path.join(self.directory, hashlib.sha1(file_name.encode("utf-8")).hexdigest() + ".json")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "loaded": self.loaded,
+            "documents": len(self.documents),
+            "chunks": sum(self._alive),
+            "terms": len(self._postings),
+            "syncs": self.syncs,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
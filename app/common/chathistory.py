@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from zep_python.message import Message
+from app.common.cache import LRUCache
+from app.common.llmrouter import ProviderRouter, get_chat_llm
+from app.common.settings import get_settings
+from app.common import getzep, langchain, tokens
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# tokens the chat format adds around every message (role, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+# messages of the last exchange (user message and answer), kept in the window even when over the budget
+LAST_EXCHANGE_MESSAGES = 2
+# quota demand of the summary prompt template and the summary on top of the messages
+SUMMARY_TOKEN_OVERHEAD = 300
+
+# token counts keyed by (message id, model), zep messages are immutable once saved
+_token_counts = LRUCache(maxsize=settings.CHAT_HISTORY_TOKEN_COUNT_CACHE_SIZE)
+# latest summary of the messages that fell out of the window, keyed by username like the cached histories
+_summaries = LRUCache(maxsize=settings.CHAT_HISTORY_CACHE_SIZE)
+_summary_tasks = {}
+# tail of each user's conversation as (chat history version, messages), keyed by username (every user has exactly
+# one active zep session). The version is users.chat_history_version, bumped in the database by every worker that
+# changes the history, so a copy cached by one worker is not served after another one has written. Appends of
+# this worker update it in place, the ttl bounds how long a turn another worker has not saved to zep yet is missed.
+_histories = LRUCache(maxsize=settings.CHAT_HISTORY_CACHE_SIZE, ttl=settings.CHAT_HISTORY_CACHE_TTL_SECONDS)
+# context retrieved for an ai answer, keyed by (username, turn id), reused by the follow-up modes
+_turn_contexts = LRUCache(maxsize=settings.TURN_CONTEXT_CACHE_SIZE, ttl=settings.TURN_CONTEXT_CACHE_TTL_SECONDS)
+
+def get_history_token_budget(model_name):
+    budgets = settings.CHAT_HISTORY_TOKEN_BUDGETS
+    return budgets.get(model_name, budgets.get("default"))
+
+def _message_key(message):
+    return message.uuid or hashlib.sha1(f"{message.role}\x00{message.content}".encode("utf-8")).hexdigest()
+
+def count_message_tokens(message, model_name):
+    key = (_message_key(message), model_name)
+    token_count = _token_counts.get(key)
+    if token_count is None:
+        token_count = tokens.count_tokens(message.content, model_name) + MESSAGE_TOKEN_OVERHEAD
+        _token_counts.set(key, token_count)
+    return token_count
+
+def select_history_window(messages, model_name):
+    # fill the model's token budget from the newest message backwards, returns (window, older messages).
+    # The last exchange is always in the window, cut down to the budget when it doesn't fit whole
+    budget = get_history_token_budget(model_name)
+    used_tokens = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, max(len(messages) - settings.CHAT_HISTORY_MAX_MESSAGES, 0) - 1, -1):
+        message_tokens = count_message_tokens(messages[i], model_name)
+        if used_tokens + message_tokens > budget:
+            break
+        used_tokens += message_tokens
+        start = i
+    last_exchange_start = max(len(messages) - LAST_EXCHANGE_MESSAGES, 0)
+    if start > last_exchange_start:
+        return _truncate_messages(messages[last_exchange_start:], budget, model_name), messages[:last_exchange_start]
+    return messages[start:], messages[:start]
+
+def _truncate_messages(messages, budget, model_name):
+    # messages that fit an even share of the budget are kept whole, the longer ones share what they leave
+    token_counts = [count_message_tokens(message, model_name) for message in messages]
+    limits = [0] * len(messages)
+    remaining = budget
+    for position, i in enumerate(sorted(range(len(messages)), key=lambda i: token_counts[i])):
+        limits[i] = min(token_counts[i], remaining // (len(messages) - position))
+        remaining -= limits[i]
+    return [message if limits[i] == token_counts[i] else
+            Message(role=message.role, created_at=message.created_at,
+                    content=tokens.truncate_to_tokens(message.content, max(limits[i] - MESSAGE_TOKEN_OVERHEAD, 0), model_name))
+            for i, message in enumerate(messages)]
+
+def get_cached_history(username, version):
+    cached = _histories.get(username)
+    if cached is None or cached[0] != version:
+        return None
+    return list(cached[1])
+
+def set_cached_history(username, version, messages):
+    _histories.set(username, (version, list(messages)[-settings.CHAT_HISTORY_CACHE_MAX_MESSAGES:]))
+
+def append_cached_history(username, version, messages):
+    # messages: list of (role, content), version: the history version after them. Only applied when the cached copy
+    # is the one right before, otherwise another worker wrote in between and the next read reloads from zep
+    cached = _histories.get(username)
+    if cached is None:
+        return
+    if cached[0] != version - 1:
+        _histories.pop(username)
+        return
+    created_at = datetime.now(timezone.utc).isoformat()
+    cached_messages = cached[1] + [Message(role=role, content=content, created_at=created_at) for role, content in messages]
+    _histories.set(username, (version, cached_messages[-settings.CHAT_HISTORY_CACHE_MAX_MESSAGES:]))
+
+def evict_cached_history(username):
+    _histories.pop(username)
+
+def get_history_cache_stats():
+    return _histories.stats()
+
+def _turn_id(ai_msg):
+    # ai messages get their zep uuid only once the write-behind queue saves them, the content identifies the turn
+    return hashlib.sha1(ai_msg.encode("utf-8")).hexdigest()
+
+def get_turn_context(username, ai_msg):
+    return _turn_contexts.get((username, _turn_id(ai_msg)))
+
+def set_turn_context(username, ai_msg, context):
+    _turn_contexts.set((username, _turn_id(ai_msg)), context)
+
+def evict_turn_contexts(username):
+    _turn_contexts.evict_where(lambda key: key[0] == username)
+
+def get_history_summary(username, older_messages):
+    # Returns the latest available summary of the older messages without waiting on the llm.
+    # A stale or missing summary is refreshed in the background and picked up by the next turn.
+    if not settings.CHAT_HISTORY_SUMMARY_ENABLED or len(older_messages) == 0:
+        return None
+
+    boundary = _message_key(older_messages[-1])
+    cached = _summaries.get(username)
+    if (cached is None or cached[0] != boundary) and username not in _summary_tasks:
+        task = asyncio.create_task(_refresh_summary(username, boundary, older_messages))
+        _summary_tasks[username] = task
+        task.add_done_callback(lambda _: _summary_tasks.pop(username, None))
+    return cached[1] if cached else None
+
+def evict_history_summary(username):
+    _summaries.pop(username)
+
+async def _refresh_summary(username, boundary, older_messages):
+    try:
+        # summarise the most recent older messages that fit in one budget, the rest is already long gone
+        summary_input, _ = select_history_window(older_messages, settings.OPENAI_CHAT_SECONDARY_MODEL_NAME)
+        chat_history = getzep.convert_zep_messages_to_langchain(summary_input)
+
+        def make_stream(provider):
+            chain = langchain.get_history_summary_chain(username, get_chat_llm(provider, "secondary"))
+            return chain.astream({"chat_history": chat_history})
+
+        demand = [("secondary", sum(count_message_tokens(message, settings.OPENAI_CHAT_SECONDARY_MODEL_NAME) for message in summary_input)
+                   + SUMMARY_TOKEN_OVERHEAD)]
+        summary = await ProviderRouter.ainvoke(make_stream, demand=demand)
+        _summaries.set(username, (boundary, summary))
+    except Exception as ex:
+        logger.exception(f"Chat history summary could not be generated | Error: {ex}")
@@ -0,0 +1,78 @@
+import os
+from typing import List
+from langchain_core.documents import Document
+from app.common import tokens
+
+# overlaps shorter than this are coincidence rather than the splitter's chunk overlap
+MIN_OVERLAP_CHARS = 40
+# a passage cut to fewer tokens than this carries no useful context, packing stops instead
+MIN_PASSAGE_TOKENS = 40
+
+# Packs retrieved documents into the prompt context: page content only, behind a short source tag, chunks of the
+# same source that overlap (splitter overlap, re-uploads) merged or dropped, and cut to a token budget.
+# Documents are expected in rank order, a merged passage keeps the rank of its best chunk.
+def pack_documents(documents: List[Document], max_tokens, model_name, source_prefix="") -> str:
+    passages = []
+    for document in documents:
+        text = document.page_content.strip()
+        if not text:
+            continue
+        source = _source_tag(document.metadata, source_prefix)
+        if not any(_merge(passage, source, text) for passage in passages):
+            passages.append({"source": source, "text": text})
+
+    packed = []
+    remaining = max_tokens
+    for i, passage in enumerate(passages):
+        entry = f"[{i + 1}] {passage['source']}\n{passage['text']}"
+        entry_tokens = tokens.count_tokens(entry, model_name)
+        if entry_tokens > remaining:
+            if remaining >= MIN_PASSAGE_TOKENS:
+                packed.append(tokens.truncate_to_tokens(entry, remaining, model_name))
+            break
+        packed.append(entry)
+        remaining -= entry_tokens
+    return "\n\n".join(packed)
+
+def _source_tag(metadata, source_prefix):
+    file_name = str(metadata.get("file_name", "unknown"))
+    # consumer file names are stored as "<username>:<document name>"
+    if source_prefix and file_name.startswith(source_prefix):
+        file_name = file_name[len(source_prefix):]
+    tag = os.path.splitext(file_name)[0]
+    page = metadata.get("page")
+    if page is not None:
+        tag += f", p. {int(page) + 1 if isinstance(page, (int, float)) else page}"
+    return tag
+
+def _merge(passage, source, text):
+    # folds text into the passage when both come from the same source and one contains or overlaps the other
+    if passage["source"].split(", p. ")[0] != source.split(", p. ")[0]:
+        return False
+    kept = passage["text"]
+    if text in kept:
+        return True
+    if kept in text:
+        passage["text"] = text
+        return True
+    overlap = _overlap(kept, text)
+    if overlap:
+        passage["text"] = kept + text[overlap:]
+        return True
+    overlap = _overlap(text, kept)
+    if overlap:
+        passage["text"] = text + kept[overlap:]
+        return True
+    return False
+
+def _overlap(first, second):
+    # length of the longest suffix of first that is a prefix of second, 0 below MIN_OVERLAP_CHARS
+    head = second[:MIN_OVERLAP_CHARS]
+    if len(head) < MIN_OVERLAP_CHARS:
+        return 0
+    start = first.find(head, max(len(first) - len(second), 0))
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(head, start + 1)
+    return 0
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app.common.settings import get_settings
+from app.common.vectorstore import VectorStoreRegistry
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# pinecone caps top_k at 10000 for queries that return ids only (1000 with metadata or values), so a document's
+# ids are listed without either and its vectors fetched by id
+MAX_VECTORS_PER_DOCUMENT = 10000
+# responses are capped at 4MB, a 1536 dimensional vector with its chunk text is ~20KB as json
+FETCH_BATCH_SIZE = 100
+
+# pinecone updates one vector per request, they are sent concurrently
+_update_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="pinecone-update")
+# index -> dimension, for the dummy query vector
+_dimensions = {}
+# (index name, namespace) -> latest flag update, updates of the same scope run in the order they were requested
+_flag_updates = {}
+
+# How retrieval is scoped to the documents that are ready to be answered from (RETRIEVAL_DOC_SCOPE):
+#   "file_names"   every completed document name in a $in filter, the filter grows with the document set
+#   "active_flag"  a constant {"active": true} filter, knowledge base vectors carry an "active" metadata flag and
+#                  consumer vectors live in one namespace per user (the username), with the same flag
+# In "active_flag" mode the ingestion worker upserts vectors (consumer ones into the user's namespace) with
+# active=false and sets it to true when it marks the document completed, the delete worker deletes them from the
+# same namespace. The delete flows here set the flag to false as soon as a document is marked for deletion, so it
+# leaves retrieval before the delete worker has removed its vectors. The flag is set in the background, a document
+# takes one query and one update per vector, the delete request does not wait for that. Existing vectors are
+# migrated with app/utils/backfill_doc_scope.py.
+def is_active_flag_scope():
+    return settings.RETRIEVAL_DOC_SCOPE == "active_flag"
+
+def active_filter():
+    return {"active": {"$eq": True}}
+
+def consumer_namespace(username):
+    return username
+
+def consumer_file_name(username, document_name):
+    # file_name metadata of consumer vectors, also in the per-user namespaces
+    return f"{username}:{document_name}"
+
+def set_kb_documents_active(file_names, active):
+    if is_active_flag_scope():
+        return _schedule_flag_update(settings.PINECONE_KNOWLEDGE_BASE_INDEX, None, file_names, active)
+
+def set_consumer_documents_active(username, document_names, active):
+    if is_active_flag_scope():
+        file_names = [consumer_file_name(username, document_name) for document_name in document_names]
+        return _schedule_flag_update(settings.PINECONE_CONSUMER_INDEX, consumer_namespace(username), file_names, active)
+
+async def delete_consumer_namespace(username):
+    # drops whatever the delete worker left behind (e.g. files in del_failed) together with the user
+    if not is_active_flag_scope():
+        return
+    index = await asyncio.to_thread(VectorStoreRegistry.get_index, settings.PINECONE_CONSUMER_INDEX)
+    try:
+        await asyncio.to_thread(index.delete, delete_all=True, namespace=consumer_namespace(username))
+    except Exception as ex:
+        logger.exception(f"Consumer namespace could not be deleted | username: {username} | Error: {ex}")
+
+def find_document_ids(index, namespace, file_name):
+    # pinecone has no lookup by metadata, a filtered query with a dummy vector returns the document's ids
+    if index not in _dimensions:
+        _dimensions[index] = index.describe_index_stats()["dimension"]
+    response = index.query(vector=[1.0] + [0.0] * (_dimensions[index] - 1),
+                           top_k=MAX_VECTORS_PER_DOCUMENT,
+                           include_values=False,
+                           include_metadata=False,
+                           namespace=namespace,
+                           filter={"file_name": {"$eq": file_name}})
+    ids = [match["id"] for match in response["matches"]]
+    if len(ids) == MAX_VECTORS_PER_DOCUMENT:
+        logger.warning(f"Document has more vectors than a query returns, the rest is missed | file_name: {file_name}")
+    return ids
+
+def find_document_vectors(index, namespace, file_name):
+    # pinecone style matches (id, values, metadata) of the document, fetched in batches
+    ids = find_document_ids(index, namespace, file_name)
+    matches = []
+    for i in range(0, len(ids), FETCH_BATCH_SIZE):
+        vectors = index.fetch(ids=ids[i:i + FETCH_BATCH_SIZE], namespace=namespace)["vectors"]
+        matches.extend({"id": vector_id, "values": vectors[vector_id]["values"], "metadata": vectors[vector_id].get("metadata") or {}}
+                       for vector_id in ids[i:i + FETCH_BATCH_SIZE] if vector_id in vectors)
+    return matches
+
+def set_vectors_active(index, namespace, file_name, active):
+    ids = find_document_ids(index, namespace, file_name)
+    # setting the flag again is a no-op, cheaper than fetching the metadata to skip it
+    list(_update_executor.map(lambda vector_id: index.update(id=vector_id, set_metadata={"active": active}, namespace=namespace), ids))
+    return len(ids)
+
+def _schedule_flag_update(index_name, namespace, file_names, active):
+    key = (index_name, namespace)
+    task = asyncio.create_task(_set_documents_active(index_name, namespace, file_names, active, _flag_updates.get(key)))
+    _flag_updates[key] = task
+
+    def finished(task):
+        if _flag_updates.get(key) is task:
+            del _flag_updates[key]
+
+    task.add_done_callback(finished)
+    return task
+
+async def _set_documents_active(index_name, namespace, file_names, active, previous=None):
+    # failures are logged, not raised: the database status change has happened and the delete worker still
+    # removes the vectors, until then a document that could not be deactivated stays retrievable
+    if previous is not None:
+        await asyncio.gather(previous, return_exceptions=True)
+    index = await asyncio.to_thread(VectorStoreRegistry.get_index, index_name)
+    for file_name in file_names:
+        try:
+            updated = await asyncio.to_thread(set_vectors_active, index, namespace, file_name, active)
+            logger.info(f"Document vectors {'activated' if active else 'deactivated'} | index: {index_name} | file_name: {file_name} | vectors: {updated}")
+        except Exception as ex:
+            logger.exception(f"Document vectors could not be updated | index: {index_name} | file_name: {file_name} | Error: {ex}")
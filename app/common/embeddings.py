@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from app.common.cache import LRUCache
+from app.common.settings import get_settings
+from app.common.azure_openai import AzureOpenAIManager
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# Append-only on-disk embedding store. Vectors live in a float32 file that is memory-mapped
+# for reads, keys are appended to a sidecar file whose line number is the vector's row.
+class DiskEmbeddingStore:
+
+    def __init__(self, directory, max_entries):
+        self.max_entries = max_entries
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._keys_path = os.path.join(directory, "keys.txt")
+        self._meta_path = os.path.join(directory, "meta.json")
+        self._rows = {}
+        self._dim = None
+        self._mmap = None
+        self._mmap_rows = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as meta_file:
+                self._dim = json.load(meta_file)["dim"]
+            keys = []
+            if os.path.exists(self._keys_path):
+                with open(self._keys_path, "rb") as keys_file:
+                    # the last piece is empty or a key cut off mid write
+                    keys = keys_file.read().split(b"\n")[:-1]
+            vector_rows = os.path.getsize(self._vectors_path) // (4 * self._dim) if os.path.exists(self._vectors_path) else 0
+            # a crash between or during the two appends can leave one file longer, both are cut back to the rows
+            # they have in common so the next append lines up again
+            rows = min(len(keys), vector_rows)
+            with open(self._keys_path, "ab") as keys_file:
+                keys_file.truncate(sum(len(key) + 1 for key in keys[:rows]))
+            with open(self._vectors_path, "ab") as vectors_file:
+                vectors_file.truncate(rows * 4 * self._dim)
+            self._rows = {key.decode("utf-8"): row for row, key in enumerate(keys[:rows])}
+            logger.info(f"Disk embedding store loaded | entries: {len(self._rows)} | path: {directory}")
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get_many(self, keys):
+        with self._lock:
+            rows = [self._rows.get(key) for key in keys]
+            if all(row is None for row in rows):
+                return [None] * len(keys)
+            vectors = self._get_mmap()
+            return [None if row is None else vectors[row].tolist() for row in rows]
+
+    def put_many(self, items):
+        with self._lock:
+            items = [(key, vector) for key, vector in items if key not in self._rows]
+            items = items[:max(self.max_entries - len(self._rows), 0)]
+            if len(items) == 0:
+                return
+            if self._dim is None:
+                self._dim = len(items[0][1])
+                with open(self._meta_path, "w") as meta_file:
+                    json.dump({"dim": self._dim}, meta_file)
+            with open(self._vectors_path, "ab") as vectors_file:
+                vectors_file.write(np.asarray([vector for _, vector in items], dtype=np.float32).tobytes())
+            with open(self._keys_path, "a") as keys_file:
+                keys_file.write("".join(f"{key}\n" for key, _ in items))
+            for key, _ in items:
+                self._rows[key] = len(self._rows)
+
+    def _get_mmap(self):
+        # remap only when rows were appended since the last read
+        if self._mmap is None or self._mmap_rows != len(self._rows):
+            self._mmap = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(len(self._rows), self._dim))
+            self._mmap_rows = len(self._rows)
+        return self._mmap
+
+# Caching wrapper around an embeddings client. Lookups go memory LRU -> disk store -> upstream,
+# and a batch only sends its (deduplicated) misses upstream.
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings: Embeddings, model_name, maxsize, disk_store: DiskEmbeddingStore = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.disk_store = disk_store
+        self.upstream_calls = 0
+        self.upstream_texts = 0
+        self._memory = LRUCache(maxsize=maxsize)
+        self._disk_hits = 0
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, texts):
+        keys = [self._key(text) for text in texts]
+        vectors = [self._memory.get(key) for key in keys]
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if self.disk_store is not None and len(missing) > 0:
+            for i, vector in zip(missing, self.disk_store.get_many([keys[i] for i in missing])):
+                if vector is not None:
+                    vectors[i] = vector
+                    self._memory.set(keys[i], vector)
+                    self._disk_hits += 1
+
+        # texts still missing, deduplicated so repeated texts in one batch are embedded once
+        misses = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                misses.setdefault(texts[i], []).append(i)
+        return keys, vectors, misses
+
+    def _store(self, keys, vectors, misses, miss_vectors):
+        new_items = []
+        for positions, vector in zip(misses.values(), miss_vectors):
+            for i in positions:
+                vectors[i] = vector
+            self._memory.set(keys[positions[0]], vector)
+            new_items.append((keys[positions[0]], vector))
+        if self.disk_store is not None:
+            self.disk_store.put_many(new_items)
+        self.upstream_calls += 1
+        self.upstream_texts += len(misses)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, misses = self._lookup(texts)
+        if len(misses) == 0:
+            return vectors
+        return self._store(keys, vectors, misses, self.embeddings.embed_documents(list(misses)))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, misses = self._lookup(texts)
+        if len(misses) == 0:
+            return vectors
+        return self._store(keys, vectors, misses, await self.embeddings.aembed_documents(list(misses)))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self):
+        memory_stats = self._memory.stats()
+        lookups = memory_stats["hits"] + memory_stats["misses"]
+        return {
+            "memory": memory_stats,
+            "disk_entries": len(self.disk_store) if self.disk_store is not None else None,
+            "disk_hits": self._disk_hits,
+            "upstream_calls": self.upstream_calls,
+            "upstream_texts": self.upstream_texts,
+            "hit_rate": round((memory_stats["hits"] + self._disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+def _get_disk_store():
+    if not settings.EMBEDDING_CACHE_DIR:
+        return None
+    try:
+        return DiskEmbeddingStore(settings.EMBEDDING_CACHE_DIR, settings.EMBEDDING_CACHE_DISK_MAX_ENTRIES)
+    except Exception as ex:
+        logger.exception(f"Disk embedding store could not be opened | Using memory cache only | Error: {ex}")
+        return None
+
+cached_embeddings = CachedEmbeddings(AzureOpenAIManager.EMBEDDINGS,
+                                     settings.AZURE_OPENAI_EMBEDDINGS_DEPLOYMENT_NAME,
+                                     settings.EMBEDDING_CACHE_SIZE,
+                                     _get_disk_store())
@@ -1,4 +1,6 @@
+import logging
 from app.common.settings import get_settings
+from app.common.cache import LRUCache
 from zep_python import ZepClient, exceptions as zep_exceptions
 from zep_python.user import CreateUserRequest
 from zep_python.memory.models import Session
@@ -6,14 +8,22 @@ from zep_python.memory import Memory, Message
 from langchain_core.messages import AIMessage, HumanMessage
 import datetime
 
+logger = logging.getLogger(__name__)
+
 settings = get_settings()
 
 zep_client = ZepClient(settings.ZEP_API_URL)
 
+# user id -> (zep session id, chat history version it was resolved or last confirmed under), every user has exactly
+# one active session. The version is users.chat_history_version, another worker that replaces the session (clear
+# chat) bumps it, so a cached id is only used under the version it is tagged with
+_session_ids = LRUCache(maxsize=settings.ZEP_SESSION_ID_CACHE_SIZE, ttl=settings.ZEP_SESSION_ID_CACHE_TTL_SECONDS)
+
 async def get_all_users():
     return await zep_client.user.alist(limit=1000, cursor=0)
 
 async def delete_user(user_id):
+    evict_session_id_of_user(user_id)
     await zep_client.user.adelete(user_id)
 
 async def check_user_exists(user_id):
@@ -41,13 +51,40 @@ async def get_all_sessions():
 async def get_all_sessions_of_user(user_id):
     return await zep_client.user.aget_sessions(user_id)
 
-async def add_session(user_id, sessionid):
+async def get_session_id_of_user(user_id, version=None):
+    # without a version (e.g. the write-behind queue) the cached id is used as it is
+    cached = _session_ids.get(user_id)
+    if cached is not None and (version is None or cached[1] == version):
+        return cached[0]
+    user_all_sessions = await get_all_sessions_of_user(user_id)
+    if len(user_all_sessions) == 0:
+        return None
+    session_id = user_all_sessions[0].session_id
+    _session_ids.set(user_id, (session_id, version))
+    return session_id
+
+def update_session_id_version(user_id, version):
+    # version: the history version after a change of this worker that kept the session. Only applied when the
+    # cached id is tagged with the version right before, otherwise another worker wrote in between
+    cached = _session_ids.get(user_id)
+    if cached is None:
+        return
+    if cached[1] != version - 1:
+        _session_ids.pop(user_id)
+        return
+    _session_ids.set(user_id, (cached[0], version))
+
+def evict_session_id_of_user(user_id):
+    _session_ids.pop(user_id)
+
+async def add_session(user_id, sessionid, version=None):
     session = Session(
         session_id=sessionid,
         user_id=user_id,
         metadata={"created_timestamp": str(datetime.datetime.now())}
         )
     await zep_client.memory.aadd_session(session)
+    _session_ids.set(user_id, (sessionid, version))
     print(f'session for user {user_id} created in zep')
 
 async def retrieve_zep_memory(session_id):
@@ -76,4 +113,9 @@ async def get_all_messages_by_session(session_id):
     
 async def add_message_to_session(session_id, role, msg_content):
     response = await zep_client.memory.aadd_memory(session_id, Memory(messages=[Message(role=role, content=msg_content)]))
-    print(f"chatbot response added to zep: {response}")
\ No newline at end of file
+    print(f"chatbot response added to zep: {response}")
+
+async def add_messages_to_session(session_id, messages):
+    # messages: list of (role, content), saved with a single memory call
+    await zep_client.memory.aadd_memory(session_id, Memory(messages=[Message(role=role, content=content) for role, content in messages]))
+    logger.debug(f"Chat turn added to zep | session: {session_id} | messages: {len(messages)}")
\ No newline at end of file
@@ -0,0 +1,496 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+from app.common.bm25 import BM25Index
+from app.common.mmr import normalize_rows
+from app.common.settings import get_settings
+from app.common import docscope
+from app.common.vectorstore import VectorStoreRegistry
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# rows scored per matmul, bounds the float32 copy an int8 or gathered block needs
+SCORE_BLOCK_ROWS = 8192
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_ROWS = 50000
+
+# Rows of the index at one point in time. Readers take the current state once and never see it change, writers
+# build a new state and swap it in. Base rows come from the snapshot (memory-mapped, float32 or int8 with a scale
+# per row, optionally in inverted lists), rows added since then (the delta segment) are float32 in memory and always
+# scanned exhaustively.
+class _State:
+
+    def __init__(self, dim, base_vectors, base_scales, centroids, list_offsets, list_rows, delta_vectors,
+                 ids, metadatas, doc_rows, doc_numbers, alive, documents):
+        self.dim = dim
+        self.base_vectors = base_vectors
+        self.base_scales = base_scales
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.delta_vectors = delta_vectors
+        self.ids = ids
+        self.metadatas = metadatas
+        # document number of every row, numbers index doc_numbers and never change for a name
+        self.doc_rows = doc_rows
+        self.doc_numbers = doc_numbers
+        self.alive = alive
+        # documents held, including the ones without vectors
+        self.documents = documents
+        self._rows_by_id = None
+
+    @property
+    def base_count(self):
+        return 0 if self.base_vectors is None else len(self.base_vectors)
+
+    @classmethod
+    def empty(cls):
+        return cls(None, None, None, None, None, None, None, [], [], np.zeros(0, dtype=np.int32), {}, np.zeros(0, dtype=bool), frozenset())
+
+    def row_of(self, id):
+        # live row of a vector id, a re-added document's ids map to its newest rows
+        if self._rows_by_id is None:
+            self._rows_by_id = {row_id: row for row, row_id in enumerate(self.ids)}
+        row = self._rows_by_id.get(id)
+        return row if row is not None and self.alive[row] else None
+
+    def vectors(self, rows):
+        # float32 copies of the given rows, rows sorted ascending
+        rows = np.asarray(rows)
+        split = np.searchsorted(rows, self.base_count)
+        parts = []
+        if split > 0:
+            base_rows = rows[:split]
+            block = np.asarray(self.base_vectors[base_rows], dtype=np.float32)
+            if self.base_scales is not None:
+                block *= self.base_scales[base_rows, None]
+            parts.append(block)
+        if split < len(rows):
+            parts.append(self.delta_vectors[rows[split:] - self.base_count])
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+# In-process copy of a pinecone index for the documents it holds, searched with numpy.
+# Snapshot directory layout, "CURRENT" names the snapshot in use so a new one is switched to atomically:
+#   <dir>/CURRENT
+#   <dir>/<snapshot>/meta.json      dim, dtype, held documents
+#   <dir>/<snapshot>/vectors.bin    one row per vector, float32 or int8
+#   <dir>/<snapshot>/scales.f32     int8 only, the row's dequantization scale
+#   <dir>/<snapshot>/records.jsonl  id, document and pinecone metadata of every row
+#   <dir>/<snapshot>/centroids.f32, lists.i32  with nlist > 0, inverted list centroids and rows ordered by list
+#   <dir>/<snapshot>/delta.jsonl    documents added (ids and metadata of their rows) and removed since, in order
+#   <dir>/<snapshot>/delta.f32      float32 rows of the added documents
+# A sync appends to the delta segment, a new snapshot is written (and the inverted lists trained again) once the
+# rows added and removed since the last one exceed compact_ratio of its rows.
+class LocalVectorIndex:
+
+    def __init__(self, directory, dtype="float32", nlist=0, nprobe=8, compact_ratio=0.2):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"Unsupported local index dtype: {dtype}")
+        self.directory = directory
+        self.dtype = dtype
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.compact_ratio = compact_ratio
+        self.hits = 0
+        self.misses = 0
+        self.syncs = 0
+        self.loaded = False
+        self._state = _State.empty()
+        # snapshot the state was read from, the delta segment is only appended to when it is still the current one
+        self._snapshot = None
+        self._write_lock = threading.Lock()
+
+    def load(self):
+        with self._write_lock:
+            snapshot = self._current_snapshot()
+            self._state = _State.empty()
+            self._snapshot = snapshot
+            if snapshot is not None:
+                self._state = self._read_snapshot(snapshot)
+                self._replay_delta(snapshot)
+                logger.info(f"Local vector index loaded | snapshot: {snapshot} | vectors: {int(self._state.alive.sum())} | "
+                            f"delta vectors: {len(self._state.ids) - self._state.base_count} | documents: {len(self._state.documents)}")
+            self.loaded = True
+
+    @property
+    def documents(self):
+        return self._state.documents
+
+    def query(self, vector, top_k, file_names):
+        # pinecone style matches over the rows of file_names, None when a document is not held (the caller falls back)
+        state = self._state
+        if not self.loaded or not file_names <= state.documents:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if len(file_names) == 0 or len(state.ids) == 0:
+            return []
+
+        query = normalize_rows(vector)
+        allowed_documents = np.zeros(len(state.doc_numbers), dtype=bool)
+        allowed_documents[[state.doc_numbers[file_name] for file_name in file_names]] = True
+        candidates = self._probe(state, query)
+        candidates = candidates[state.alive[candidates] & allowed_documents[state.doc_rows[candidates]]]
+        if len(candidates) == 0:
+            return []
+
+        scores = np.concatenate([state.vectors(candidates[i:i + SCORE_BLOCK_ROWS]) @ query
+                                 for i in range(0, len(candidates), SCORE_BLOCK_ROWS)])
+        top = np.argpartition(-scores, top_k - 1)[:top_k] if len(scores) > top_k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        rows = candidates[top]
+        order = np.argsort(rows)
+        values = np.empty((len(rows), state.dim), dtype=np.float32)
+        values[order] = state.vectors(rows[order])
+        return [{"id": state.ids[row], "score": float(scores[i]), "values": values[j].tolist(), "metadata": state.metadatas[row]}
+                for j, (i, row) in enumerate(zip(top, rows))]
+
+    def fetch(self, ids):
+        # values by id like a pinecone fetch, None when one of the ids is not held
+        state = self._state
+        rows = [state.row_of(id) for id in ids]
+        if not self.loaded or any(row is None for row in rows):
+            return None
+        if len(rows) == 0:
+            return {}
+        order = np.argsort(rows)
+        vectors = state.vectors(np.asarray(rows)[order])
+        return {ids[i]: vectors[j].tolist() for j, i in enumerate(order)}
+
+    def _probe(self, state, query):
+        # candidate rows: every row, or the rows of the nprobe closest inverted lists plus the in-memory ones
+        if state.centroids is None:
+            return np.arange(len(state.ids))
+        lists = np.argsort(-(state.centroids @ query))[:self.nprobe]
+        base_rows = np.concatenate([state.list_rows[state.list_offsets[i]:state.list_offsets[i + 1]] for i in lists])
+        return np.concatenate([np.sort(base_rows), np.arange(state.base_count, len(state.ids))])
+
+    def sync(self, file_names, fetch_document):
+        # file_names are the keys the documents are held as (e.g. kb_document_key), fetch_document(key) returns the
+        # document's pinecone matches with values and metadata
+        started_at = time.perf_counter()
+        with self._write_lock:
+            # the changes in the order they are applied, appended to the delta segment
+            changes = []
+            removed = self._state.documents - file_names
+            if len(removed) > 0:
+                self._remove(removed)
+                changes.append(({"op": "remove", "documents": sorted(removed)}, None))
+            added = file_names - self._state.documents
+            for file_name in sorted(added):
+                matches = fetch_document(file_name)
+                ids = [match["id"] for match in matches]
+                metadatas = [dict(match["metadata"]) for match in matches]
+                vectors = normalize_rows([match["values"] for match in matches]) if len(matches) > 0 else None
+                self._add(file_name, ids, metadatas, vectors)
+                changes.append(({"op": "add", "document": file_name, "ids": ids, "metadatas": metadatas}, vectors))
+            if len(added) == 0 and len(removed) == 0:
+                return
+            self.syncs += 1
+            logger.info(f"Local vector index synced | added: {len(added)} | removed: {len(removed)} | duration_ms: {round((time.perf_counter() - started_at) * 1000, 2)}")
+            if self._needs_compaction():
+                self._write_snapshot()
+            else:
+                self._append_delta(changes)
+
+    def _needs_compaction(self):
+        # caller must hold self._write_lock
+        state = self._state
+        if self._snapshot is None or self._snapshot != self._current_snapshot():
+            return True
+        changed_rows = (len(state.ids) - state.base_count) + int(state.base_count - state.alive[:state.base_count].sum())
+        return changed_rows > self.compact_ratio * state.base_count
+
+    def _add(self, file_name, ids, metadatas, vectors):
+        # vectors: normalized float32 rows of the ids, None without any
+        state = self._state
+        doc_numbers = state.doc_numbers
+        if file_name not in doc_numbers:
+            doc_numbers = {**doc_numbers, file_name: len(doc_numbers)}
+        dim = state.dim
+        delta_vectors = state.delta_vectors
+        doc_rows, alive = state.doc_rows, state.alive
+        if len(ids) > 0:
+            dim = dim or vectors.shape[1]
+            delta_vectors = vectors if delta_vectors is None else np.concatenate([delta_vectors, vectors])
+            ids = state.ids + ids
+            metadatas = state.metadatas + metadatas
+            doc_rows = np.concatenate([doc_rows, np.full(len(vectors), doc_numbers[file_name], dtype=np.int32)])
+            alive = np.concatenate([alive, np.ones(len(vectors), dtype=bool)])
+        else:
+            ids, metadatas = state.ids, state.metadatas
+        self._state = _State(dim, state.base_vectors, state.base_scales, state.centroids, state.list_offsets, state.list_rows,
+                             delta_vectors, ids, metadatas, doc_rows, doc_numbers, alive, state.documents | {file_name})
+
+    def _remove(self, file_names):
+        state = self._state
+        removed_numbers = [state.doc_numbers[file_name] for file_name in file_names]
+        alive = state.alive & ~np.isin(state.doc_rows, removed_numbers)
+        self._state = _State(state.dim, state.base_vectors, state.base_scales, state.centroids, state.list_offsets, state.list_rows,
+                             state.delta_vectors, state.ids, state.metadatas, state.doc_rows, state.doc_numbers, alive,
+                             state.documents - file_names)
+
+    def _append_delta(self, changes):
+        # caller must hold self._write_lock. Vectors go first, a change is only replayed once its line is complete
+        path = os.path.join(self.directory, self._snapshot)
+        with open(os.path.join(path, "delta.f32"), "ab") as vectors_file:
+            for _, vectors in changes:
+                if vectors is not None:
+                    vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(os.path.join(path, "delta.jsonl"), "a") as changes_file:
+            changes_file.write("".join(json.dumps(change) + "\n" for change, _ in changes))
+
+    def _replay_delta(self, snapshot):
+        # caller must hold self._write_lock. A crash during an append can leave a cut off line or vectors without
+        # their line, both files are cut back to the complete changes so the next append lines up again
+        path = os.path.join(self.directory, snapshot)
+        changes_path = os.path.join(path, "delta.jsonl")
+        vectors_path = os.path.join(path, "delta.f32")
+        if not os.path.exists(changes_path):
+            return
+        with open(changes_path, "rb") as changes_file:
+            # the last piece is empty or a line cut off mid write
+            lines = changes_file.read().split(b"\n")[:-1]
+        vector_bytes = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+        row_bytes = 4 * self._state.dim if self._state.dim else None
+        changes, kept_lines, rows = [], 0, 0
+        for line in lines:
+            change = json.loads(line)
+            change_rows = len(change["ids"]) if change["op"] == "add" else 0
+            if change_rows > 0 and (row_bytes is None or (rows + change_rows) * row_bytes > vector_bytes):
+                break
+            changes.append(change)
+            kept_lines += 1
+            rows += change_rows
+        with open(changes_path, "ab") as changes_file:
+            changes_file.truncate(sum(len(line) + 1 for line in lines[:kept_lines]))
+        if os.path.exists(vectors_path):
+            with open(vectors_path, "ab") as vectors_file:
+                vectors_file.truncate(rows * row_bytes if row_bytes else 0)
+
+        delta_vectors = np.fromfile(vectors_path, dtype=np.float32).reshape(rows, self._state.dim) if rows > 0 else None
+        row = 0
+        for change in changes:
+            if change["op"] == "remove":
+                self._remove(frozenset(change["documents"]))
+                continue
+            count = len(change["ids"])
+            self._add(change["document"], change["ids"], change["metadatas"], delta_vectors[row:row + count] if count > 0 else None)
+            row += count
+
+    def _current_snapshot(self):
+        current_path = os.path.join(self.directory, "CURRENT")
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path) as current_file:
+            return current_file.read().strip() or None
+
+    def _read_snapshot(self, snapshot):
+        path = os.path.join(self.directory, snapshot)
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        ids, metadatas, documents = [], [], []
+        with open(os.path.join(path, "records.jsonl")) as records_file:
+            for line in records_file:
+                record = json.loads(line)
+                ids.append(record["id"])
+                metadatas.append(record["metadata"])
+                documents.append(record["document"])
+        count = len(ids)
+        dim = meta["dim"]
+        if count == 0:
+            state = _State.empty()
+            state.documents = frozenset(meta["documents"])
+            return state
+
+        vectors = np.memmap(os.path.join(path, "vectors.bin"), dtype=meta["dtype"], mode="r", shape=(count, dim))
+        scales = None
+        if meta["dtype"] == "int8":
+            scales = np.fromfile(os.path.join(path, "scales.f32"), dtype=np.float32)
+        centroids, list_offsets, list_rows = None, None, None
+        if meta.get("nlist", 0) > 0:
+            centroids = np.fromfile(os.path.join(path, "centroids.f32"), dtype=np.float32).reshape(meta["nlist"], dim)
+            lists = np.fromfile(os.path.join(path, "lists.i32"), dtype=np.int32)
+            list_rows = np.argsort(lists, kind="stable").astype(np.int32)
+            list_offsets = np.searchsorted(lists[list_rows], np.arange(meta["nlist"] + 1))
+        doc_numbers = {}
+        for document in meta["documents"]:
+            doc_numbers.setdefault(document, len(doc_numbers))
+        doc_rows = np.asarray([doc_numbers[document] for document in documents], dtype=np.int32)
+        return _State(dim, vectors, scales, centroids, list_offsets, list_rows, None, ids, metadatas, doc_rows,
+                      doc_numbers, np.ones(count, dtype=bool), frozenset(meta["documents"]))
+
+    def _write_snapshot(self):
+        # caller must hold self._write_lock. Compacts the live rows into a new snapshot and switches to it,
+        # so rows added since the last snapshot end up memory-mapped (and in inverted lists) as well
+        state = self._state
+        snapshot = f"snapshot-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(self.directory, snapshot)
+        os.makedirs(path)
+        rows = np.flatnonzero(state.alive)
+        nlist = min(self.nlist, len(rows))
+
+        scales = []
+        with open(os.path.join(path, "vectors.bin"), "wb") as vectors_file:
+            for i in range(0, len(rows), SCORE_BLOCK_ROWS):
+                block = state.vectors(rows[i:i + SCORE_BLOCK_ROWS])
+                if self.dtype == "int8":
+                    block_scales = np.abs(block).max(axis=1) / 127
+                    block_scales[block_scales == 0] = 1.0
+                    block = np.round(block / block_scales[:, None]).astype(np.int8)
+                    scales.append(block_scales.astype(np.float32))
+                vectors_file.write(np.ascontiguousarray(block).tobytes())
+        if self.dtype == "int8":
+            np.concatenate(scales or [np.zeros(0, dtype=np.float32)]).tofile(os.path.join(path, "scales.f32"))
+        if nlist > 0:
+            centroids = self._train_centroids(state, rows, nlist)
+            lists = np.concatenate([np.argmax(state.vectors(rows[i:i + SCORE_BLOCK_ROWS]) @ centroids.T, axis=1)
+                                    for i in range(0, len(rows), SCORE_BLOCK_ROWS)]).astype(np.int32)
+            centroids.tofile(os.path.join(path, "centroids.f32"))
+            lists.tofile(os.path.join(path, "lists.i32"))
+
+        numbers_to_names = {number: name for name, number in state.doc_numbers.items()}
+        with open(os.path.join(path, "records.jsonl"), "w") as records_file:
+            for row in rows:
+                records_file.write(json.dumps({"id": state.ids[row], "document": numbers_to_names[state.doc_rows[row]], "metadata": state.metadatas[row]}) + "\n")
+        with open(os.path.join(path, "meta.json"), "w") as meta_file:
+            json.dump({"dim": state.dim, "dtype": self.dtype, "nlist": nlist, "documents": sorted(state.documents)}, meta_file)
+
+        previous = self._current_snapshot()
+        current_path = os.path.join(self.directory, "CURRENT")
+        with open(current_path + ".tmp", "w") as current_file:
+            current_file.write(snapshot)
+        os.replace(current_path + ".tmp", current_path)
+        self._state = self._read_snapshot(snapshot)
+        self._snapshot = snapshot
+        # readers may still hold the previous state, its memory maps stay valid after the files are unlinked
+        if previous is not None:
+            shutil.rmtree(os.path.join(self.directory, previous), ignore_errors=True)
+        logger.info(f"Local vector index snapshot written | snapshot: {snapshot} | vectors: {len(rows)} | nlist: {nlist}")
+
+    def _train_centroids(self, state, rows, nlist):
+        # spherical k-means on a sample of the rows, empty lists keep their previous centroid
+        rng = np.random.default_rng(0)
+        sample = state.vectors(np.sort(rng.choice(rows, min(len(rows), KMEANS_SAMPLE_ROWS), replace=False)))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=nlist)
+            sums[counts == 0] = centroids[counts == 0]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    def stats(self):
+        state = self._state
+        lookups = self.hits + self.misses
+        return {
+            "loaded": self.loaded,
+            "dtype": self.dtype,
+            "inverted_lists": 0 if state.centroids is None else len(state.centroids),
+            "documents": len(state.documents),
+            "vectors": int(state.alive.sum()),
+            "delta_vectors": 0 if state.delta_vectors is None else int(state.alive[state.base_count:].sum()),
+            "syncs": self.syncs,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+# Keeps an index's documents at the latest requested set: syncs run one at a time in a daemon thread and a
+# request made while one runs becomes the next target.
+class BackgroundSync:
+
+    def __init__(self, index, fetch_document, name):
+        self.index = index
+        self.fetch_document = fetch_document
+        self.name = name
+        self._lock = threading.Lock()
+        self._target = None
+        self._thread = None
+
+    def schedule(self, file_names):
+        file_names = frozenset(file_names)
+        if not self.index.loaded:
+            return
+        with self._lock:
+            if self._thread is None and file_names == self.index.documents:
+                return
+            self._target = file_names
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-sync", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                file_names, self._target = self._target, None
+                if file_names is None:
+                    self._thread = None
+                    return
+            try:
+                self.index.sync(file_names, self.fetch_document)
+            except Exception as ex:
+                logger.exception(f"Index sync failed | index: {self.name} | Error: {ex}")
+
+# The knowledge base is shared by every user and changes rarely, so it can be searched in process instead of
+# with a pinecone round trip per query: kb_local_index holds a copy of its vectors, kb_lexical_index a BM25 index
+# of its chunk texts. Both are loaded from disk at startup and synced to the completed documents (by
+# kb_document_key) whenever a kb retriever is built (a changed doc-set version rebuilds the qa chains). Until a sync has fetched a newly completed
+# document, queries that need it go to pinecone (vectors) or skip the lexical search.
+kb_local_index = LocalVectorIndex(settings.KB_LOCAL_INDEX_DIR, settings.KB_LOCAL_INDEX_DTYPE, settings.KB_LOCAL_INDEX_NLIST,
+                                  settings.KB_LOCAL_INDEX_NPROBE, settings.KB_LOCAL_INDEX_COMPACT_RATIO) if settings.KB_LOCAL_INDEX_DIR else None
+kb_lexical_index = BM25Index(settings.KB_LEXICAL_INDEX_DIR) if settings.KB_LEXICAL_INDEX_DIR else None
+
+def kb_document_key(document_name, document_id, updated_at):
+    # what the kb indexes hold a document as: a re-upload under the same name (a new row) or a change to the row
+    # gets a new key, so the next sync drops the old vectors and fetches the document again
+    return f"{document_name}@{document_id}:{updated_at.isoformat() if updated_at is not None else ''}"
+
+def _document_file_name(document_key):
+    return document_key.rsplit("@", 1)[0]
+
+def _fetch_kb_document(document_key):
+    # vectors and metadata (chunk text) of the document, the local index keeps both, the lexical index the text
+    index = VectorStoreRegistry.get_index(settings.PINECONE_KNOWLEDGE_BASE_INDEX)
+    return docscope.find_document_vectors(index, None, _document_file_name(document_key))
+
+_kb_syncs = [BackgroundSync(index, _fetch_kb_document, name)
+             for index, name in ((kb_local_index, "kb-local-index"), (kb_lexical_index, "kb-lexical-index"))
+             if index is not None]
+
+def load_kb_indexes():
+    for kb_sync in _kb_syncs:
+        try:
+            os.makedirs(kb_sync.index.directory, exist_ok=True)
+            kb_sync.index.load()
+        except Exception as ex:
+            logger.exception(f"Index could not be loaded | index: {kb_sync.name} | Using pinecone only | Error: {ex}")
+
+def sync_kb_indexes(document_keys):
+    for kb_sync in _kb_syncs:
+        kb_sync.schedule(document_keys)
+
+def build_kb_indexes(document_keys, rebuild=False):
+    # loads and syncs the indexes in the calling thread (see app.utils.build_kb_indexes), with rebuild the files
+    # on disk are dropped first so every document is fetched again
+    for kb_sync in _kb_syncs:
+        if rebuild:
+            shutil.rmtree(kb_sync.index.directory, ignore_errors=True)
+        os.makedirs(kb_sync.index.directory, exist_ok=True)
+        kb_sync.index.load()
+        kb_sync.index.sync(frozenset(document_keys), kb_sync.fetch_document)
+
+def get_kb_index_stats():
+    return {
+        "local": kb_local_index.stats() if kb_local_index is not None else None,
+        "lexical": kb_lexical_index.stats() if kb_lexical_index is not None else None,
+    }
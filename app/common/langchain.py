@@ -1,90 +1,143 @@
 from app.common.settings import get_settings
 from app.common.vectorstore import get_vector_store_instance
 from app.common.adminconfig import AdminConfig
+from app.common.cache import LRUCache
+from app.common import contextpack, docscope, kbindex, telemetry
+from app.common.retrieval import MultiQueryFusionRetriever, split_search_queries
 from app.models.user import UserDocument, KnowledgeBaseDocument
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableParallel
+from langchain_core.runnables import RunnableBranch, RunnableLambda, RunnableParallel, RunnablePassthrough
 from operator import itemgetter
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 
 settings = get_settings()
 
-def get_qa_chain(session: Session, username, llm_primary, llm_secondary):
-    kb_docs = session.query(KnowledgeBaseDocument).filter_by(
-        status="Completed").all()
-    user_docs = session.query(UserDocument).filter_by(
-        user_id=username,
-        status="Completed").all()
-    
-    if len(user_docs) > 0:
-        consumer_retrieval = __get_consumer_retriever_tool(llm_secondary, [f"{username}:{user_doc.document_name}" for user_doc in user_docs], 3)
-        kb_retrieval = __get_kb_retriever_tool(llm_secondary, [kb_doc.document_name for kb_doc in kb_docs], 3)
-        return construct_kb_consumer_chain(username, llm_primary, consumer_retrieval, kb_retrieval)
-    
-    kb_retrieval = __get_kb_retriever_tool(llm_secondary, [kb_doc.document_name for kb_doc in kb_docs], 4)
-    return construct_kb_chain(username, llm_primary, kb_retrieval)
+# compiled qa chains keyed by (username, kb doc-set version, user doc-set version, admin config version, provider)
+_qa_chain_cache = LRUCache(maxsize=settings.QA_CHAIN_CACHE_SIZE)
 
-# SETUP KNOWLEDGE BASE + CONSUMER'S DOCUMENT CHAIN
-def construct_kb_consumer_chain(username, llm, consumer_retriever_tool, kb_retriever_tool):
+def get_qa_chain(session: Session, username, llm_primary, llm_secondary, provider):
+    with telemetry.stage("doc_set_queries"):
+        kb_version = _get_kb_doc_set_version(session)
+        user_docs_version = _get_user_doc_set_version(session, username)
+    cache_key = (username, kb_version, user_docs_version, AdminConfig.VERSION, provider)
 
-    prompt = ChatPromptTemplate.from_messages([
-        ('system', f"You are a {AdminConfig.LLM_ROLE}.\n{AdminConfig.LLM_PROMPT}." +        
-        "\n\nYou should ALWAYS and ONLY reference the following cases and legal acts to support your answer:'''{laws_from_kb}'''" +
-        "\n\nUser's Scenario:\n'''{user_scenario}'''"),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{input}")
-    ])
+    qa_chain = _qa_chain_cache.get(cache_key)
+    if qa_chain is None:
+        # drop chains built from older doc-set versions of this user before caching the new one, the other
+        # providers' chains of the current versions stay
+        versions = cache_key[1:4]
+        _qa_chain_cache.evict_where(lambda key: key[0] == username and key[1:4] != versions)
+        with telemetry.stage("qa_chain_build"):
+            qa_chain = _build_qa_chain(session, username, llm_primary, llm_secondary, has_user_docs=user_docs_version[0] > 0)
+        _qa_chain_cache.set(cache_key, qa_chain)
+    return qa_chain
+
+def invalidate_user_qa_chains(username):
+    _qa_chain_cache.evict_where(lambda key: key[0] == username)
+
+def invalidate_all_qa_chains():
+    _qa_chain_cache.clear()
+
+def get_qa_chain_cache_stats():
+    return _qa_chain_cache.stats()
+
+def get_kb_answer_version(session: Session, username):
+    # what a knowledge-base-only answer depends on, None when the user's own documents are part of the answers
+    if _get_user_doc_set_version(session, username)[0] > 0:
+        return None
+    return (_get_kb_doc_set_version(session), AdminConfig.VERSION)
+
+def _get_kb_doc_set_version(session: Session):
+    # count + max id + max updated_at changes whenever a document completes, is re-uploaded or leaves the completed set
+    return tuple(session.query(
+        func.count(KnowledgeBaseDocument.id),
+        func.max(KnowledgeBaseDocument.id),
+        func.max(KnowledgeBaseDocument.updated_at))\
+        .filter(KnowledgeBaseDocument.status == "Completed").one())
+
+def _get_user_doc_set_version(session: Session, username):
+    return tuple(session.query(
+        func.count(UserDocument.id),
+        func.max(UserDocument.id),
+        func.max(UserDocument.updated_at))\
+        .filter(UserDocument.user_id == username,
+                UserDocument.status == "Completed").one())
+
+def _build_qa_chain(session: Session, username, llm_primary, llm_secondary, has_user_docs):
+    if has_user_docs:
+        query_rewriter = __get_query_rewriter(llm_secondary, KB_CONSUMER_QUERY_REWRITE_TEMPLATE)
+        consumer_retriever = __get_consumer_retriever(session, username, 3)
+        kb_retriever = __get_kb_retriever(session, 3)
+        return construct_kb_consumer_chain(username, llm_primary, query_rewriter, consumer_retriever, kb_retriever)
     
-    output_parser = StrOutputParser()
-    setup_and_retrieval = RunnableParallel(
-        {"user_scenario": consumer_retriever_tool, "laws_from_kb": kb_retriever_tool, "input": itemgetter("input"), "chat_history": itemgetter("chat_history")}
+    query_rewriter = __get_query_rewriter(llm_secondary, KB_QUERY_REWRITE_TEMPLATE)
+    kb_retriever = __get_kb_retriever(session, 4)
+    return construct_kb_chain(username, llm_primary, query_rewriter, kb_retriever)
+
+# Qa chains stream the retrieved context first (one chunk per CONTEXT_KEYS entry, packed into a string by
+# contextpack) and then the answer as {"answer": delta} chunks, so the context of a turn can be kept and
+# reused by the follow-up modes.
+CONTEXT_KEYS = ("laws_from_kb", "user_scenario")
+
+# SETUP KNOWLEDGE BASE + CONSUMER'S DOCUMENT CHAIN
+def construct_kb_consumer_chain(username, llm, query_rewriter, consumer_retriever, kb_retriever):
+    # search queries are generated once and shared by both retrievers
+    setup_and_retrieval = RunnablePassthrough.assign(search_queries=query_rewriter) | RunnableParallel(
+        {"user_scenario": itemgetter("search_queries") | consumer_retriever | __get_context_packer("consumer", settings.CONTEXT_CONSUMER_TOKEN_BUDGET, f"{username}:"),
+         "laws_from_kb": itemgetter("search_queries") | kb_retriever | __get_context_packer("kb", settings.CONTEXT_KB_TOKEN_BUDGET),
+         "input": itemgetter("input"), "chat_history": itemgetter("chat_history")}
     )
 
     chain = (
         setup_and_retrieval
-        | prompt
-        | llm
-        | output_parser
+        | RunnablePassthrough.assign(answer=__get_kb_consumer_prompt() | llm | StrOutputParser())
     ).with_config({"tags": ["execute-kb+docs-retriever-agent"], "metadata": {"user-email": username}})
     
     return chain
 
 # SETUP KNOWLEDGE BASE CHAIN
-def construct_kb_chain(username, llm, kb_retriever_tool):    
-    prompt = ChatPromptTemplate.from_messages([
-        ('system', f"You are a {AdminConfig.LLM_ROLE}.\n{AdminConfig.LLM_PROMPT}." +        
-        "\n\nYou should ALWAYS and ONLY reference the following cases and legal acts to support your answer:'''{laws_from_kb}'''"),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{input}")
-    ])
-    
-    output_parser = StrOutputParser()
-    setup_and_retrieval = RunnableParallel(
-        {"laws_from_kb": kb_retriever_tool, "input": itemgetter("input"), "chat_history": itemgetter("chat_history")}
+def construct_kb_chain(username, llm, query_rewriter, kb_retriever):    
+    setup_and_retrieval = RunnablePassthrough.assign(search_queries=query_rewriter) | RunnableParallel(
+        {"laws_from_kb": itemgetter("search_queries") | kb_retriever | __get_context_packer("kb", settings.CONTEXT_KB_TOKEN_BUDGET),
+         "input": itemgetter("input"), "chat_history": itemgetter("chat_history")}
     )
 
     chain = (
         setup_and_retrieval
-        | prompt
-        | llm
-        | output_parser
+        | RunnablePassthrough.assign(answer=__get_kb_prompt() | llm | StrOutputParser())
     ).with_config({"tags": ["execute-kb-retriever-agent"], "metadata": {"user-email": username}})
     
     return chain
 
-def __get_kb_retriever_tool(llm, kb_doc_names, top_k):
-    vectorstore = get_vector_store_instance(settings.PINECONE_KNOWLEDGE_BASE_INDEX, None)
-    retriever = vectorstore.as_retriever(search_type="mmr", 
-                                         search_kwargs={
-                                             'k': top_k, 
-                                             'fetch_k': 50,
-                                             'filter': {"file_name": {"$in": kb_doc_names}}
-                                             })
+# SETUP ANSWER CHAIN FOR AN ALREADY RETRIEVED CONTEXT
+def construct_context_answer_chain(username, llm, has_user_docs):
+    # no rewrite or retrieval, the input carries the context kept from an earlier turn
+    prompt = __get_kb_consumer_prompt() if has_user_docs else __get_kb_prompt()
+    chain = RunnablePassthrough.assign(answer=prompt | llm | StrOutputParser())\
+        .with_config({"tags": ["execute-context-answer-agent"], "metadata": {"user-email": username}})
+    return chain
 
-    template = """
+def __get_kb_consumer_prompt():
+    return ChatPromptTemplate.from_messages([
+        ('system', f"You are a {AdminConfig.LLM_ROLE}.\n{AdminConfig.LLM_PROMPT}." +        
+        "\n\nYou should ALWAYS and ONLY reference the following cases and legal acts to support your answer:'''{laws_from_kb}'''" +
+        "\n\nUser's Scenario:\n'''{user_scenario}'''"),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{input}")
+    ])
+
+def __get_kb_prompt():
+    return ChatPromptTemplate.from_messages([
+        ('system', f"You are a {AdminConfig.LLM_ROLE}.\n{AdminConfig.LLM_PROMPT}." +        
+        "\n\nYou should ALWAYS and ONLY reference the following cases and legal acts to support your answer:'''{laws_from_kb}'''"),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{input}")
+    ])
+
+KB_QUERY_REWRITE_TEMPLATE = """
     You are an experienced solicitor and have access to knowledge base of cases and legal acts.
     You have been tasked to output three keyword-based search queries to fetch relevant pieces of information from cases and legal acts.
     Use the below conversation between a user and legal writer to generate the search queries.
@@ -97,28 +150,11 @@ def __get_kb_retriever_tool(llm, kb_doc_names, top_k):
 
     Search Queries:"""
 
-    retriever_prompt = ChatPromptTemplate.from_template(template)
-
-    return create_history_aware_retriever(
-        llm=llm,
-        retriever=retriever,
-        prompt=retriever_prompt
-    )
-
-def __get_consumer_retriever_tool(llm, consumer_doc_names, top_k):
-    vectorstore = get_vector_store_instance(settings.PINECONE_CONSUMER_INDEX, None)
-    retriever = vectorstore.as_retriever(search_type = "mmr", 
-                                                  search_kwargs={
-                                                      'k': top_k, 
-                                                      'fetch_k': 50,
-                                                      'filter': {"file_name": {"$in": consumer_doc_names}}
-                                                     })
+KB_CONSUMER_QUERY_REWRITE_TEMPLATE = """
+    You are an experienced solicitor and have access to knowledge base of cases and legal acts as well as the user's own documents.
+    You have been tasked to output three keyword-based search queries that will be used to fetch relevant pieces of information from cases and legal acts and relevant sections from the user's documents.
+    Use the below conversation between a user and legal writer to generate the search queries.
     
-    template = """
-    You are an expert in generating keyword-based search queries to extract relevant sections from a document.
-    Your task is to analyse the on going conversation between the user and the assitant below and output three keyword-based search queries.
-    The search queries will be used to fetch relevant sections from the user's document.
-
     Conversation:'''{chat_history}'''
 
     Latest Message:'''{input}'''
@@ -127,13 +163,64 @@ def __get_consumer_retriever_tool(llm, consumer_doc_names, top_k):
 
     Search Queries:"""
 
-    retriever_prompt = ChatPromptTemplate.from_template(template)
+def __get_context_packer(stage_name, max_tokens, source_prefix=""):
+    # page content with short source tags instead of the document reprs, overlapping chunks merged, within the slot's budget
+    return telemetry.timed_runnable(f"{stage_name}_context_pack", RunnableLambda(
+        lambda documents: contextpack.pack_documents(documents, max_tokens, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME, source_prefix)))
 
-    return create_history_aware_retriever(
-        llm=llm,
-        retriever=retriever,
-        prompt=retriever_prompt
-    )
+def __get_query_rewriter(llm, template):
+    rewrite_prompt = ChatPromptTemplate.from_template(template)
+
+    # without chat history the latest message is already a standalone query, skip the llm round trip
+    return telemetry.timed_runnable("query_rewrite", RunnableBranch(
+        (lambda x: not x.get("chat_history", False), lambda x: [x["input"]]),
+        rewrite_prompt | llm | StrOutputParser() | (lambda text: split_search_queries(text, 3))
+    ).with_config(run_name="rewrite_search_queries"))
+
+def __get_kb_retriever(session: Session, top_k):
+    vectorstore = get_vector_store_instance(settings.PINECONE_KNOWLEDGE_BASE_INDEX, None)
+    file_names = None
+    document_keys = None
+    if not docscope.is_active_flag_scope() or kbindex.kb_local_index is not None or kbindex.kb_lexical_index is not None:
+        kb_docs = session.query(KnowledgeBaseDocument.document_name, KnowledgeBaseDocument.id, KnowledgeBaseDocument.updated_at)\
+            .filter_by(status="Completed").all()
+        file_names = frozenset(kb_doc.document_name for kb_doc in kb_docs)
+        document_keys = frozenset(kbindex.kb_document_key(kb_doc.document_name, kb_doc.id, kb_doc.updated_at) for kb_doc in kb_docs)
+    if docscope.is_active_flag_scope():
+        doc_filter = docscope.active_filter()
+    else:
+        doc_filter = {"file_name": {"$in": list(file_names)}}
+    # chains are rebuilt when the completed set changes, the local indexes follow it in the background
+    kbindex.sync_kb_indexes(document_keys)
+    return MultiQueryFusionRetriever(vectorstore=vectorstore,
+                                     k=top_k,
+                                     fetch_k=50,
+                                     filter=doc_filter,
+                                     local_index=kbindex.kb_local_index,
+                                     local_documents=document_keys,
+                                     lexical_index=kbindex.kb_lexical_index,
+                                     lexical_k=settings.KB_LEXICAL_TOP_K,
+                                     lexical_weight=settings.KB_LEXICAL_WEIGHT,
+                                     stage_name="kb")
+
+def __get_consumer_retriever(session: Session, username, top_k):
+    vectorstore = get_vector_store_instance(settings.PINECONE_CONSUMER_INDEX, None)
+    namespace = None
+    if docscope.is_active_flag_scope():
+        # one shared store handle, the user's namespace is set on the retriever
+        namespace = docscope.consumer_namespace(username)
+        doc_filter = docscope.active_filter()
+    else:
+        user_docs = session.query(UserDocument.document_name).filter_by(
+            user_id=username,
+            status="Completed").all()
+        doc_filter = {"file_name": {"$in": [docscope.consumer_file_name(username, user_doc.document_name) for user_doc in user_docs]}}
+    return MultiQueryFusionRetriever(vectorstore=vectorstore,
+                                     k=top_k,
+                                     fetch_k=50,
+                                     filter=doc_filter,
+                                     namespace=namespace,
+                                     stage_name="consumer")
 
 def get_suggested_questions_chain(username, llm):
     template = """
@@ -155,4 +242,24 @@ def get_suggested_questions_chain(username, llm):
         | StrOutputParser()
     ).with_config({"tags": ["execute-suggested-question-chain"], "metadata": {"user-email": username}})
 
-    return chain
\ No newline at end of file
+    return chain
+
+def get_history_summary_chain(username, llm):
+    template = """
+    Summarise the conversation between a user and legal writer below in a few sentences.
+    Keep the user's situation, the legal questions asked and the key points of the answers.
+
+    Conversation:'''{chat_history}'''
+
+    Summary:"""
+
+    prompt = ChatPromptTemplate.from_template(template)
+
+    chain = (
+        {"chat_history": itemgetter("chat_history")}
+        | prompt
+        | llm
+        | StrOutputParser()
+    ).with_config({"tags": ["execute-history-summary-chain"], "metadata": {"user-email": username}})
+
+    return chain
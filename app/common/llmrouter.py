@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import random
+import time
+import openai
+from app.common.azure_openai import AzureOpenAIManager
+from app.common.openai import OpenAIManager
+from app.common.quota import PRIORITY_BACKGROUND, PRIORITY_FREE, QuotaScheduler
+from app.common.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# errors that say something about the provider rather than the request, they fail over to the next provider
+PROVIDER_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+# Consecutive failures open the breaker, the provider is skipped until the reset timeout has passed.
+# After that a single trial request is let through (half open), its outcome closes or re-opens the breaker.
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def release(self):
+        # the request was abandoned without an outcome (e.g. lost a hedge), let another trial through
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+def get_chat_llm(provider, role):
+    # the provider's "primary" or "secondary" chat model, looked up per call as admin config changes replace them
+    llm_manager = OpenAIManager if provider == "openai" else AzureOpenAIManager
+    return llm_manager.CHAT_PRIMARY if role == "primary" else llm_manager.CHAT_SECONDARY
+
+class ProviderStats:
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.breaker = CircuitBreaker(settings.LLM_CIRCUIT_FAILURE_THRESHOLD, settings.LLM_CIRCUIT_RESET_SECONDS)
+        self.ttft_ewma = None
+        self.requests = 0
+        self.failures = 0
+        self.hedges_won = 0
+
+    def record_ttft(self, seconds):
+        alpha = settings.LLM_LATENCY_EWMA_ALPHA
+        self.ttft_ewma = seconds if self.ttft_ewma is None else alpha * seconds + (1 - alpha) * self.ttft_ewma
+
+# Routes streamed llm calls across the providers ("openai" -> OpenAIManager, "azure" -> AzureOpenAIManager).
+# The first provider is drawn by its configured weight divided by its recent time to first token, providers
+# with an open breaker are skipped. With hedging enabled a second provider is started when the first one
+# has not produced a token within the hedge delay, the first to produce a token wins and the other is cancelled.
+# Provider errors before the first token fail over to the next provider, after it the stream is committed.
+# With a token demand the request is first admitted by the QuotaScheduler, see _admit.
+class ProviderRouter:
+    _providers = {name: ProviderStats(name, weight) for name, weight in settings.LLM_PROVIDER_WEIGHTS.items()}
+
+    @classmethod
+    async def astream(cls, make_stream, is_token=lambda chunk: True, demand=None, priority=PRIORITY_FREE):
+        # make_stream(provider) -> async iterator, is_token(chunk) tells answer tokens from preamble chunks,
+        # demand: list of (model role, estimated tokens)
+        candidates = cls._order()
+        # every breaker is open, try them all rather than failing the request outright
+        ignore_breakers = len(candidates) == 0
+        if ignore_breakers:
+            candidates = list(cls._providers.values())
+        if demand:
+            candidates = await cls._admit(candidates, demand, priority)
+        admitted = candidates[0]
+
+        running = {}
+        stream = None
+        # the provider whose breaker still waits for an outcome of this request
+        pending = None
+        try:
+            last_error = None
+            winner = None
+            while winner is None:
+                if len(running) == 0:
+                    if len(candidates) == 0:
+                        raise last_error or RuntimeError("No LLM provider available")
+                    await cls._start(running, candidates.pop(0), make_stream, is_token, ignore_breakers, demand, admitted)
+                    continue
+
+                hedge_delay = settings.LLM_HEDGE_DELAY_SECONDS if settings.LLM_HEDGE_ENABLED and len(candidates) > 0 else None
+                done, _ = await asyncio.wait(running.keys(), timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    logger.info(f"No token within {hedge_delay}s, hedging with provider {candidates[0].name}")
+                    await cls._start(running, candidates.pop(0), make_stream, is_token, ignore_breakers, demand, admitted)
+                    continue
+
+                for task in done:
+                    provider, stream, started_at, hedged = running.pop(task)
+                    try:
+                        buffered = task.result()
+                    except PROVIDER_ERRORS as ex:
+                        logger.warning(f"Provider {provider.name} failed before the first token | Error: {ex}")
+                        cls._record_failure(provider)
+                        last_error = ex
+                        continue
+                    except Exception:
+                        # the request itself was rejected, that says nothing about the provider
+                        provider.breaker.release()
+                        raise
+                    if winner is None:
+                        winner = (provider, stream, started_at, hedged, buffered)
+                        pending = provider
+                    else:
+                        # both produced a token in the same tick, the later one is dropped
+                        provider.breaker.release()
+                        await cls._close(stream)
+
+            await cls._cancel(running)
+            provider, stream, started_at, hedged, buffered = winner
+            provider.record_ttft(time.monotonic() - started_at)
+            if hedged:
+                provider.hedges_won += 1
+
+            for chunk in buffered:
+                yield chunk
+            try:
+                async for chunk in stream:
+                    yield chunk
+            except PROVIDER_ERRORS:
+                pending = None
+                cls._record_failure(provider)
+                raise
+            pending = None
+            provider.breaker.record_success()
+        finally:
+            # also reached when the consumer goes away (client disconnect), no provider keeps generating
+            # and no half open breaker is left waiting for a trial that will never finish
+            if pending is not None:
+                pending.breaker.release()
+            await cls._cancel(running)
+            if stream is not None:
+                await cls._close(stream)
+
+    @classmethod
+    async def ainvoke(cls, make_stream, demand=None, priority=PRIORITY_BACKGROUND):
+        # for chains that return a string, e.g. background generation, the streamed pieces joined
+        return "".join([chunk async for chunk in cls.astream(make_stream, demand=demand, priority=priority)])
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            provider.name: {
+                "state": provider.breaker.state,
+                "weight": provider.weight,
+                "ttft_ewma_seconds": provider.ttft_ewma,
+                "requests": provider.requests,
+                "failures": provider.failures,
+                "hedges_won": provider.hedges_won,
+            }
+            for provider in cls._providers.values()
+        }
+
+    @classmethod
+    def _order(cls):
+        available = [provider for provider in cls._providers.values() if provider.breaker.state != "open"]
+        if len(available) == 0:
+            return []
+
+        known = [provider.ttft_ewma for provider in available if provider.ttft_ewma is not None]
+        default_ttft = min(known) if known else 1.0
+        scores = {provider.name: provider.weight / max(provider.ttft_ewma or default_ttft, 0.01) for provider in available}
+
+        weighted = [provider for provider in available if scores[provider.name] > 0]
+        if len(weighted) > 0:
+            first = random.choices(weighted, weights=[scores[provider.name] for provider in weighted])[0]
+        else:
+            first = available[0]
+        # fallbacks by latency, providers that never answered keep their configured order
+        rest = sorted([provider for provider in available if provider is not first], key=lambda provider: provider.ttft_ewma or float("inf"))
+        return [first] + rest
+
+    @classmethod
+    async def _admit(cls, candidates, demand, priority):
+        # route to the first provider with quota left, queue on the preferred one when all are saturated
+        for provider in candidates:
+            if QuotaScheduler.try_reserve(provider.name, demand):
+                return [provider] + [other for other in candidates if other is not provider]
+        await QuotaScheduler.wait_reserve(candidates[0].name, demand, priority)
+        return candidates
+
+    @classmethod
+    async def _start(cls, running, provider, make_stream, is_token, ignore_breaker=False, demand=None, admitted=None):
+        if not provider.breaker.allow() and not ignore_breaker:
+            if demand and provider is admitted:
+                # its breaker opened while the request was queued, the quota reserved for it is not used
+                await QuotaScheduler.release(provider.name, demand)
+            return
+        if demand and provider is not admitted:
+            # fallbacks and hedges are not queued again, their usage still counts against the quota
+            QuotaScheduler.reserve(provider.name, demand)
+        provider.requests += 1
+        try:
+            stream = make_stream(provider.name)
+        except Exception:
+            provider.breaker.release()
+            raise
+        task = asyncio.create_task(cls._until_first_token(stream, is_token))
+        running[task] = (provider, stream, time.monotonic(), len(running) > 0)
+
+    @staticmethod
+    async def _until_first_token(stream, is_token):
+        buffered = []
+        async for chunk in stream:
+            buffered.append(chunk)
+            if is_token(chunk):
+                break
+        return buffered
+
+    @classmethod
+    async def _cancel(cls, running):
+        for task, (provider, stream, started_at, _) in list(running.items()):
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await cls._close(stream)
+            # no token yet, the time waited so far is only a lower bound of its latency. It is recorded when it
+            # raises the estimate, a hedge loser would otherwise be credited with about the hedge delay
+            waited = time.monotonic() - started_at
+            if provider.ttft_ewma is not None and waited > provider.ttft_ewma:
+                provider.record_ttft(waited)
+            provider.breaker.release()
+        running.clear()
+
+    @staticmethod
+    async def _close(stream):
+        try:
+            await stream.aclose()
+        except Exception as ex:
+            logger.warning(f"Cancelled llm stream did not close cleanly | Error: {ex}")
+
+    @staticmethod
+    def _record_failure(provider):
+        provider.failures += 1
+        provider.breaker.record_failure()
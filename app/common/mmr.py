@@ -0,0 +1,38 @@
+from typing import List
+import numpy as np
+
+def normalize_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def mmr_select(query_vectors, candidate_vectors, k, lambda_mult=0.5, relevance_bonus=None) -> List[int]:
+    # Indices of the k candidates picked by maximal marginal relevance. Each greedy step only computes
+    # similarities to the newly picked candidate and folds them into a running max, so the cost is
+    # O(n * k * d) instead of re-scoring every candidate against the whole selected set.
+    if len(candidate_vectors) == 0 or k <= 0:
+        return []
+    candidates = normalize_rows(candidate_vectors)
+    queries = normalize_rows(np.atleast_2d(query_vectors))
+
+    # relevance of a candidate is its best cosine similarity to any of the queries, plus its bonus if given
+    # (e.g. a lexical match score)
+    relevance = (candidates @ queries.T).max(axis=1)
+    if relevance_bonus is not None:
+        relevance += np.asarray(relevance_bonus, dtype=np.float32)
+
+    selected = np.zeros(len(candidates), dtype=bool)
+    max_similarity_to_selected = np.full(len(candidates), -np.inf, dtype=np.float32)
+    picks = []
+    for step in range(min(k, len(candidates))):
+        if step == 0:
+            scores = relevance.copy()
+        else:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity_to_selected
+        scores[selected] = -np.inf
+        pick = int(np.argmax(scores))
+        picks.append(pick)
+        selected[pick] = True
+        np.maximum(max_similarity_to_selected, candidates @ candidates[pick], out=max_similarity_to_selected)
+    return picks
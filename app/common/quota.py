@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from app.common.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+QUOTA_WINDOW_SECONDS = 60
+
+# lower runs first, paid plans are admitted ahead of free users when a deployment is saturated, background
+# generation (suggested questions, history summaries) only gets what the chats leave
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+PRIORITY_BACKGROUND = 2
+
+# model role -> deployment (model name for openai) per provider
+DEPLOYMENTS = {
+    "openai": {"primary": settings.OPENAI_CHAT_PRIMARY_MODEL_NAME, "secondary": settings.OPENAI_CHAT_SECONDARY_MODEL_NAME},
+    "azure": {"primary": settings.AZURE_OPENAI_CHAT_PRIMARY_DEPLOYMENT_NAME, "secondary": settings.AZURE_OPENAI_CHAT_SECONDARY_DEPLOYMENT_NAME},
+}
+
+# Requests and tokens used by one deployment over the last minute
+class RollingWindow:
+    def __init__(self, tpm, rpm):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.entries = deque()
+        self.tokens = 0
+
+    def _expire(self, now):
+        while self.entries and now - self.entries[0][0] >= QUOTA_WINDOW_SECONDS:
+            _, tokens = self.entries.popleft()
+            self.tokens -= tokens
+
+    def fits(self, tokens, now):
+        self._expire(now)
+        if self.rpm and len(self.entries) + 1 > self.rpm:
+            return False
+        # a single request larger than the whole budget is let through once the window is empty
+        if self.tpm and self.tokens + tokens > self.tpm and len(self.entries) > 0:
+            return False
+        return True
+
+    def add(self, tokens, now):
+        self.entries.append((now, tokens))
+        self.tokens += tokens
+
+    def remove(self, tokens):
+        # drops the newest entry of that size
+        for index in range(len(self.entries) - 1, -1, -1):
+            if self.entries[index][1] == tokens:
+                del self.entries[index]
+                self.tokens -= tokens
+                return
+
+    def seconds_until_change(self, now):
+        if not self.entries:
+            return 0
+        return max(QUOTA_WINDOW_SECONDS - (now - self.entries[0][0]), 0)
+
+# Client side TPM/RPM scheduler per "<provider>:<deployment>" as configured in LLM_QUOTAS_JSON.
+# A request's demand is a list of (model role, estimated tokens) and is admitted for all its deployments at
+# once. Requests that do not fit wait in a priority queue per provider until the window frees up or the
+# max wait has passed, then they are let through and the provider's own rate limiting takes over.
+class QuotaScheduler:
+    _windows: dict = {}
+    _waiters: dict = {}
+    _sequence = itertools.count()
+    _changed: asyncio.Condition = None
+    _admitted = 0
+    _queued = 0
+    _timed_out = 0
+
+    @classmethod
+    def try_reserve(cls, provider, demand) -> bool:
+        if cls._waiters.get(provider):
+            # never overtake queued requests
+            return False
+        return cls._reserve_if_fits(provider, demand)
+
+    @classmethod
+    def reserve(cls, provider, demand):
+        # records usage without waiting, e.g. for fallback and hedged requests
+        now = time.monotonic()
+        for role, tokens in demand:
+            window = cls._get_window(provider, role)
+            if window is not None:
+                window.add(tokens, now)
+
+    @classmethod
+    async def release(cls, provider, demand):
+        # gives back a reservation whose request was never sent
+        for role, tokens in demand:
+            window = cls._get_window(provider, role)
+            if window is not None:
+                window.remove(tokens)
+        if cls._changed is not None:
+            async with cls._changed:
+                cls._changed.notify_all()
+
+    @classmethod
+    async def wait_reserve(cls, provider, demand, priority):
+        if cls._changed is None:
+            cls._changed = asyncio.Condition()
+        waiter = (priority, next(cls._sequence))
+        heapq.heappush(cls._waiters.setdefault(provider, []), waiter)
+        cls._queued += 1
+        deadline = time.monotonic() + settings.LLM_QUOTA_MAX_WAIT_SECONDS
+        try:
+            async with cls._changed:
+                while True:
+                    now = time.monotonic()
+                    if cls._waiters[provider][0] == waiter and cls._reserve_if_fits(provider, demand):
+                        return
+                    if now >= deadline:
+                        cls._timed_out += 1
+                        logger.warning(f"Quota wait timed out, sending request anyway | provider: {provider}")
+                        cls.reserve(provider, demand)
+                        return
+                    timeout = min(cls._seconds_until_change(provider, demand, now), deadline - now)
+                    try:
+                        await asyncio.wait_for(cls._changed.wait(), timeout=max(timeout, 0.01))
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            waiters = cls._waiters[provider]
+            waiters.remove(waiter)
+            heapq.heapify(waiters)
+            # the next waiter may fit now
+            async with cls._changed:
+                cls._changed.notify_all()
+
+    @classmethod
+    def get_stats(cls):
+        now = time.monotonic()
+        windows = {}
+        for key, window in cls._windows.items():
+            if window is None:
+                continue
+            window._expire(now)
+            windows[key] = {"tpm": window.tpm, "rpm": window.rpm, "tokens_used": window.tokens, "requests_used": len(window.entries)}
+        return {
+            "windows": windows,
+            "waiting": {provider: len(waiters) for provider, waiters in cls._waiters.items()},
+            "admitted": cls._admitted,
+            "queued": cls._queued,
+            "timed_out": cls._timed_out,
+        }
+
+    @classmethod
+    def _reserve_if_fits(cls, provider, demand):
+        now = time.monotonic()
+        windows = [(cls._get_window(provider, role), tokens) for role, tokens in demand]
+        if not all(window.fits(tokens, now) for window, tokens in windows if window is not None):
+            return False
+        for window, tokens in windows:
+            if window is not None:
+                window.add(tokens, now)
+        cls._admitted += 1
+        return True
+
+    @classmethod
+    def _seconds_until_change(cls, provider, demand, now):
+        # waiting behind another request is woken by its notify, the fallback timeout only guards against a lost wakeup
+        delays = [window.seconds_until_change(now) for window, tokens in ((cls._get_window(provider, role), tokens) for role, tokens in demand)
+                  if window is not None and not window.fits(tokens, now)]
+        return min(delays, default=1.0)
+
+    @classmethod
+    def _get_window(cls, provider, role):
+        # demand is given per model role, quotas are configured per deployment
+        key = f"{provider}:{DEPLOYMENTS[provider][role]}"
+        if key not in cls._windows:
+            quota = settings.LLM_QUOTAS.get(key)
+            cls._windows[key] = RollingWindow(quota.get("tpm", 0), quota.get("rpm", 0)) if quota else None
+        return cls._windows[key]
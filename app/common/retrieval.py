@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Union
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_pinecone import PineconeVectorStore
+from app.common.mmr import mmr_select
+from app.common import telemetry
+
+logger = logging.getLogger(__name__)
+
+# used by the sync path only, the async path runs queries with asyncio.to_thread
+_query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pinecone-query")
+
+def split_search_queries(text: str, max_queries: int) -> List[str]:
+    queries = []
+    for line in text.split("\n"):
+        # strip list markers like "1.", "2)", "-", "*" and surrounding quotes the llm tends to add
+        query = re.sub(r'^\s*(\d+[\.\)]|[-*•])\s*', '', line).strip().strip('"\'').strip()
+        if query and query.lower() not in [q.lower() for q in queries]:
+            queries.append(query)
+    if len(queries) == 0:
+        queries = [text.strip()]
+    return queries[:max_queries]
+
+def reciprocal_rank_fusion(result_lists, rrf_k: int = 60):
+    # result_lists: one ranked list of pinecone matches per query, returns matches ordered by fused score.
+    # A match found by several lists is kept as the first list returned it
+    fused_scores = {}
+    matches_by_id = {}
+    for matches in result_lists:
+        for rank, match in enumerate(matches):
+            fused_scores[match["id"]] = fused_scores.get(match["id"], 0.0) + 1.0 / (rrf_k + rank + 1)
+            matches_by_id.setdefault(match["id"], match)
+    ranked_ids = sorted(fused_scores, key=fused_scores.get, reverse=True)
+    return [(matches_by_id[match_id], fused_scores[match_id]) for match_id in ranked_ids]
+
+# Takes the rewritten search queries (a list, a plain string is searched as one query), embeds them in one call, searches the index for each query
+# concurrently, fuses the ranked lists with reciprocal-rank fusion and runs MMR over the fused pool.
+# With a lexical index the queries are also searched with BM25: those lists join the fusion, so chunks that
+# name the act, section or case of the query make the pool even when their embeddings rank them low, and a
+# chunk's BM25 score (relative to the best of its list) is added to its cosine relevance in MMR.
+class MultiQueryFusionRetriever(BaseRetriever):
+    vectorstore: PineconeVectorStore
+    k: int = 4
+    fetch_k: int = 50
+    lambda_mult: float = 0.5
+    filter: Optional[dict] = None
+    # overrides the namespace of the vector store, e.g. a per-user namespace on the shared store handle
+    namespace: Optional[str] = None
+    # in-process copy of the index (app.common.kbindex) searched first over local_documents (the keys it holds the
+    # documents in scope as), pinecone answers when it doesn't hold all of them
+    local_index: Optional[Any] = None
+    local_documents: Optional[frozenset] = None
+    # BM25 index (app.common.bm25) over the same chunks, searched over local_documents
+    lexical_index: Optional[Any] = None
+    lexical_k: int = 10
+    # relevance added for the best lexical match of a query, cosine similarities of the pool are usually a few
+    # hundredths apart
+    lexical_weight: float = 0.1
+    max_queries: int = 3
+    rrf_k: int = 60
+    # prefix of the latency stages recorded for this retriever
+    stage_name: str = "retrieval"
+
+    def _get_relevant_documents(self, query: Union[str, List[str]], *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        queries = self._get_queries(query)
+        with telemetry.stage(f"{self.stage_name}_query_embedding"):
+            query_vectors = self.vectorstore.embeddings.embed_documents(queries)
+        with telemetry.stage(f"{self.stage_name}_vector_search"):
+            lexical_future = _query_executor.submit(contextvars.copy_context().run, self._search_lexical, queries)
+            result_lists = list(_query_executor.map(self._query_index, query_vectors))
+            lexical_lists = lexical_future.result()
+        candidates, relevance_bonus = self._fuse(result_lists, lexical_lists)
+        with telemetry.stage(f"{self.stage_name}_mmr"):
+            return self._select(query_vectors, candidates, relevance_bonus)
+
+    async def _aget_relevant_documents(self, query: Union[str, List[str]], *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        queries = self._get_queries(query)
+        with telemetry.stage(f"{self.stage_name}_query_embedding"):
+            query_vectors = await self.vectorstore.embeddings.aembed_documents(queries)
+        with telemetry.stage(f"{self.stage_name}_vector_search"):
+            # the lexical search (and the vector fetch of its matches) runs alongside the vector queries
+            *result_lists, lexical_lists = await asyncio.gather(
+                *[asyncio.to_thread(self._query_index, query_vector) for query_vector in query_vectors],
+                asyncio.to_thread(self._search_lexical, queries))
+        candidates, relevance_bonus = self._fuse(result_lists, lexical_lists)
+        with telemetry.stage(f"{self.stage_name}_mmr"):
+            return self._select(query_vectors, candidates, relevance_bonus)
+
+    def _get_queries(self, query):
+        # a message that skipped the rewrite is searched as it is, its lines are not separate queries
+        if isinstance(query, str):
+            return [query]
+        return list(query)[:self.max_queries]
+
+    def _query_index(self, query_vector):
+        if self.local_index is not None:
+            matches = self.local_index.query(query_vector, self.fetch_k, self.local_documents)
+            if matches is not None:
+                return matches
+        response = self.vectorstore._index.query(
+            vector=query_vector,
+            top_k=self.fetch_k,
+            include_values=True,
+            include_metadata=True,
+            namespace=self.namespace or self.vectorstore._namespace,
+            filter=self.filter,
+        )
+        return response["matches"]
+
+    def _search_lexical(self, queries):
+        # one ranked list per query, none when there is no lexical index or it doesn't hold every document yet
+        if self.lexical_index is None:
+            return []
+        with telemetry.stage(f"{self.stage_name}_lexical_search"):
+            result_lists = [self.lexical_index.query(query, self.lexical_k, self.local_documents) for query in queries]
+            result_lists = [matches for matches in result_lists if matches]
+        if len(result_lists) == 0:
+            return []
+        # MMR needs the vectors of the chunks the vector search didn't return
+        with telemetry.stage(f"{self.stage_name}_lexical_vector_fetch"):
+            vectors = self._fetch_values(list({match["id"] for matches in result_lists for match in matches}))
+        result_lists = [[{**match, "values": vectors[match["id"]]} for match in matches if match["id"] in vectors]
+                        for matches in result_lists]
+        return [matches for matches in result_lists if matches]
+
+    def _fetch_values(self, ids):
+        if self.local_index is not None:
+            vectors = self.local_index.fetch(ids)
+            if vectors is not None:
+                return vectors
+        response = self.vectorstore._index.fetch(ids=ids, namespace=self.namespace or self.vectorstore._namespace)
+        return {id: vector["values"] for id, vector in response["vectors"].items()}
+
+    def _fuse(self, result_lists, lexical_lists):
+        # vector lists go first, a chunk found by both keeps the vector search's match
+        candidates = []
+        seen_texts = set()
+        for match, _ in reciprocal_rank_fusion(list(result_lists) + lexical_lists, self.rrf_k):
+            text = match["metadata"].get(self.vectorstore._text_key)
+            # the same chunk can be stored under different ids (e.g. re-uploads), keep the best ranked one
+            if text is None or text in seen_texts:
+                continue
+            seen_texts.add(text)
+            candidates.append(match)
+            if len(candidates) == self.fetch_k:
+                break
+        if len(lexical_lists) == 0 or len(candidates) == 0:
+            return candidates, None
+
+        lexical_scores = {}
+        for matches in lexical_lists:
+            for match in matches:
+                score = match["score"] / max(matches[0]["score"], 1e-6)
+                lexical_scores[match["id"]] = max(lexical_scores.get(match["id"], 0.0), score)
+        return candidates, [self.lexical_weight * lexical_scores.get(match["id"], 0.0) for match in candidates]
+
+    def _select(self, query_vectors, candidates, relevance_bonus=None) -> List[Document]:
+        if len(candidates) == 0:
+            return []
+
+        # relevance is scored against every rewritten query, not their average
+        selected = mmr_select(query_vectors, [match["values"] for match in candidates], self.k, self.lambda_mult, relevance_bonus)
+
+        documents = []
+        for i in selected:
+            metadata = dict(candidates[i]["metadata"])
+            text = metadata.pop(self.vectorstore._text_key)
+            documents.append(Document(page_content=text, metadata=metadata))
+        return documents
@@ -95,9 +95,96 @@ class Settings(BaseSettings):
     PINECONE_API_KEY: str
     PINECONE_CONSUMER_INDEX: str
     PINECONE_KNOWLEDGE_BASE_INDEX: str
+    PINECONE_POOL_THREADS: int = 8
+    PINECONE_CONNECTION_POOL_MAXSIZE: int = 20
+    # "file_names" ($in filter of completed documents) or "active_flag" (active metadata flag + per-user
+    # consumer namespaces), see app.common.docscope
+    RETRIEVAL_DOC_SCOPE: str = "file_names"
+    # snapshot directory of the in-process knowledge base index searched before pinecone (see app.common.kbindex),
+    # empty disables it
+    KB_LOCAL_INDEX_DIR: str = ""
+    # "float32" or "int8" (a scale per row, a quarter of the memory)
+    KB_LOCAL_INDEX_DTYPE: str = "float32"
+    # inverted lists trained when a snapshot is written, 0 searches every vector
+    KB_LOCAL_INDEX_NLIST: int = 0
+    KB_LOCAL_INDEX_NPROBE: int = 8
+    # syncs append to the snapshot's delta segment, the snapshot is rewritten once added and removed rows exceed
+    # this share of its rows
+    KB_LOCAL_INDEX_COMPACT_RATIO: float = 0.2
+    # directory of the BM25 index over the knowledge base chunks fused with the vector results, empty disables it
+    KB_LEXICAL_INDEX_DIR: str = ""
+    KB_LEXICAL_TOP_K: int = 10
+    # relevance added to the best lexical match of a query in MMR, the others get their share of it by BM25 score
+    KB_LEXICAL_WEIGHT: float = 0.1
 
     # ZEP Config
     ZEP_API_URL: str
+    ZEP_SESSION_ID_CACHE_SIZE: int = 10000
+    ZEP_SESSION_ID_CACHE_TTL_SECONDS: int = 300
+    ZEP_WRITER_WORKERS: int = 4
+    ZEP_WRITER_MAX_ATTEMPTS: int = 5
+    ZEP_WRITER_SHUTDOWN_TIMEOUT_SECONDS: int = 10
+    ZEP_WRITER_SPOOL_PATH: str = "zep_writer_spool.jsonl"
+
+    # Chat Pipeline Config
+    QA_CHAIN_CACHE_SIZE: int = 512
+    EMBEDDING_CACHE_SIZE: int = 10000
+    EMBEDDING_CACHE_DIR: str = ""
+    EMBEDDING_CACHE_DISK_MAX_ENTRIES: int = 200000
+    # JSON object of model name -> chat history token budget, "default" is used for unlisted models
+    CHAT_HISTORY_TOKEN_BUDGETS_JSON: str = '{"default": 3000}'
+    CHAT_HISTORY_MAX_MESSAGES: int = 50
+    # token budgets of the packed retrieved context per prompt slot
+    CONTEXT_KB_TOKEN_BUDGET: int = 2500
+    CONTEXT_CONSUMER_TOKEN_BUDGET: int = 1500
+    CHAT_HISTORY_TOKEN_COUNT_CACHE_SIZE: int = 50000
+    CHAT_HISTORY_SUMMARY_ENABLED: bool = False
+    CHAT_HISTORY_CACHE_SIZE: int = 10000
+    CHAT_HISTORY_CACHE_TTL_SECONDS: int = 300
+    CHAT_HISTORY_CACHE_MAX_MESSAGES: int = 1000
+    TURN_CONTEXT_CACHE_SIZE: int = 10000
+    TURN_CONTEXT_CACHE_TTL_SECONDS: int = 3600
+    SUGGESTED_QUESTIONS_CACHE_SIZE: int = 10000
+    SUGGESTED_QUESTIONS_POOL_SIZE: int = 5
+    # answers to knowledge-base-only questions without chat history, reused for similar questions
+    ANSWER_CACHE_ENABLED: bool = False
+    ANSWER_CACHE_SIZE: int = 2000
+    ANSWER_CACHE_TTL_SECONDS: int = 86400
+    # cosine similarity of the question embeddings above which a cached answer is served
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.95
+    CHAT_STREAM_COALESCE_MS: int = 30
+    CHAT_STREAM_COALESCE_BYTES: int = 256
+    # seconds without output before a heartbeat comment is sent, 0 disables heartbeats
+    CHAT_STREAM_HEARTBEAT_SECONDS: float = 15
+    # finished chat turns kept in memory for /admin/monitoring/chat-latency
+    CHAT_TELEMETRY_RING_BUFFER_SIZE: int = 1000
+
+    @property
+    def CHAT_HISTORY_TOKEN_BUDGETS(self) -> dict:
+        return json.loads(self.CHAT_HISTORY_TOKEN_BUDGETS_JSON)
+
+    # LLM Provider Routing Config
+    # JSON object of provider -> weight for picking the first provider, 0 keeps a provider as fallback only
+    LLM_PROVIDER_WEIGHTS_JSON: str = '{"openai": 1.0, "azure": 0.0}'
+    LLM_CIRCUIT_FAILURE_THRESHOLD: int = 3
+    LLM_CIRCUIT_RESET_SECONDS: int = 30
+    LLM_LATENCY_EWMA_ALPHA: float = 0.2
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_DELAY_SECONDS: float = 4.0
+    # JSON object of "<provider>:<deployment>" -> {"tpm": .., "rpm": ..}, deployments without an entry are not limited
+    LLM_QUOTAS_JSON: str = '{}'
+    LLM_QUOTA_MAX_WAIT_SECONDS: float = 10.0
+    # estimates for the parts of a request that are not known before it runs
+    LLM_CONTEXT_TOKEN_ESTIMATE: int = 1500
+    LLM_COMPLETION_TOKEN_ESTIMATE: int = 800
+
+    @property
+    def LLM_PROVIDER_WEIGHTS(self) -> dict:
+        return json.loads(self.LLM_PROVIDER_WEIGHTS_JSON)
+
+    @property
+    def LLM_QUOTAS(self) -> dict:
+        return json.loads(self.LLM_QUOTAS_JSON)
 
     # Google Cloud Service Account JSON
     GOOGLE_SERVICE_ACCOUNT_JSON: str
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from app.common.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+def format_event(data, event=None, event_id=None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    # multi-line payloads become one data field per line, clients join them back with "\n". A bare "\r" ends a
+    # line for the client too, so it is split on as well, otherwise the text after it would lose its "data: " field
+    lines.extend(f"data: {line}" for line in re.split(r"\r\n|\r|\n", data))
+    return "\n".join(lines) + "\n\n"
+
+def format_comment(comment) -> str:
+    return f": {comment}\n\n"
+
+# Merges small deltas into one chunk per interval or once max_bytes are buffered, whichever comes first.
+# When nothing is buffered and the source stays quiet for heartbeat_seconds, None is yielded instead.
+# The source is iterated by a single pump task, so it keeps one context (context vars) for its whole run.
+async def coalesce(chunks, interval, max_bytes, heartbeat_seconds=0):
+    queue = asyncio.Queue()
+    end = object()
+
+    async def pump():
+        try:
+            async for chunk in chunks:
+                queue.put_nowait((chunk, None))
+            queue.put_nowait((end, None))
+        except Exception as ex:
+            queue.put_nowait((end, ex))
+
+    pump_task = asyncio.create_task(pump())
+    buffer = []
+    buffered_bytes = 0
+    flush_at = None
+    try:
+        while True:
+            if flush_at is not None:
+                timeout = max(flush_at - time.monotonic(), 0)
+            else:
+                timeout = heartbeat_seconds or None
+            try:
+                chunk, error = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if buffer:
+                    yield "".join(buffer)
+                    buffer, buffered_bytes, flush_at = [], 0, None
+                else:
+                    yield None
+                continue
+
+            if chunk is end:
+                # deliver what was produced before the end or failure of the source
+                if buffer:
+                    yield "".join(buffer)
+                if error is not None:
+                    raise error
+                break
+            buffer.append(chunk)
+            buffered_bytes += len(chunk.encode("utf-8"))
+            if flush_at is None:
+                flush_at = time.monotonic() + interval
+            if buffered_bytes >= max_bytes:
+                yield "".join(buffer)
+                buffer, buffered_bytes, flush_at = [], 0, None
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+        await asyncio.gather(pump_task, return_exceptions=True)
+
+# Frames a stream of text deltas as server-sent events: coalesced "message" events with increasing ids,
+# heartbeat comments while the source is quiet, and a final "done" (or "error") event carrying metadata.
+async def encode_stream(chunks, metadata=None):
+    started_at = time.monotonic()
+    event_id = 0
+    characters = 0
+    first_event_ms = None
+    stream = coalesce(chunks,
+                      settings.CHAT_STREAM_COALESCE_MS / 1000,
+                      settings.CHAT_STREAM_COALESCE_BYTES,
+                      settings.CHAT_STREAM_HEARTBEAT_SECONDS)
+    try:
+        async for data in stream:
+            if data is None:
+                yield format_comment("heartbeat")
+                continue
+            event_id += 1
+            characters += len(data)
+            if first_event_ms is None:
+                first_event_ms = round((time.monotonic() - started_at) * 1000)
+            yield format_event(data, event_id=event_id)
+    except Exception as ex:
+        logger.exception(f"Error occured while streaming response: {ex}")
+        detail = getattr(ex, "detail", None) or "Error occured while generating the response"
+        yield format_event(json.dumps({"detail": detail}), event="error", event_id=event_id + 1)
+        return
+
+    done = {
+        **(metadata or {}),
+        "events": event_id,
+        "characters": characters,
+        "first_event_ms": first_event_ms,
+        "total_ms": round((time.monotonic() - started_at) * 1000),
+    }
+    yield format_event(json.dumps(done), event="done", event_id=event_id + 1)
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import logging
+import random
+import re
+from app.common.cache import LRUCache
+from app.common.llmrouter import ProviderRouter, get_chat_llm
+from app.common.settings import get_settings
+from app.common import getzep, langchain, tokens
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# only the latest messages go into the prompt, so they alone decide the suggestions
+SUGGESTION_HISTORY_MESSAGES = 4
+# quota demand of the prompt template and the five questions on top of the messages
+SUGGESTION_TOKEN_OVERHEAD = 200
+
+# Suggested questions are generated in the background after every saved ai turn and stored per user
+# under a hash of the messages they were generated from, the endpoint only reads them. Users without
+# history get one of a pool of generic question sets generated once at startup. Generation goes through the
+# ProviderRouter at background priority, it only uses quota the chats leave.
+_suggestions = LRUCache(maxsize=settings.SUGGESTED_QUESTIONS_CACHE_SIZE)
+_tasks = {}
+_pool = []
+_pool_task = None
+
+def history_hash(messages):
+    digest = hashlib.sha1()
+    for message in messages[-SUGGESTION_HISTORY_MESSAGES:]:
+        digest.update(f"{message.role}\x00{message.content}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+async def get_suggested_questions(username, messages):
+    if len(messages) == 0:
+        return await _get_pool_questions()
+
+    key = history_hash(messages)
+    cached = _suggestions.get(username)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # not generated yet (e.g. first read after a restart), wait for the background generation
+    task = schedule_refresh(username, messages)
+    return await asyncio.shield(task)
+
+def schedule_refresh(username, messages):
+    key = history_hash(messages)
+    task = _tasks.get((username, key))
+    if task is None:
+        task = asyncio.create_task(_refresh(username, key, messages))
+        _tasks[(username, key)] = task
+        task.add_done_callback(lambda _: _tasks.pop((username, key), None))
+    return task
+
+def evict_suggested_questions(username):
+    _suggestions.pop(username)
+
+def start_pool_refresh():
+    global _pool_task
+    if _pool_task is None or _pool_task.done():
+        _pool_task = asyncio.create_task(_refresh_pool())
+    return _pool_task
+
+async def _get_pool_questions():
+    if len(_pool) == 0:
+        await asyncio.shield(start_pool_refresh())
+    return random.choice(_pool) if _pool else []
+
+async def _refresh(username, key, messages):
+    try:
+        questions = await _generate(username, messages[-SUGGESTION_HISTORY_MESSAGES:])
+        _suggestions.set(username, (key, questions))
+        return questions
+    except Exception as ex:
+        logger.exception(f"Suggested questions could not be generated | Error: {ex}")
+        return []
+
+async def _refresh_pool():
+    try:
+        question_sets = await asyncio.gather(*[_generate("suggested-questions-pool", []) for _ in range(settings.SUGGESTED_QUESTIONS_POOL_SIZE)])
+        _pool[:] = [questions for questions in question_sets if questions]
+    except Exception as ex:
+        logger.exception(f"Suggested questions pool could not be generated | Error: {ex}")
+
+async def _generate(username, messages):
+    chat_history = getzep.convert_zep_messages_to_langchain(messages)
+
+    def make_stream(provider):
+        chain = langchain.get_suggested_questions_chain(username, get_chat_llm(provider, "primary"))
+        return chain.astream({"chat_history": chat_history})
+
+    demand = [("primary", sum(tokens.count_tokens(message.content, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME) for message in messages)
+               + SUGGESTION_TOKEN_OVERHEAD)]
+    response = await ProviderRouter.ainvoke(make_stream, demand=demand)
+    return [_strip_suggested_question(question) for question in response.split('\n') if question.strip()]
+
+def _strip_suggested_question(question):
+    question = re.sub(r'^[^a-zA-Z]+', '', question)
+    question = re.sub(r'\?.*', '?', question)
+    return question
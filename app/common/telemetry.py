@@ -0,0 +1,104 @@
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+from opentelemetry import metrics, trace
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+# Spans and histograms go through the global OpenTelemetry providers (configured for Azure Monitor in
+# app.main), every finished chat turn is also kept in an in-process ring buffer for the admin endpoint.
+tracer = trace.get_tracer("caira.chat")
+meter = metrics.get_meter("caira.chat")
+
+_stage_duration = meter.create_histogram("chat.stage.duration", unit="ms", description="Duration of a chat pipeline stage")
+_answer_tokens = meter.create_histogram("chat.answer.tokens", unit="tokens", description="Tokens in a streamed chat answer")
+_tokens_per_second = meter.create_histogram("chat.answer.tokens_per_second", unit="tokens/s", description="Answer tokens per second after the first token")
+
+_current_turn = contextvars.ContextVar("chat_turn", default=None)
+_recent_turns = deque(maxlen=settings.CHAT_TELEMETRY_RING_BUFFER_SIZE)
+
+class ChatTurn:
+    def __init__(self, mode):
+        self.mode = mode
+        self.started_at = time.monotonic()
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.stages = {}
+
+    def add_stage(self, name, duration_ms):
+        # stages that run more than once per turn (e.g. one search per index) add up
+        self.stages[name] = self.stages.get(name, 0.0) + duration_ms
+
+def start_turn(mode):
+    # the turn follows the request through the tasks it spawns via the context var
+    _current_turn.set(ChatTurn(mode))
+
+def finish_turn(answer_tokens, first_token_at=None, outcome="completed"):
+    turn = _current_turn.get()
+    if turn is None:
+        return
+    now = time.monotonic()
+    total_ms = (now - turn.started_at) * 1000
+    tokens_per_second = None
+    if first_token_at is not None and answer_tokens > 0 and now > first_token_at:
+        tokens_per_second = answer_tokens / (now - first_token_at)
+        _tokens_per_second.record(tokens_per_second, {"mode": turn.mode})
+    _answer_tokens.record(answer_tokens, {"mode": turn.mode, "outcome": outcome})
+    _stage_duration.record(total_ms, {"stage": "total", "mode": turn.mode})
+    _recent_turns.append({
+        "created_at": turn.created_at,
+        "mode": turn.mode,
+        "outcome": outcome,
+        "total_ms": round(total_ms, 1),
+        "stages_ms": {name: round(duration, 1) for name, duration in turn.stages.items()},
+        "answer_tokens": answer_tokens,
+        "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second is not None else None,
+    })
+    _current_turn.set(None)
+
+@contextmanager
+def stage(name, **attributes):
+    started_at = time.monotonic()
+    with tracer.start_as_current_span(f"chat.{name}", attributes=attributes):
+        try:
+            yield
+        finally:
+            record_stage(name, (time.monotonic() - started_at) * 1000)
+
+def record_stage(name, duration_ms):
+    turn = _current_turn.get()
+    _stage_duration.record(duration_ms, {"stage": name, "mode": turn.mode if turn else "background"})
+    if turn is not None:
+        turn.add_stage(name, duration_ms)
+
+def timed_runnable(name, runnable):
+    # times a runnable inside an lcel chain as its own stage
+    def run(value, config):
+        with stage(name):
+            return runnable.invoke(value, config)
+
+    async def arun(value, config):
+        with stage(name):
+            return await runnable.ainvoke(value, config)
+
+    return RunnableLambda(run, afunc=arun, name=name)
+
+def get_recent_turns(limit=100):
+    return list(_recent_turns)[-limit:]
+
+def get_stage_summary():
+    # latency percentiles per stage over the turns in the ring buffer
+    durations = {}
+    for turn in _recent_turns:
+        durations.setdefault("total", []).append(turn["total_ms"])
+        for name, duration in turn["stages_ms"].items():
+            durations.setdefault(name, []).append(duration)
+    summary = {}
+    for name, values in durations.items():
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        summary[name] = {"count": len(values), "p50_ms": round(float(p50), 1), "p95_ms": round(float(p95), 1), "p99_ms": round(float(p99), 1)}
+    return {"turns": len(_recent_turns), "stages": summary}
@@ -0,0 +1,36 @@
+import logging
+from functools import lru_cache
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# rough chars-per-token ratio used when no tiktoken encoding can be loaded (e.g. bpe files not reachable)
+APPROX_CHARS_PER_TOKEN = 4
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name):
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # newer chat models unknown to the installed tiktoken share the gpt-4 tokenizer family
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as ex:
+        # encodings are downloaded on first use
+        logger.exception(f"Tiktoken encoding could not be loaded | Falling back to approximate token counts | Error: {ex}")
+        return None
+
+def count_tokens(text, model_name) -> int:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return len(text) // APPROX_CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens, model_name) -> str:
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return text[:max_tokens * APPROX_CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
@@ -1,8 +1,11 @@
 import logging
+import threading
+import time
 from pinecone import Pinecone
+from pinecone.config.openapi import OpenApiConfigFactory
 from langchain_pinecone import PineconeVectorStore
 from app.common.settings import get_settings
-from app.common.azure_openai import AzureOpenAIManager
+from app.common.embeddings import cached_embeddings
 import os
 
 logger = logging.getLogger(__name__)
@@ -13,5 +16,93 @@ settings = get_settings()
 pinecone_instance = Pinecone(api_key=settings.PINECONE_API_KEY)
 os.environ["PINECONE_API_KEY"] = settings.PINECONE_API_KEY
 
+# Process-wide, long-lived vector store handles, one per (index, namespace).
+# Every namespace of an index shares the same pinecone Index client so its urllib3
+# pool keeps the keep-alive connections across requests.
+class VectorStoreRegistry:
+    _indexes: dict = {}
+    _stores: dict = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, index_name, namespace=None) -> PineconeVectorStore:
+        key = (index_name, namespace)
+        store = cls._stores.get(key)
+        if store is not None:
+            return store
+
+        with cls._lock:
+            store = cls._stores.get(key)
+            if store is None:
+                store = PineconeVectorStore(index=cls._get_index(index_name), embedding=cached_embeddings, namespace=namespace)
+                cls._stores[key] = store
+                logger.info(f"Vector store handle created | index: {index_name} | namespace: {namespace}")
+        return store
+
+    @classmethod
+    def get_index(cls, index_name):
+        with cls._lock:
+            return cls._get_index(index_name)
+
+    @classmethod
+    def _get_index(cls, index_name):
+        # caller must hold cls._lock
+        index = cls._indexes.get(index_name)
+        if index is None:
+            host = pinecone_instance.describe_index(index_name).host
+            openapi_config = OpenApiConfigFactory.build(api_key=settings.PINECONE_API_KEY, host=host)
+            openapi_config.connection_pool_maxsize = settings.PINECONE_CONNECTION_POOL_MAXSIZE
+            index = pinecone_instance.Index(host=host, pool_threads=settings.PINECONE_POOL_THREADS, openapi_config=openapi_config)
+            cls._indexes[index_name] = index
+        return index
+
+    @classmethod
+    def warm_up(cls, index_names):
+        # resolve hosts and open one connection per index so the first chat turn doesn't pay for it
+        for index_name in index_names:
+            try:
+                cls.get(index_name, None)
+                cls._indexes[index_name].describe_index_stats()
+                logger.info(f"Vector store warmed up | index: {index_name}")
+            except Exception as ex:
+                logger.exception(f"Vector store warm up failed | index: {index_name} | Error: {ex}")
+
+    @classmethod
+    def health_check(cls):
+        health = {}
+        for index_name, index in list(cls._indexes.items()):
+            start = time.perf_counter()
+            try:
+                stats = index.describe_index_stats()
+                health[index_name] = {
+                    "healthy": True,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "total_vector_count": stats.total_vector_count,
+                }
+            except Exception as ex:
+                logger.exception(f"Vector store health check failed | index: {index_name} | Error: {ex}")
+                health[index_name] = {
+                    "healthy": False,
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "error": str(ex),
+                }
+        return health
+
+    @classmethod
+    def get_metrics(cls):
+        metrics = {"handles": len(cls._stores), "indexes": {}}
+        for index_name, index in list(cls._indexes.items()):
+            pool_manager = index._api_client.rest_client.pool_manager
+            pools = [pool_manager.pools[key] for key in pool_manager.pools.keys()]
+            metrics["indexes"][index_name] = {
+                "namespaces": [namespace for name, namespace in cls._stores if name == index_name],
+                "pool_threads": index._api_client.pool_threads,
+                "connection_pool_maxsize": pool_manager.connection_pool_kw.get("maxsize"),
+                "connections_opened": sum(pool.num_connections for pool in pools),
+                "requests_served": sum(pool.num_requests for pool in pools),
+                "pool_slots_available": sum(pool.pool.qsize() for pool in pools if pool.pool is not None),
+            }
+        return metrics
+
 def get_vector_store_instance(index_name, namespace):
-    return PineconeVectorStore.from_existing_index(index_name, AzureOpenAIManager.EMBEDDINGS, namespace=namespace)
\ No newline at end of file
+    return VectorStoreRegistry.get(index_name, namespace)
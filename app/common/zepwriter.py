@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from zep_python.message import Message
+from app.common.settings import get_settings
+from app.common import getzep, telemetry
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+# writes started without the queue, the event loop only keeps weak references to tasks
+_background_tasks = set()
+
+# Write-behind persistence of chat turns to zep. A turn (user + ai message) is queued when the
+# stream ends and saved with a single memory call by background workers, so the response is not
+# held open by zep. Users are sharded over the workers so each user's turns are saved in order.
+# Failed writes are retried with backoff and spooled to disk after the last attempt (and at
+# shutdown), the spool is replayed on the next startup.
+class ChatTurnWriter:
+    _queues: list = []
+    _workers: list = []
+    _pending: dict = {}
+    # writes in flight, a worker cancelled at shutdown lets its write finish
+    _writes: set = set()
+
+    @classmethod
+    async def start(cls):
+        cls._queues = [asyncio.Queue() for _ in range(settings.ZEP_WRITER_WORKERS)]
+        cls._workers = [asyncio.create_task(cls._work(queue)) for queue in cls._queues]
+        for turn in cls._load_spool():
+            cls._put(turn)
+        logger.info(f"Chat turn writer started | workers: {settings.ZEP_WRITER_WORKERS}")
+
+    @classmethod
+    async def stop(cls):
+        if len(cls._queues) == 0:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*[queue.join() for queue in cls._queues]), timeout=settings.ZEP_WRITER_SHUTDOWN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Chat turn writer did not drain before shutdown | turns left: {cls.get_stats()['pending_turns']}")
+        for worker in cls._workers:
+            worker.cancel()
+        await asyncio.gather(*cls._workers, return_exceptions=True)
+        if len(cls._writes) > 0:
+            await asyncio.wait(list(cls._writes), timeout=settings.ZEP_WRITER_SHUTDOWN_TIMEOUT_SECONDS)
+        # turns still queued or being retried are spooled for the next startup, a turn saved by a write that
+        # finished after its worker was cancelled would be saved twice
+        cls._spool([turn for turns in cls._pending.values() for turn in turns if not turn.get("written")])
+        cls._pending = {}
+        cls._queues = []
+        cls._workers = []
+
+    @classmethod
+    def enqueue(cls, user_id, messages):
+        # messages: list of (role, content)
+        created_at = datetime.now(timezone.utc).isoformat()
+        turn = {"user_id": user_id, "messages": [{"role": role, "content": content, "created_at": created_at} for role, content in messages]}
+        if len(cls._queues) == 0:
+            # writer not running (e.g. scripts), save without queueing
+            task = asyncio.create_task(cls._write(turn))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            return task
+        cls._put(turn)
+
+    @classmethod
+    def pending_messages(cls, user_id):
+        # messages accepted but not yet saved, lets the next turn see them in its history
+        return [Message(role=message["role"], content=message["content"], created_at=message["created_at"])
+                for turn in cls._pending.get(user_id, []) for message in turn["messages"]]
+
+    @classmethod
+    def discard_pending(cls, user_id):
+        # used when the user's session is replaced, queued turns belong to the old conversation
+        for turn in cls._pending.pop(user_id, []):
+            turn["discarded"] = True
+
+    @classmethod
+    def get_stats(cls):
+        return {
+            "queued": sum(queue.qsize() for queue in cls._queues),
+            "pending_turns": sum(len(turns) for turns in cls._pending.values()),
+        }
+
+    @classmethod
+    def _put(cls, turn):
+        cls._pending.setdefault(turn["user_id"], []).append(turn)
+        cls._queues[hash(turn["user_id"]) % len(cls._queues)].put_nowait(turn)
+
+    @classmethod
+    def _done(cls, turn):
+        turns = cls._pending.get(turn["user_id"], [])
+        if turn in turns:
+            turns.remove(turn)
+        if len(turns) == 0:
+            cls._pending.pop(turn["user_id"], None)
+
+    @classmethod
+    async def _work(cls, queue):
+        while True:
+            turn = await queue.get()
+            try:
+                for attempt in range(1, settings.ZEP_WRITER_MAX_ATTEMPTS + 1):
+                    if turn.get("discarded"):
+                        break
+                    try:
+                        await cls._write_shielded(turn)
+                        break
+                    except Exception as ex:
+                        if attempt == settings.ZEP_WRITER_MAX_ATTEMPTS:
+                            logger.exception(f"Chat turn could not be saved to zep, spooling to disk | user: {turn['user_id']} | Error: {ex}")
+                            cls._spool([turn])
+                        else:
+                            delay = min(2 ** attempt, 60)
+                            logger.warning(f"Chat turn save failed, retrying in {delay}s | user: {turn['user_id']} | Error: {ex}")
+                            await asyncio.sleep(delay)
+                cls._done(turn)
+            finally:
+                queue.task_done()
+
+    @classmethod
+    async def _write_shielded(cls, turn):
+        write = asyncio.create_task(cls._write(turn))
+        cls._writes.add(write)
+
+        def finished(task):
+            cls._writes.discard(task)
+            if not task.cancelled() and task.exception() is None:
+                turn["written"] = True
+
+        write.add_done_callback(finished)
+        await asyncio.shield(write)
+
+    @classmethod
+    async def _write(cls, turn):
+        with telemetry.stage("zep_write"):
+            session_id = await getzep.get_session_id_of_user(turn["user_id"])
+            if session_id is None:
+                raise Exception("No Zep session found")
+            await getzep.add_messages_to_session(session_id, [(message["role"], message["content"]) for message in turn["messages"]])
+
+    @classmethod
+    def _spool(cls, turns):
+        turns = [turn for turn in turns if not turn.get("discarded")]
+        if not settings.ZEP_WRITER_SPOOL_PATH or len(turns) == 0:
+            return
+        try:
+            with open(settings.ZEP_WRITER_SPOOL_PATH, "a") as spool_file:
+                for turn in turns:
+                    spool_file.write(json.dumps(turn) + "\n")
+        except Exception as ex:
+            logger.exception(f"Chat turns could not be spooled | turns lost: {len(turns)} | Error: {ex}")
+
+    @classmethod
+    def _load_spool(cls):
+        if not settings.ZEP_WRITER_SPOOL_PATH or not os.path.exists(settings.ZEP_WRITER_SPOOL_PATH):
+            return []
+        try:
+            with open(settings.ZEP_WRITER_SPOOL_PATH) as spool_file:
+                turns = [json.loads(line) for line in spool_file if line.strip()]
+            os.remove(settings.ZEP_WRITER_SPOOL_PATH)
+            logger.info(f"Replaying spooled chat turns | turns: {len(turns)}")
+            return turns
+        except Exception as ex:
+            logger.exception(f"Spooled chat turns could not be loaded | Error: {ex}")
+            return []
@@ -1,10 +1,14 @@
+import asyncio
 from fastapi import FastAPI
 from .common import logging_config
 
 logging_config.setup_logging()
 
-from app.routes import auth, user, user_chat, user_document, admin_config, admin_knowledge_base, payment, stripe
+from app.routes import auth, user, user_chat, user_document, admin_config, admin_knowledge_base, admin_monitoring, payment, stripe
 from app.common.settings import get_settings
+from app.common import kbindex, suggestions
+from app.common.vectorstore import VectorStoreRegistry
+from app.common.zepwriter import ChatTurnWriter
 from fastapi.middleware.cors import CORSMiddleware
 from azure.monitor.opentelemetry import configure_azure_monitor
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
@@ -33,6 +37,7 @@ def create_application():
     application.include_router(auth.auth_router)
     application.include_router(admin_config.admin_config_router_protected)
     application.include_router(admin_knowledge_base.admin_knowledge_base_router_protected)
+    application.include_router(admin_monitoring.admin_monitoring_router_protected)
     return application
 
 app = create_application()
@@ -45,6 +50,27 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+@app.on_event("startup")
+async def warm_up_vector_stores():
+    await asyncio.to_thread(VectorStoreRegistry.warm_up, [settings.PINECONE_KNOWLEDGE_BASE_INDEX, settings.PINECONE_CONSUMER_INDEX])
+
+@app.on_event("startup")
+async def load_kb_indexes():
+    await asyncio.to_thread(kbindex.load_kb_indexes)
+
+@app.on_event("startup")
+async def start_chat_turn_writer():
+    await ChatTurnWriter.start()
+
+@app.on_event("startup")
+async def precompute_suggested_questions():
+    # generic question sets for users without history, generated in the background
+    suggestions.start_pool_refresh()
+
+@app.on_event("shutdown")
+async def stop_chat_turn_writer():
+    await ChatTurnWriter.stop()
+
 @app.get("/")
 async def root():
     return {"message": "Caira V2 is live"}
@@ -34,6 +34,9 @@ class User(Base):
     role = Column(Enum(Role), nullable=False)
     verified_at = Column(DATETIME(fsp=3), nullable=True, default=None)
     trial_expiry = Column(DATETIME(fsp=3), nullable=True, default=None)
+    message_count = Column(Integer, nullable=True, default=0)
+    # bumped on every change to the user's zep chat history, tells every worker its cached copy is stale
+    chat_history_version = Column(Integer, nullable=False, default=0, server_default="0")
     updated_at = Column(DATETIME(fsp=3), nullable=True, default=None, onupdate=func.now())
     created_at = Column(DATETIME(fsp=3), nullable=False, default=func.now())
     
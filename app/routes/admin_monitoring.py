@@ -0,0 +1,30 @@
+from fastapi import APIRouter, Depends, status
+from app.common.security import is_admin, oauth2_scheme, validate_access_token
+from app.services import admin_monitoring
+
+admin_monitoring_router_protected = APIRouter(
+    prefix="/admin/monitoring",
+    tags=["Admin"],
+    responses={404: {"description": "Not found"}},
+    dependencies=[Depends(oauth2_scheme), Depends(validate_access_token), Depends(is_admin)]
+)
+
+@admin_monitoring_router_protected.get("/vector-stores", status_code=status.HTTP_200_OK)
+async def get_vector_store_status():
+    return await admin_monitoring.get_vector_store_status()
+
+@admin_monitoring_router_protected.get("/caches", status_code=status.HTTP_200_OK)
+async def get_cache_stats():
+    return await admin_monitoring.get_cache_stats()
+
+@admin_monitoring_router_protected.delete("/caches/answers", status_code=status.HTTP_200_OK)
+async def purge_answer_cache():
+    return await admin_monitoring.purge_answer_cache()
+
+@admin_monitoring_router_protected.get("/llm-providers", status_code=status.HTTP_200_OK)
+async def get_llm_provider_status():
+    return await admin_monitoring.get_llm_provider_status()
+
+@admin_monitoring_router_protected.get("/chat-latency", status_code=status.HTTP_200_OK)
+async def get_chat_latency(limit: int = 50):
+    return await admin_monitoring.get_chat_latency(limit)
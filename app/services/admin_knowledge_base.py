@@ -6,7 +6,7 @@ from sqlalchemy import case, desc
 from app.common.settings import get_settings
 from app.models.user import KnowledgeBaseDocument
 from app.schemas.responses.admin_knowledge_base import FileInfo, GdriveUploadResponse, DeleteDocumentsResponse, DocumentsListResponse, ValidateDocumentsResponse, FileExists
-from app.common import gdrive, azurecloud
+from app.common import gdrive, azurecloud, docscope, langchain
 from sqlalchemy.orm import Session
 
 settings = get_settings()
@@ -170,14 +170,22 @@ async def enqueue_file_deletions(file_names: List[str], session: Session):
             # error logging can be made more descriptive using status
             failed_files.append(FileInfo(filename=file_name, error="File does not exists"))
 
+    # knowledge base is shared, every cached chain references the deleted files
+    if len(existing_file_names) > 0:
+        langchain.invalidate_all_qa_chains()
+        # with flag scoped retrieval the status alone doesn't keep the files out of the answers
+        docscope.set_kb_documents_active(existing_file_names, False)
+
     messages_to_enqueue = []
     for batch in _chunk_data(existing_file_names, size=256):
         message_body = json.dumps({"file_names": batch})
         messages_to_enqueue.append(message_body)
     failed_messages = await azurecloud.send_messages_to_queue(settings.AZURE_STORAGE_KNOWLEDGEBASE_FILE_DELETE_QUEUE_NAME, messages_to_enqueue)
 
+    reverted_file_names = []
     for msg, error in failed_messages:
         failed_file_names = json.loads(msg)["file_names"]
+        reverted_file_names.extend(failed_file_names)
         for failed_file_name in failed_file_names:
             failed_files.append(FileInfo(filename=failed_file_name, error=error))
             # revert status to completed for failed files
@@ -187,6 +195,9 @@ async def enqueue_file_deletions(file_names: List[str], session: Session):
             session.add(doc)
             session.commit()
 
+    if len(reverted_file_names) > 0:
+        docscope.set_kb_documents_active(reverted_file_names, True)
+
     return DeleteDocumentsResponse(failed_files=failed_files)
 
 async def get_azure_storage_token():
@@ -0,0 +1,31 @@
+import asyncio
+from app.common import chathistory, kbindex, langchain, telemetry
+from app.common.answercache import answer_cache
+from app.common.embeddings import cached_embeddings
+from app.common.llmrouter import ProviderRouter
+from app.common.quota import QuotaScheduler
+from app.common.vectorstore import VectorStoreRegistry
+from app.common.zepwriter import ChatTurnWriter
+
+async def get_vector_store_status():
+    # health check does a network round trip per index, keep it off the event loop
+    health = await asyncio.to_thread(VectorStoreRegistry.health_check)
+    return {"health": health, "metrics": VectorStoreRegistry.get_metrics(), "kb_indexes": kbindex.get_kb_index_stats()}
+
+async def get_cache_stats():
+    return {
+        "qa_chains": langchain.get_qa_chain_cache_stats(),
+        "embeddings": cached_embeddings.stats(),
+        "chat_histories": chathistory.get_history_cache_stats(),
+        "zep_writer": ChatTurnWriter.get_stats(),
+        "answers": answer_cache.stats(),
+    }
+
+async def purge_answer_cache():
+    return {"purged": answer_cache.purge()}
+
+async def get_llm_provider_status():
+    return {"providers": ProviderRouter.get_stats(), "quotas": QuotaScheduler.get_stats()}
+
+async def get_chat_latency(limit):
+    return {"summary": telemetry.get_stage_summary(), "recent_turns": telemetry.get_recent_turns(limit)}
@@ -3,7 +3,8 @@ import logging
 import uuid
 from fastapi import HTTPException, status
 from app.common.security import delete_refresh_tokens_from_db, get_user_from_db, hash_password, is_password_strong_enough, verify_password
-from app.common import getzep, azurecloud
+from app.common import chathistory, docscope, getzep, azurecloud
+from app.common.zepwriter import ChatTurnWriter
 from app.models.user import AdminConfig, User, Plan, Role, UserDocument
 from app.services import email, payment
 from app.utils.email_context import FORGOT_PASSWORD, USER_VERIFY_ACCOUNT, USER_DELETE_ACCOUNT
@@ -224,10 +225,17 @@ async def delete_user(data, session):
         if user.role == Role.User and user.stripeId:
             await payment.delete_customer(user.stripeId)
 
-        # clear zep chat history
+        # clear zep chat history (resolved from zep, the cached id may be stale on this worker)
+        chathistory.evict_cached_history(user.email)
+        chathistory.evict_turn_contexts(user.email)
+        ChatTurnWriter.discard_pending(user.email)
+        getzep.evict_session_id_of_user(user.email)
         zep_session_id = await _get_zep_session_id_by_username(user.email)
         await getzep.delete_session(zep_session_id)
         await getzep.delete_user(user.email)
+
+        # leftovers of files whose vector deletion failed
+        await docscope.delete_consumer_namespace(user.email)
         
         # delete user entry from database
         session.delete(user)
@@ -238,8 +246,7 @@ async def delete_user(data, session):
                             detail=f"Error occured while deleting user: {ex}")
 
 async def _get_zep_session_id_by_username(username):
-    user_all_sessions = await getzep.get_all_sessions_of_user(username)
-    if len(user_all_sessions) == 0:
+    session_id = await getzep.get_session_id_of_user(username)
+    if session_id is None:
         raise Exception("No Zep session found")
-    session_id = user_all_sessions[0].session_id
     return session_id
\ No newline at end of file
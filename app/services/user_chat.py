@@ -1,57 +1,71 @@
+import asyncio
 import logging
 import re
+import time
 import uuid
 from fastapi import HTTPException, status
-import openai
-import backoff
-from app.common.openai import OpenAIManager
-from app.common.azure_openai import AzureOpenAIManager
+from app.common.llmrouter import ProviderRouter, get_chat_llm
 from app.common.settings import get_settings
 from app.schemas.requests.user_chat import Mode
-from app.common import getzep, langchain
+from app.common import chathistory, getzep, langchain, suggestions, telemetry, tokens
+from app.common.answercache import answer_cache
+from app.common.embeddings import cached_embeddings
+from app.common.mmr import normalize_rows
+from app.common.quota import PRIORITY_FREE, PRIORITY_PAID
+from app.common.zepwriter import ChatTurnWriter
+from langchain_core.messages import SystemMessage
+from opentelemetry import metrics
 from app.models.user import Plan, Role, User
 
 logger = logging.getLogger(__name__)
 
 settings = get_settings()
 
+meter = metrics.get_meter(__name__)
+_cancelled_answers = meter.create_counter("chat.answers.cancelled", description="Chat answers cancelled by a client disconnect")
+_cancelled_answer_tokens = meter.create_histogram("chat.answers.cancelled.tokens", unit="tokens", description="Answer tokens streamed before the client disconnected")
+
 async def get_ai_response(user: User, db_session, user_msg, traceless, mode):
     username = user.email
     user_role = user.role
     user_plan = user.plan
-    zep_chat_history = await get_chat_history(username)
 
     # Check number of messages for regular user with free plan
     if user_role == Role.User and user_plan == Plan.free:
-        user_message_count = 0
-        for message in zep_chat_history:
-            if message.role == "User":
-                user_message_count += 1
-                if user_message_count == settings.FREE_PLAN_MSG_LIMIT:
-                    yield "You have consumed all of your free messages. Subscribe to Caira in the side menu. You can access it by pressing the icon on the top left corner of the page."
-                    return
-    
-    zep_chat_history = zep_chat_history[-10:]
+        if await _get_user_message_count(user, db_session) >= settings.FREE_PLAN_MSG_LIMIT:
+            yield "You have consumed all of your free messages. Subscribe to Caira in the side menu. You can access it by pressing the icon on the top left corner of the page."
+            return
+
+    telemetry.start_turn(mode.name)
+    with telemetry.stage("zep_history"):
+        zep_chat_history = await get_chat_history(username, db_session, user.chat_history_version)
+    history_window, older_messages = chathistory.select_history_window(zep_chat_history, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME)
+    langchain_chat_history = getzep.convert_zep_messages_to_langchain(history_window)
+    history_summary = chathistory.get_history_summary(username, older_messages)
+    if history_summary:
+        langchain_chat_history.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {history_summary}"))
     ai_msg=''
+    retrieved_context = {}
 
     if mode == Mode.NA:
-        langchain_chat_history = getzep.convert_zep_messages_to_langchain(zep_chat_history)
-        
-        # If streaming fails after retrying fallback to azure openai
-        try:
-            qa_chain = langchain.get_qa_chain(db_session, username, OpenAIManager.CHAT_PRIMARY, OpenAIManager.CHAT_SECONDARY)
-            async for content in _stream_response(chain=qa_chain, user_msg=user_msg, chat_history=langchain_chat_history):
-                ai_msg += content
-                yield content
-        except openai.RateLimitError:
-            qa_chain = langchain.get_qa_chain(db_session, username, AzureOpenAIManager.CHAT_PRIMARY, AzureOpenAIManager.CHAT_SECONDARY)
-            async for content in _stream_response(chain=qa_chain, user_msg=user_msg, chat_history=langchain_chat_history):
-                ai_msg += content
-                yield content
+        cache_key = await _get_answer_cache_key(db_session, username, user_msg, langchain_chat_history)
+        cached_answer = answer_cache.lookup(*cache_key) if cache_key is not None else None
+        if cached_answer is not None:
+            stream = _stream_cached_answer(cached_answer, retrieved_context)
+        else:
+            stream = _stream_answer(db_session, user, user_msg, langchain_chat_history, None, retrieved_context)
+        async for content in stream:
+            ai_msg += content
+            yield content
+
+        if cache_key is not None and cached_answer is None and ai_msg:
+            answer_cache.store(*cache_key, ai_msg, retrieved_context)
 
         if not traceless:
-            await _add_message_to_chat_history(username, "User", user_msg)
-            await _add_message_to_chat_history(username, "AI", ai_msg)
+            # saved in the background, the stream is not held open by zep
+            _add_messages_to_chat_history(username, [("User", user_msg), ("AI", ai_msg)], db_session)
+            chathistory.set_turn_context(username, ai_msg, retrieved_context)
+            _increment_user_message_count(user, db_session)
 
     else:
         latest_ai_response = None
@@ -68,62 +82,203 @@ async def get_ai_response(user: User, db_session, user_msg, traceless, mode):
             user_msg = f'''Repeat your last response where you say: "{latest_ai_response}" but with more detail including relevant case law and legal precedent if available.'''
         else:
             user_msg = f'''Repeat your last response where you say: "{latest_ai_response}" but tell me what I could consider step-by-step.'''
-        
-        langchain_chat_history = getzep.convert_zep_messages_to_langchain(zep_chat_history)
 
-        # If streaming fails after retrying fallback to azure openai
-        try:
-            qa_chain = langchain.get_qa_chain(db_session, username, OpenAIManager.CHAT_PRIMARY, OpenAIManager.CHAT_SECONDARY)
-            async for content in _stream_response(chain=qa_chain, user_msg=user_msg, chat_history=langchain_chat_history):
-                ai_msg += content
-                yield content
-        except openai.RateLimitError:
-            qa_chain = langchain.get_qa_chain(db_session, username, AzureOpenAIManager.CHAT_PRIMARY, AzureOpenAIManager.CHAT_SECONDARY)
-            async for content in _stream_response(chain=qa_chain, user_msg=user_msg, chat_history=langchain_chat_history):
-                ai_msg += content
-                yield content
+        # rephrasing the previous answer needs the same context, reuse it instead of retrieving again
+        context = chathistory.get_turn_context(username, latest_ai_response)
+
+        async for content in _stream_answer(db_session, user, user_msg, langchain_chat_history, context, retrieved_context):
+            ai_msg += content
+            yield content
 
         if not traceless:
-            await _add_message_to_chat_history(username, "AI", ai_msg)
+            _add_messages_to_chat_history(username, [("AI", ai_msg)], db_session)
+            chathistory.set_turn_context(username, ai_msg, retrieved_context)
+
+async def _get_answer_cache_key(db_session, username, user_msg, chat_history):
+    # (question vector, version) when the answer can be served from and kept in the answer cache: kb-only users
+    # without chat history, whose question goes to retrieval unchanged. The question is embedded the way the kb
+    # retriever embeds its search queries, on a miss retrieval finds the vectors in the embedding cache
+    if not settings.ANSWER_CACHE_ENABLED or len(chat_history) > 0:
+        return None
+    with telemetry.stage("answer_cache_lookup"):
+        version = langchain.get_kb_answer_version(db_session, username)
+        if version is None:
+            return None
+        query_vectors = await cached_embeddings.aembed_documents([user_msg])
+        return normalize_rows(query_vectors[0]), version
+
+async def _stream_cached_answer(cached_answer, retrieved_context):
+    answer, context, similarity = cached_answer
+    # the context of the cached turn backs the follow-up modes of this one
+    retrieved_context.update(context)
+    logger.info(f"Chat response served from the answer cache | similarity: {similarity:.4f}")
+    # word by word like an llm stream, the sse framing coalesces the pieces
+    for piece in re.split(r"(?<=\s)(?=\S)", answer):
+        yield piece
+    telemetry.finish_turn(_count_answer_tokens(answer), outcome="cached")
+
+def _get_answer_chain(db_session, username, context, provider):
+    if context:
+        return langchain.construct_context_answer_chain(username, get_chat_llm(provider, "primary"), has_user_docs="user_scenario" in context)
+    return langchain.get_qa_chain(db_session, username, get_chat_llm(provider, "primary"), get_chat_llm(provider, "secondary"), provider)
+
+async def _stream_answer(db_session, user: User, user_msg, chat_history, context, retrieved_context):
+    # the router picks (and if needed fails over or hedges) the provider,
+    # the chains stream the retrieved context ahead of the answer, it is collected into retrieved_context
+    context_at = None
+
+    async def timed_stream(stream):
+        # the router holds back the context chunks until the first answer token, note when the last one was produced
+        nonlocal context_at
+        try:
+            async for chunk in stream:
+                if any(key in chunk for key in langchain.CONTEXT_KEYS):
+                    context_at = time.monotonic()
+                yield chunk
+        finally:
+            # closing the wrapper closes the chain stream right away, like the router does for unwrapped streams
+            await stream.aclose()
+
+    def make_stream(provider):
+        chain = _get_answer_chain(db_session, user.email, context, provider)
+        return timed_stream(_stream_response(chain=chain, user_msg=user_msg, chat_history=chat_history, context=context))
 
-async def _get_zep_session_id_by_username(username):
-    user_all_sessions = await getzep.get_all_sessions_of_user(username)
-    if len(user_all_sessions) == 0:
+    demand = _estimate_token_demand(user_msg, chat_history, context)
+    priority = PRIORITY_FREE if user.plan == Plan.free else PRIORITY_PAID
+    started_at = time.monotonic()
+    first_token_at = None
+    answer = ""
+    try:
+        async for chunk in ProviderRouter.astream(make_stream, is_token=lambda chunk: "answer" in chunk, demand=demand, priority=priority):
+            if "answer" in chunk:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                    telemetry.record_stage("time_to_first_token", (first_token_at - started_at) * 1000)
+                    # time the primary llm took to start answering once the context was there
+                    telemetry.record_stage("llm_first_token", (first_token_at - (context_at or started_at)) * 1000)
+                answer += chunk["answer"]
+                yield chunk["answer"]
+            else:
+                retrieved_context.update({key: value for key, value in chunk.items() if key in langchain.CONTEXT_KEYS})
+    except (asyncio.CancelledError, GeneratorExit):
+        # the client went away, starlette cancels the response stream and with it the llm calls and retrieval,
+        # the turn is never handed to the zep writer
+        _record_cancelled_answer(answer, started_at, first_token_at, bool(retrieved_context))
+        raise
+    except Exception:
+        telemetry.finish_turn(_count_answer_tokens(answer), first_token_at, outcome="failed")
+        raise
+    telemetry.finish_turn(_count_answer_tokens(answer), first_token_at)
+
+def _count_answer_tokens(answer):
+    return tokens.count_tokens(answer, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME) if answer else 0
+
+def _record_cancelled_answer(partial_answer, started_at, first_token_at, retrieval_done):
+    elapsed = time.monotonic() - started_at
+    answer_tokens = _count_answer_tokens(partial_answer)
+    stage = "answer" if partial_answer else "retrieval" if not retrieval_done else "first_token"
+    _cancelled_answers.add(1, {"stage": stage})
+    _cancelled_answer_tokens.record(answer_tokens, {"stage": stage})
+    telemetry.finish_turn(answer_tokens, first_token_at, outcome="cancelled")
+    logger.info(f"Chat response cancelled by client | stage: {stage} | partial answer tokens: {answer_tokens} | elapsed: {elapsed:.2f}s")
+
+def _estimate_token_demand(user_msg, chat_history, context):
+    # (model role, tokens) for the quota scheduler, retrieved context and completion are not known upfront
+    conversation_tokens = sum(tokens.count_tokens(message.content, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME) for message in chat_history)\
+        + tokens.count_tokens(user_msg, settings.OPENAI_CHAT_PRIMARY_MODEL_NAME)
+    primary_tokens = conversation_tokens + settings.LLM_CONTEXT_TOKEN_ESTIMATE + settings.LLM_COMPLETION_TOKEN_ESTIMATE
+    if context or len(chat_history) == 0:
+        # no query rewrite, the secondary model is not called
+        return [("primary", primary_tokens)]
+    return [("primary", primary_tokens), ("secondary", conversation_tokens + 100)]
+
+async def _get_user_message_count(user: User, db_session):
+    if user.message_count is not None:
+        return user.message_count
+
+    # accounts created before the counter existed are backfilled once from their zep history
+    zep_chat_history = await get_chat_history(user.email, db_session, user.chat_history_version)
+    user.message_count = sum(1 for message in zep_chat_history if message.role == "User")
+    db_session.add(user)
+    db_session.commit()
+    return user.message_count
+
+def _increment_user_message_count(user: User, db_session):
+    # atomic increment in the database, rows still waiting for the backfill are left NULL
+    db_session.query(User)\
+        .filter(User.id == user.id, User.message_count.isnot(None))\
+        .update({User.message_count: User.message_count + 1}, synchronize_session=False)
+    db_session.commit()
+
+def _reset_user_message_count(username, db_session):
+    db_session.query(User)\
+        .filter(User.email == username, User.message_count.isnot(None))\
+        .update({User.message_count: 0}, synchronize_session=False)
+    db_session.commit()
+
+async def _get_zep_session_id_by_username(username, version=None):
+    session_id = await getzep.get_session_id_of_user(username, version)
+    if session_id is None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No Zep session found")
-    session_id = user_all_sessions[0].session_id
     return session_id
 
-async def _add_message_to_chat_history(username, role, msg_content):
-    session_id = await _get_zep_session_id_by_username(username)
-    await getzep.add_message_to_session(session_id, role, msg_content)
+def _get_chat_history_version(username, db_session):
+    return db_session.query(User.chat_history_version).filter(User.email == username).scalar()
 
-async def get_chat_history(username):
-    session_id = await _get_zep_session_id_by_username(username)
-    return await getzep.get_all_messages_by_session(session_id)
-
-async def get_suggested_questions(username):
-
-    def strip_suggested_questions(question):
-        question = re.sub(r'^[^a-zA-Z]+', '', question)
-        question = re.sub(r'\?.*', '?', question)
-        return question
-    
-    chat_history = await get_chat_history(username)
-    chain = langchain.get_suggested_questions_chain(username, OpenAIManager.CHAT_PRIMARY)
-    response = chain.invoke({"chat_history": getzep.convert_zep_messages_to_langchain(chat_history[-4:])})
-    suggested_questions = response.split('\n')
-    suggested_questions = [strip_suggested_questions(suggested_question) for suggested_question in suggested_questions]
-    return suggested_questions
-
-async def clear_chat_history(username):
+def _bump_chat_history_version(username, db_session):
+    # atomic increment, updated_at is left alone as it keys the user's password reset tokens
+    db_session.query(User)\
+        .filter(User.email == username)\
+        .update({User.chat_history_version: User.chat_history_version + 1, User.updated_at: User.updated_at}, synchronize_session=False)
+    db_session.commit()
+    return _get_chat_history_version(username, db_session)
+
+def _add_messages_to_chat_history(username, messages, db_session):
+    # messages: list of (role, content), saved to zep in one call by the write-behind queue
+    ChatTurnWriter.enqueue(username, messages)
+    version = _bump_chat_history_version(username, db_session)
+    chathistory.append_cached_history(username, version, messages)
+    getzep.update_session_id_version(username, version)
+    # suggested questions for the new history are ready by the time the client asks for them
+    chat_history = chathistory.get_cached_history(username, version)
+    if chat_history:
+        suggestions.schedule_refresh(username, chat_history)
+
+async def get_chat_history(username, db_session, version=None):
+    if version is None:
+        version = _get_chat_history_version(username, db_session)
+    messages = chathistory.get_cached_history(username, version)
+    if messages is None:
+        session_id = await _get_zep_session_id_by_username(username, version)
+        messages = await getzep.get_all_messages_by_session(session_id)
+        # turns accepted by the write-behind queue but not saved to zep yet
+        messages = messages + ChatTurnWriter.pending_messages(username)
+        chathistory.set_cached_history(username, version, messages)
+    return messages
+
+async def get_suggested_questions(username, db_session):
+    chat_history = await get_chat_history(username, db_session)
+    return await suggestions.get_suggested_questions(username, chat_history)
+
+async def clear_chat_history(username, db_session):
+    chathistory.evict_history_summary(username)
+    chathistory.evict_cached_history(username)
+    chathistory.evict_turn_contexts(username)
+    suggestions.evict_suggested_questions(username)
+    ChatTurnWriter.discard_pending(username)
+    # resolve from zep, another worker may have replaced the session since it was cached here
+    getzep.evict_session_id_of_user(username)
     session_id = await _get_zep_session_id_by_username(username)
     try:
         await getzep.delete_session(session_id)
-        await getzep.add_session(user_id=username, sessionid=uuid.uuid4().hex)
+        version = _bump_chat_history_version(username, db_session)
+        await getzep.add_session(user_id=username, sessionid=uuid.uuid4().hex, version=version)
+        chathistory.set_cached_history(username, version, [])
+        # free plan quota counts the messages of the current chat session
+        _reset_user_message_count(username, db_session)
     except Exception as ex:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Error occured while clearing chat history: {ex}")
 
-@backoff.on_exception(backoff.expo, openai.RateLimitError, max_time=10, jitter=backoff.random_jitter, logger=logger)
-async def _stream_response(chain, user_msg, chat_history):
-    async for chunk in chain.astream({"input": user_msg, "chat_history": chat_history}):
+async def _stream_response(chain, user_msg, chat_history, context=None):
+    async for chunk in chain.astream({"input": user_msg, "chat_history": chat_history, **(context or {})}):
         yield chunk
\ No newline at end of file
@@ -5,7 +5,7 @@ from fastapi import HTTPException, status
 from app.common.settings import get_settings
 from app.models.user import UserDocument, User, Plan, Role
 from app.schemas.responses.user_document import FileInfo, GdriveUploadResponse, DeleteDocumentsResponse, DocumentsListResponse, ValidateDocumentsResponse, FileExists
-from app.common import gdrive, azurecloud
+from app.common import gdrive, azurecloud, docscope, langchain
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import case, desc, func
 
@@ -202,14 +202,22 @@ async def enqueue_file_deletions(username, file_names: List[str], session: Sessi
             # error logging can be made more descriptive using status
             failed_files.append(FileInfo(filename=file_name, error="File does not exists"))
 
+    # files marked for deletion must stop being retrieved on the next chat turn
+    if len(existing_file_names) > 0:
+        langchain.invalidate_user_qa_chains(username)
+        # with flag scoped retrieval the status alone doesn't keep the files out of the answers
+        docscope.set_consumer_documents_active(username, existing_file_names, False)
+
     messages_to_enqueue = []
     for batch in _chunk_data(existing_file_names, size=256):
         message_body = json.dumps({"user_name": username, "file_names": batch})
         messages_to_enqueue.append(message_body)
     failed_messages = await azurecloud.send_messages_to_queue(settings.AZURE_STORAGE_CONSUMER_FILE_DELETE_QUEUE_NAME, messages_to_enqueue)
     
+    reverted_file_names = []
     for msg, error in failed_messages:
         failed_file_names = json.loads(msg)["file_names"]
+        reverted_file_names.extend(failed_file_names)
         for failed_file_name in failed_file_names:
             failed_files.append(FileInfo(filename=failed_file_name, error=error))
             # revert status to completed for failed files
@@ -221,6 +229,9 @@ async def enqueue_file_deletions(username, file_names: List[str], session: Sessi
             session.add(user_doc)
             session.commit()
 
+    if len(reverted_file_names) > 0:
+        docscope.set_consumer_documents_active(username, reverted_file_names, True)
+
     return DeleteDocumentsResponse(failed_files=failed_files)
 
 def _chunk_data(list, size):
@@ -0,0 +1,60 @@
+# One-off migration of the pinecone indexes for RETRIEVAL_DOC_SCOPE="active_flag" (see app.common.docscope):
+# sets the "active" flag on every knowledge base vector from its document's status and copies the consumer vectors
+# from the default namespace into one namespace per user, with the flag. Run it before switching the setting,
+# the ingestion and delete workers must already write the new layout so nothing is missed in between.
+# Usage: python -m app.utils.backfill_doc_scope [--skip-kb] [--skip-consumer] [--delete-source]
+import argparse
+import logging
+from app.common.database import SessionLocal
+from app.common.docscope import consumer_file_name, consumer_namespace, find_document_vectors, set_vectors_active
+from app.common.settings import get_settings
+from app.common.vectorstore import VectorStoreRegistry
+from app.models.user import KnowledgeBaseDocument, UserDocument
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def backfill_kb(session):
+    index = VectorStoreRegistry.get_index(settings.PINECONE_KNOWLEDGE_BASE_INDEX)
+    for doc in session.query(KnowledgeBaseDocument.document_name, KnowledgeBaseDocument.status).all():
+        updated = set_vectors_active(index, None, doc.document_name, doc.status == "Completed")
+        logger.info(f"Knowledge base document flagged | file_name: {doc.document_name} | active: {doc.status == 'Completed'} | vectors: {updated}")
+
+def backfill_consumer(session, delete_source):
+    index = VectorStoreRegistry.get_index(settings.PINECONE_CONSUMER_INDEX)
+    for doc in session.query(UserDocument.user_id, UserDocument.document_name, UserDocument.status).all():
+        file_name = consumer_file_name(doc.user_id, doc.document_name)
+        matches = find_document_vectors(index, None, file_name)
+        vectors = [{"id": match["id"], "values": match["values"], "metadata": {**match["metadata"], "active": doc.status == "Completed"}}
+                   for match in matches]
+        for batch in _batches(vectors, UPSERT_BATCH_SIZE):
+            index.upsert(vectors=batch, namespace=consumer_namespace(doc.user_id))
+        if delete_source:
+            for batch in _batches([match["id"] for match in matches], DELETE_BATCH_SIZE):
+                index.delete(ids=batch)
+        logger.info(f"Consumer document moved | file_name: {file_name} | vectors: {len(vectors)} | source deleted: {delete_source}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--skip-kb", action="store_true")
+    parser.add_argument("--skip-consumer", action="store_true")
+    parser.add_argument("--delete-source", action="store_true", help="delete the consumer vectors from the default namespace once copied")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        if not args.skip_kb:
+            backfill_kb(session)
+        if not args.skip_consumer:
+            backfill_consumer(session, args.delete_source)
+    finally:
+        session.close()
@@ -0,0 +1,35 @@
+# Builds the local knowledge base indexes (see app.common.kbindex) from pinecone, so the api starts with every
+# completed document local instead of syncing them one by one after the first chat turn.
+# Rerun it with --rebuild to fetch every document again, e.g. after changing KB_LOCAL_INDEX_DTYPE or KB_LOCAL_INDEX_NLIST.
+# Usage: python -m app.utils.build_kb_indexes [--rebuild]
+import argparse
+import logging
+from app.common.database import SessionLocal
+from app.common import kbindex
+from app.common.settings import get_settings
+from app.models.user import KnowledgeBaseDocument
+
+logger = logging.getLogger(__name__)
+
+settings = get_settings()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true", help="ignore what is on disk and fetch every document again")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if kbindex.kb_local_index is None and kbindex.kb_lexical_index is None:
+        raise SystemExit("Neither KB_LOCAL_INDEX_DIR nor KB_LEXICAL_INDEX_DIR is set")
+
+    session = SessionLocal()
+    try:
+        kb_docs = session.query(KnowledgeBaseDocument.document_name, KnowledgeBaseDocument.id, KnowledgeBaseDocument.updated_at)\
+            .filter_by(status="Completed").all()
+    finally:
+        session.close()
+    # the keys the api syncs to, so it starts without fetching any of them again
+    document_keys = frozenset(kbindex.kb_document_key(kb_doc.document_name, kb_doc.id, kb_doc.updated_at) for kb_doc in kb_docs)
+
+    kbindex.build_kb_indexes(document_keys, rebuild=args.rebuild)
+    logger.info(f"Knowledge base indexes built | {kbindex.get_kb_index_stats()}")
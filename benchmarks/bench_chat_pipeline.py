@@ -0,0 +1,272 @@
+# Chat pipeline benchmark: get_qa_chain and get_ai_response end to end against the offline fakes in benchmarks.fakes
+# (OpenAI / Azure chat models, embeddings, Pinecone, Zep, sqlite) with configurable latencies.
+# Reports time to first token, total latency, throughput and cpu per turn for every combination of history length,
+# knowledge base size and concurrency. Cpu time and allocations per stage are only attributable when turns do not
+# overlap, they are measured in the concurrency 1 runs. Allocations are traced with tracemalloc, which slows the
+# traced runs down considerably, so it is opt-in (--trace-allocations).
+# Usage: python -m benchmarks.bench_chat_pipeline [--history 0,10,50] [--docs 10,100,1000] [--concurrency 1,8,32]
+#                                                 [--requests 16] [--trace-allocations] [--output results.json]
+#                                                 [--kb-local-index float32|int8] [--kb-local-nlist 0] [--kb-lexical-index]
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+fakes.disable_zep_healthcheck()
+
+from app.common import docscope, kbindex, langchain, telemetry
+from app.common.bm25 import BM25Index
+from app.common.openai import OpenAIManager
+from app.common.settings import get_settings
+from app.models.user import KnowledgeBaseDocument, Plan, Role, User
+from app.schemas.requests.user_chat import Mode
+from app.services import user_chat
+
+settings = get_settings()
+
+# runs are offline, the .env of a developer machine may still enable langsmith tracing
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+QUESTION = "Can my landlord keep the deposit for cleaning after I moved out?"
+
+_user_ids = itertools.count()
+_stage_costs = None
+_telemetry_stage = telemetry.stage
+
+@contextmanager
+def _costed_stage(name, **attributes):
+    # telemetry.stage plus the cpu time (and peak traced memory while tracing) of the stage, while _stage_costs is set
+    if _stage_costs is None:
+        with _telemetry_stage(name, **attributes):
+            yield
+        return
+    tracing = tracemalloc.is_tracing()
+    cpu_at = time.process_time()
+    if tracing:
+        memory_at, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+    try:
+        with _telemetry_stage(name, **attributes):
+            yield
+    finally:
+        cost = _stage_costs.setdefault(name, {"cpu_ms": 0.0, "peak_kb": None})
+        cost["cpu_ms"] += (time.process_time() - cpu_at) * 1000
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            cost["peak_kb"] = max(cost["peak_kb"] or 0.0, (peak - memory_at) / 1024)
+
+telemetry.stage = _costed_stage
+
+def _percentiles(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+def _add_user(session):
+    user = User(name="Bench", email=f"bench-{next(_user_ids)}@example.com", password="x", is_active=True,
+                role=Role.User, plan=Plan.one_month, paid=True, message_count=0)
+    session.add(user)
+    session.commit()
+    return user
+
+async def _drain():
+    # zep writes and suggested question refreshes of the previous turns must not overlap the next scenario
+    pending = asyncio.all_tasks() - {asyncio.current_task()}
+    await asyncio.gather(*pending, return_exceptions=True)
+
+def _bench_qa_chain(session_factory, repeat):
+    session = session_factory()
+    user = _add_user(session)
+    langchain.invalidate_all_qa_chains()
+    tracemalloc.start()
+    cpu_at = time.process_time()
+    started_at = time.perf_counter()
+    langchain.get_qa_chain(session, user.email, OpenAIManager.CHAT_PRIMARY, OpenAIManager.CHAT_SECONDARY, "openai")
+    cold_ms = (time.perf_counter() - started_at) * 1000
+    cold_cpu_ms = (time.process_time() - cpu_at) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        langchain.get_qa_chain(session, user.email, OpenAIManager.CHAT_PRIMARY, OpenAIManager.CHAT_SECONDARY, "openai")
+    warm_ms = (time.perf_counter() - started_at) * 1000 / repeat
+    session.close()
+    return {"cold_ms": round(cold_ms, 2), "cold_cpu_ms": round(cold_cpu_ms, 2), "cold_peak_kb": round(peak / 1024, 1), "warm_ms": round(warm_ms, 3)}
+
+async def _bench_turns(session_factory, concurrency, requests, trace_allocations):
+    global _stage_costs
+    semaphore = asyncio.Semaphore(concurrency)
+    ttfts, totals = [], []
+
+    async def turn(i):
+        async with semaphore:
+            session = session_factory()
+            user = _add_user(session)
+            started_at = time.perf_counter()
+            first_token_at = None
+            async for _ in user_chat.get_ai_response(user, session, f"{QUESTION} ({i})", traceless=False, mode=Mode.NA):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+            totals.append((time.perf_counter() - started_at) * 1000)
+            ttfts.append((first_token_at - started_at) * 1000)
+            session.close()
+
+    if concurrency == 1:
+        _stage_costs = {}
+    traced = concurrency == 1 and trace_allocations
+    if traced:
+        tracemalloc.start()
+    cpu_at = time.process_time()
+    started_at = time.perf_counter()
+    await asyncio.gather(*[turn(i) for i in range(requests)])
+    elapsed = time.perf_counter() - started_at
+    cpu_ms = (time.process_time() - cpu_at) * 1000
+    peak_kb = None
+    if traced:
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    stage_costs, _stage_costs = _stage_costs, None
+    await _drain()
+
+    stage_durations = {}
+    for recent in telemetry.get_recent_turns(limit=requests):
+        for name, duration in recent["stages_ms"].items():
+            stage_durations.setdefault(name, []).append(duration)
+    stages = {}
+    for name, durations in sorted(stage_durations.items()):
+        stages[name] = {"p50_ms": _percentiles(durations)["p50"]}
+        if stage_costs is not None and name in stage_costs:
+            stages[name]["cpu_ms_per_turn"] = round(stage_costs[name]["cpu_ms"] / requests, 2)
+            if stage_costs[name]["peak_kb"] is not None:
+                stages[name]["peak_kb"] = round(stage_costs[name]["peak_kb"], 1)
+
+    return {
+        "ttft_ms": _percentiles(ttfts),
+        "total_ms": _percentiles(totals),
+        "turns_per_second": round(requests / elapsed, 2),
+        "cpu_ms_per_turn": round(cpu_ms / requests, 2),
+        "peak_kb": round(peak_kb, 1) if peak_kb is not None else None,
+        "stages": stages,
+    }
+
+async def _run(args):
+    results = {"config": vars(args), "qa_chain": [], "scenarios": []}
+    llm_config = {"ttft": args.llm_ttft, "token_interval": args.token_interval, "answer_tokens": args.answer_tokens}
+    azure_llm_config = {**llm_config, "ttft": args.azure_ttft if args.azure_ttft is not None else args.llm_ttft}
+
+    print(f"{'docs':>5} {'qa chain cold ms':>16} {'cold cpu ms':>11} {'cold peak KB':>12} {'warm ms':>8}")
+    for docs in args.docs:
+        session_factory = fakes.create_session_factory()
+        session = session_factory()
+        file_names = fakes.add_knowledge_base_documents(session, docs)
+        session.close()
+        indexes = {
+            settings.PINECONE_KNOWLEDGE_BASE_INDEX: fakes.FakePineconeIndex(file_names, args.chunks_per_doc, args.dim, args.pinecone_latency),
+            settings.PINECONE_CONSUMER_INDEX: fakes.FakePineconeIndex([], args.chunks_per_doc, args.dim, args.pinecone_latency),
+        }
+        zep = fakes.install(llm_config, azure_llm_config, fakes.FakeEmbeddings(args.dim, args.embedding_latency), indexes, fakes.FakeZep(latency=args.zep_latency))
+        if args.kb_local_index:
+            kbindex.kb_local_index = _build_kb_local_index(args, indexes[settings.PINECONE_KNOWLEDGE_BASE_INDEX], _kb_document_keys(session_factory))
+        if args.kb_lexical_index:
+            kbindex.kb_lexical_index = _build_kb_lexical_index(indexes[settings.PINECONE_KNOWLEDGE_BASE_INDEX], _kb_document_keys(session_factory))
+
+        qa_chain = _bench_qa_chain(session_factory, args.repeat)
+        results["qa_chain"].append({"docs": docs, **qa_chain})
+        print(f"{docs:>5} {qa_chain['cold_ms']:>16.2f} {qa_chain['cold_cpu_ms']:>11.2f} {qa_chain['cold_peak_kb']:>12.1f} {qa_chain['warm_ms']:>8.3f}")
+
+        for history_length in args.history:
+            zep.history_length = history_length
+            for concurrency in args.concurrency:
+                scenario = await _bench_turns(session_factory, concurrency, args.requests, args.trace_allocations)
+                results["scenarios"].append({"docs": docs, "history": history_length, "concurrency": concurrency, **scenario})
+
+    print()
+    print(f"{'history':>7} {'docs':>5} {'conc':>4} {'ttft p50':>8} {'ttft p95':>8} {'total p50':>9} {'total p95':>9} {'turns/s':>7} {'cpu ms/turn':>11} {'peak KB':>8}")
+    for scenario in results["scenarios"]:
+        peak_kb = f"{scenario['peak_kb']:.0f}" if scenario["peak_kb"] is not None else "-"
+        print(f"{scenario['history']:>7} {scenario['docs']:>5} {scenario['concurrency']:>4} "
+              f"{scenario['ttft_ms']['p50']:>8.1f} {scenario['ttft_ms']['p95']:>8.1f} "
+              f"{scenario['total_ms']['p50']:>9.1f} {scenario['total_ms']['p95']:>9.1f} "
+              f"{scenario['turns_per_second']:>7.2f} {scenario['cpu_ms_per_turn']:>11.2f} {peak_kb:>8}")
+
+    for scenario in results["scenarios"]:
+        if scenario["concurrency"] != 1:
+            continue
+        print()
+        print(f"stages | history {scenario['history']} | docs {scenario['docs']}")
+        print(f"{'stage':>28} {'p50 ms':>8} {'cpu ms/turn':>11} {'peak KB':>8}")
+        for name, stage in scenario["stages"].items():
+            cpu_ms = f"{stage['cpu_ms_per_turn']:.2f}" if "cpu_ms_per_turn" in stage else "-"
+            peak_kb = f"{stage['peak_kb']:.0f}" if "peak_kb" in stage else "-"
+            print(f"{name:>28} {stage['p50_ms']:>8.1f} {cpu_ms:>11} {peak_kb:>8}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nresults written to {args.output}")
+
+def _kb_document_keys(session_factory):
+    # the keys the kb retriever syncs the indexes to
+    session = session_factory()
+    try:
+        return frozenset(kbindex.kb_document_key(doc.document_name, doc.id, doc.updated_at)
+                         for doc in session.query(KnowledgeBaseDocument).filter_by(status="Completed"))
+    finally:
+        session.close()
+
+def _build_kb_local_index(args, pinecone_index, document_keys):
+    # synced up front, the retriever would otherwise go to the fake pinecone until the background sync is done
+    local_index = kbindex.LocalVectorIndex(tempfile.mkdtemp(prefix="kb-local-index-"), args.kb_local_index, args.kb_local_nlist)
+    local_index.load()
+    latency, pinecone_index.latency = pinecone_index.latency, 0
+    local_index.sync(document_keys, lambda document_key: docscope.find_document_vectors(pinecone_index, None, document_key.rsplit("@", 1)[0]))
+    pinecone_index.latency = latency
+    return local_index
+
+def _build_kb_lexical_index(pinecone_index, document_keys):
+    lexical_index = BM25Index(tempfile.mkdtemp(prefix="kb-lexical-index-"))
+    lexical_index.load()
+    latency, pinecone_index.latency = pinecone_index.latency, 0
+    lexical_index.sync(document_keys, lambda document_key: docscope.find_document_vectors(pinecone_index, None, document_key.rsplit("@", 1)[0]))
+    pinecone_index.latency = latency
+    return lexical_index
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+def run(args):
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=_int_list, default=[0, 10, 50], help="zep messages per user")
+    parser.add_argument("--docs", type=_int_list, default=[10, 100, 1000], help="completed knowledge base documents")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=16, help="chat turns per scenario")
+    parser.add_argument("--repeat", type=int, default=100, help="cached get_qa_chain lookups")
+    parser.add_argument("--chunks-per-doc", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--llm-ttft", type=float, default=0.4, help="seconds to the first token (openai)")
+    parser.add_argument("--azure-ttft", type=float, default=None, help="seconds to the first token (azure), defaults to --llm-ttft")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between tokens")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--pinecone-latency", type=float, default=0.08)
+    parser.add_argument("--zep-latency", type=float, default=0.05)
+    parser.add_argument("--kb-local-index", choices=["float32", "int8"], default=None, help="search the knowledge base in process")
+    parser.add_argument("--kb-local-nlist", type=int, default=0, help="inverted lists of the local index, 0 is exhaustive")
+    parser.add_argument("--kb-lexical-index", action="store_true", help="fuse bm25 results into the knowledge base search")
+    parser.add_argument("--trace-allocations", action="store_true", help="trace allocations in the concurrency 1 runs")
+    parser.add_argument("--output", default=None, help="write the results as json")
+    run(parser.parse_args())
@@ -0,0 +1,291 @@
+# HTTP load test: drives the FastAPI app in-process (ASGI, no server or sockets) at configurable concurrency with
+# the external services replaced by the fakes in benchmarks.fakes and a sqlite database in a temporary directory.
+# Covers /auth/token, /users/me, /users/chat/send-msg (streamed, time to first byte included) and /users/documents/list,
+# and reports p50/p95/p99 latency, throughput and event loop lag per endpoint and concurrency level.
+# Results are written as json; with --baseline a previous run is compared and regressions beyond --tolerance
+# (p95 latency up or throughput down) make the run exit with status 1.
+# Usage: python -m benchmarks.bench_load [--concurrency 1,16,64] [--requests 200] [--output load.json] [--baseline old.json]
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+fakes.disable_zep_healthcheck()
+
+from app.main import app
+from app.common.database import get_session
+from app.common.email import fm
+from app.common.security import create_access_token, hash_password
+from app.common.settings import get_settings
+from app.models.user import Plan, Role, User, UserDocument
+
+settings = get_settings()
+
+# runs are offline, the .env of a developer machine may still enable langsmith tracing
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+ENDPOINTS = ("auth_token", "users_me", "documents_list", "chat_send_msg")
+USER_PASSWORD = "LoadTest@123"
+LOOP_LAG_INTERVAL = 0.01
+
+def _percentiles(values):
+    if len(values) == 0:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+# Sends one request straight into the ASGI app, returns (status, body, seconds to the first body byte, total seconds)
+async def _call(method, path, headers=None, body=b""):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("loadtest", 80),
+    }
+    request_sent = False
+    response_complete = asyncio.Event()
+    status = None
+    chunks = []
+    first_byte_at = None
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # the client stays connected until the whole response is read
+        await response_complete.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, first_byte_at
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            if message.get("body"):
+                if first_byte_at is None:
+                    first_byte_at = time.perf_counter()
+                chunks.append(message["body"])
+            if not message.get("more_body", False):
+                response_complete.set()
+
+    started_at = time.perf_counter()
+    await app(scope, receive, send)
+    finished_at = time.perf_counter()
+    return status, b"".join(chunks), (first_byte_at or finished_at) - started_at, finished_at - started_at
+
+def _request(endpoint, user, i):
+    # (method, path, headers, body) of the i-th request of an endpoint
+    auth = {"Authorization": f"Bearer {user['access_token']}"}
+    if endpoint == "auth_token":
+        body = urlencode({"username": user["email"], "password": USER_PASSWORD}).encode()
+        return "POST", "/auth/token", {"Content-Type": "application/x-www-form-urlencoded"}, body
+    if endpoint == "users_me":
+        return "GET", "/users/me", auth, b""
+    if endpoint == "documents_list":
+        return "GET", "/users/documents/list", auth, b""
+    body = json.dumps({"user_msg": f"Can my landlord keep the deposit for cleaning? ({i})", "traceless": False, "mode": 0}).encode()
+    return "POST", "/users/chat/send-msg", {**auth, "Content-Type": "application/json"}, body
+
+def _is_error(endpoint, status, body):
+    # a streamed answer starts with 200, failures after that arrive as an sse error event
+    return status != 200 or (endpoint == "chat_send_msg" and b"event: error" in body)
+
+async def _measure_loop_lag(samples):
+    # how late a short sleep wakes up is how long the loop was blocked by something else
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.append((time.perf_counter() - started_at - LOOP_LAG_INTERVAL) * 1000)
+
+async def _run_scenario(endpoint, users, concurrency, requests, warmup):
+    # untimed requests first, the first calls of an endpoint pay for imports and cold caches
+    for i in range(warmup):
+        await _call(*_request(endpoint, users[i % len(users)], -i - 1))
+
+    latencies, first_bytes = [], []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal errors, next_request
+        while next_request < requests:
+            i = next_request
+            next_request += 1
+            status, body, first_byte, total = await _call(*_request(endpoint, users[i % len(users)], i))
+            if _is_error(endpoint, status, body):
+                errors += 1
+            latencies.append(total * 1000)
+            first_bytes.append(first_byte * 1000)
+
+    lag_samples = []
+    lag_task = asyncio.create_task(_measure_loop_lag(lag_samples))
+    cpu_at = time.process_time()
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started_at
+    cpu_ms = (time.process_time() - cpu_at) * 1000
+    lag_task.cancel()
+    await asyncio.gather(lag_task, return_exceptions=True)
+
+    loop_lag = _percentiles(lag_samples)
+    if loop_lag is not None:
+        loop_lag["max"] = round(max(lag_samples), 1)
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "latency_ms": _percentiles(latencies),
+        "first_byte_ms": _percentiles(first_bytes) if endpoint == "chat_send_msg" else None,
+        "throughput_rps": round(requests / elapsed, 2),
+        "cpu_ms_per_request": round(cpu_ms / requests, 2),
+        "loop_lag_ms": loop_lag,
+    }
+
+def _seed(session_factory, args):
+    session = session_factory()
+    kb_file_names = fakes.add_knowledge_base_documents(session, args.kb_docs)
+    # one bcrypt hash for every user, hashing is what /auth/token measures, not the setup
+    password = hash_password(USER_PASSWORD)
+    users, consumer_file_names = [], []
+    for i in range(args.users):
+        email = f"load-{i}@example.com"
+        session.add(User(name="Load", email=email, password=password, is_active=True, role=Role.User,
+                         plan=Plan.one_month, paid=True, message_count=0, verified_at=datetime.now(timezone.utc)))
+        for j in range(args.user_docs):
+            session.add(UserDocument(user_id=email, document_name=f"lease-{j}.pdf", content_type="application/pdf", status="Completed"))
+            consumer_file_names.append(f"{email}:lease-{j}.pdf")
+        access_token = create_access_token(data={"sub": email}, expires_delta=timedelta(hours=1))
+        users.append({"email": email, "access_token": access_token})
+    session.commit()
+    session.close()
+    return users, kb_file_names, consumer_file_names
+
+def _compare(results, baseline, tolerance):
+    # p95 latency and throughput per endpoint and concurrency against the baseline run
+    previous = {(result["endpoint"], result["concurrency"]): result for result in baseline["results"]}
+    regressions = []
+    print()
+    print(f"{'endpoint':>15} {'conc':>4} {'p95 ms':>9} {'baseline':>9} {'change':>7} {'rps':>8} {'baseline':>9} {'change':>7}")
+    for result in results:
+        old = previous.get((result["endpoint"], result["concurrency"]))
+        if old is None:
+            continue
+        p95_change = result["latency_ms"]["p95"] / max(old["latency_ms"]["p95"], 0.1) - 1
+        rps_change = result["throughput_rps"] / max(old["throughput_rps"], 0.01) - 1
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        if regressed:
+            regressions.append(result)
+        print(f"{result['endpoint']:>15} {result['concurrency']:>4} {result['latency_ms']['p95']:>9.1f} {old['latency_ms']['p95']:>9.1f} {p95_change:>+7.0%} "
+              f"{result['throughput_rps']:>8.2f} {old['throughput_rps']:>9.2f} {rps_change:>+7.0%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+async def _run(args, session_factory):
+    users, kb_file_names, consumer_file_names = _seed(session_factory, args)
+    llm_config = {"ttft": args.llm_ttft, "token_interval": args.token_interval, "answer_tokens": args.answer_tokens}
+    indexes = {
+        settings.PINECONE_KNOWLEDGE_BASE_INDEX: fakes.FakePineconeIndex(kb_file_names, args.chunks_per_doc, args.dim, args.pinecone_latency),
+        settings.PINECONE_CONSUMER_INDEX: fakes.FakePineconeIndex(consumer_file_names, args.chunks_per_doc, args.dim, args.pinecone_latency),
+    }
+    fakes.install(llm_config, embeddings=fakes.FakeEmbeddings(args.dim, args.embedding_latency), indexes=indexes,
+                  zep=fakes.FakeZep(args.history, args.zep_latency))
+
+    def _session():
+        session = session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    app.dependency_overrides[get_session] = _session
+    fm.config.SUPPRESS_SEND = 1
+
+    results = []
+    await app.router.startup()
+    try:
+        for endpoint in args.endpoints:
+            for concurrency in args.concurrency:
+                requests = args.chat_requests if endpoint == "chat_send_msg" else args.requests
+                results.append(await _run_scenario(endpoint, users, concurrency, requests, args.warmup))
+    finally:
+        await app.router.shutdown()
+        app.dependency_overrides.pop(get_session, None)
+    return results
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        session_factory = fakes.create_session_factory(os.path.join(directory, "loadtest.db"))
+        results = asyncio.run(_run(args, session_factory))
+
+    print(f"{'endpoint':>15} {'conc':>4} {'req':>5} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttfb p50':>8} {'rps':>8} {'cpu ms/req':>10} {'lag p95':>7} {'lag max':>7}")
+    for result in results:
+        ttfb = f"{result['first_byte_ms']['p50']:.1f}" if result["first_byte_ms"] else "-"
+        lag = result["loop_lag_ms"] or {"p95": 0.0, "max": 0.0}
+        print(f"{result['endpoint']:>15} {result['concurrency']:>4} {result['requests']:>5} {result['errors']:>4} "
+              f"{result['latency_ms']['p50']:>8.1f} {result['latency_ms']['p95']:>8.1f} {result['latency_ms']['p99']:>8.1f} {ttfb:>8} "
+              f"{result['throughput_rps']:>8.2f} {result['cpu_ms_per_request']:>10.2f} {lag['p95']:>7.1f} {lag['max']:>7.1f}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"created_at": datetime.now(timezone.utc).isoformat(), "config": vars(args), "results": results}, file, indent=2)
+        print(f"\nresults written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = _compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+def _endpoint_list(value):
+    endpoints = value.split(",")
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}")
+    return endpoints
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--endpoints", type=_endpoint_list, default=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 16, 64])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--chat-requests", type=int, default=64, help="requests per send-msg scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests before each scenario")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--user-docs", type=int, default=3, help="completed documents per user")
+    parser.add_argument("--kb-docs", type=int, default=100, help="completed knowledge base documents")
+    parser.add_argument("--history", type=int, default=10, help="zep messages per user")
+    parser.add_argument("--chunks-per-doc", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--llm-ttft", type=float, default=0.4, help="seconds to the first token")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between tokens")
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--pinecone-latency", type=float, default=0.08)
+    parser.add_argument("--zep-latency", type=float, default=0.05)
+    parser.add_argument("--output", default=None, help="write the results as json")
+    parser.add_argument("--baseline", default=None, help="json results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95 / throughput change")
+    run(parser.parse_args())
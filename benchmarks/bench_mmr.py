@@ -0,0 +1,42 @@
+# MMR benchmark: langchain_pinecone's maximal_marginal_relevance (current path) vs app.common.mmr
+# Usage: python -m benchmarks.bench_mmr [--dim 1536] [--k 4] [--repeat 20]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_pinecone._utilities import maximal_marginal_relevance
+from app.common.mmr import mmr_select
+
+def _time_ms(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def run(dim, k, repeat):
+    rng = np.random.default_rng(0)
+    print(f"dim={dim} k={k} repeat={repeat}")
+    print(f"{'candidates':>10} {'queries':>7} {'langchain ms':>13} {'numpy ms':>9} {'speedup':>8} {'same picks':>10}")
+    for candidates_count in (50, 150, 300, 600):
+        for queries_count in (1, 3):
+            queries = rng.normal(size=(queries_count, dim)).astype(np.float32)
+            candidates = list(rng.normal(size=(candidates_count, dim)).astype(np.float32))
+            # the current path scores against a single query vector, feed it the mean of the queries
+            mean_query = queries.mean(axis=0)
+            langchain_ms = _time_ms(lambda: maximal_marginal_relevance(mean_query, candidates, k=k), repeat)
+            numpy_ms = _time_ms(lambda: mmr_select(queries, candidates, k), repeat)
+            same = maximal_marginal_relevance(mean_query, candidates, k=k) == mmr_select(mean_query, candidates, k)
+            print(f"{candidates_count:>10} {queries_count:>7} {langchain_ms:>13.3f} {numpy_ms:>9.3f} {langchain_ms / numpy_ms:>7.1f}x {str(same):>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.dim, args.k, args.repeat)
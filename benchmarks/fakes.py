@@ -0,0 +1,204 @@
+# Deterministic offline stand-ins for the external services of the chat pipeline (OpenAI / Azure chat models,
+# Azure embeddings, Pinecone indexes, Zep) with configurable latency, shared by the benchmarks.
+# disable_zep_healthcheck() has to run before app modules are imported, app.common.getzep connects at import.
+import asyncio
+import hashlib
+import time
+import uuid
+from typing import Any, List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+ANSWER_WORDS = ("Under the tenancy act the landlord must give written notice before entering the property "
+                "and the tenant may ask the tribunal to review any deduction from the deposit").split()
+
+def disable_zep_healthcheck():
+    import zep_python.zep_client as zep_client
+    zep_client.ZepClient._healthcheck = lambda self, url: None
+
+# Streams answer_tokens words, first token after ttft seconds and then one every token_interval seconds.
+# The words are rotated by a hash of the prompt, so different questions get different (but repeatable) answers.
+class FakeStreamingChatModel(BaseChatModel):
+    answer_tokens: int = 200
+    ttft: float = 0.3
+    token_interval: float = 0.01
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming-chat"
+
+    def _tokens(self, messages):
+        digest = hashlib.sha1("".join(str(message.content) for message in messages).encode("utf-8")).digest()
+        offset = int.from_bytes(digest[:4], "little")
+        return [ANSWER_WORDS[(offset + i) % len(ANSWER_WORDS)] + " " for i in range(self.answer_tokens)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.ttft + self.token_interval * self.answer_tokens)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(self._tokens(messages))))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.ttft + self.token_interval * self.answer_tokens)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(self._tokens(messages))))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        await asyncio.sleep(self.ttft)
+        for i, token in enumerate(self._tokens(messages)):
+            if i > 0 and self.token_interval:
+                await asyncio.sleep(self.token_interval)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+# Unit vectors seeded by the text, the same text always embeds to the same vector
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dim=1536, latency=0.05):
+        self.dim = dim
+        self.latency = latency
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).normal(size=self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+# Brute force cosine search over chunks_per_doc random chunks per document, honours file_name $in / $eq filters
+class FakePineconeIndex:
+    def __init__(self, file_names, chunks_per_doc=20, dim=1536, latency=0.08, seed=0):
+        rng = np.random.default_rng(seed)
+        self.latency = latency
+        self.file_names = np.array([name for name in file_names for _ in range(chunks_per_doc)], dtype=object)
+        vectors = rng.normal(size=(len(self.file_names), dim)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.texts = [f"{name} section {i % chunks_per_doc}: " + " ".join(ANSWER_WORDS) for i, name in enumerate(self.file_names)]
+        self.queries = 0
+
+    def query(self, vector, top_k, include_values=False, include_metadata=False, namespace=None, filter=None, **kwargs):
+        time.sleep(self.latency)
+        self.queries += 1
+        candidates = np.arange(len(self.file_names))
+        if filter and "file_name" in filter:
+            allowed = set(filter["file_name"].get("$in", [])) | {filter["file_name"].get("$eq")}
+            candidates = candidates[[name in allowed for name in self.file_names]]
+        if len(candidates) == 0:
+            return {"matches": []}
+        scores = self.vectors[candidates] @ np.asarray(vector, dtype=np.float32)
+        order = np.argsort(-scores)[:top_k]
+        matches = []
+        for position in order:
+            i = candidates[position]
+            match = {"id": str(i), "score": float(scores[position])}
+            if include_values:
+                match["values"] = self.vectors[i].tolist()
+            if include_metadata:
+                match["metadata"] = {"text": self.texts[i], "file_name": self.file_names[i]}
+            matches.append(match)
+        return {"matches": matches}
+
+    def fetch(self, ids, namespace=None, **kwargs):
+        time.sleep(self.latency)
+        return {"vectors": {id: {"id": id, "values": self.vectors[int(id)].tolist(),
+                                 "metadata": {"text": self.texts[int(id)], "file_name": self.file_names[int(id)]}}
+                            for id in ids}}
+
+    def describe_index_stats(self):
+        return {"total_vector_count": len(self.file_names), "dimension": self.vectors.shape[1]}
+
+# Stand-ins for the app.common.getzep functions used on the chat path, every user starts with history_length messages
+class FakeZep:
+    def __init__(self, history_length=10, latency=0.05):
+        self.history_length = history_length
+        self.latency = latency
+        self.sessions = {}
+        self.writes = 0
+
+    def _history(self):
+        from zep_python import Message
+        return [Message(uuid=uuid.uuid4().hex,
+                        role="User" if i % 2 == 0 else "AI",
+                        content=f"Earlier message {i}: " + " ".join(ANSWER_WORDS[:12 if i % 2 == 0 else len(ANSWER_WORDS)]))
+                for i in range(self.history_length)]
+
+    async def get_session_id_of_user(self, user_id, version=None):
+        await asyncio.sleep(self.latency)
+        return self.sessions.setdefault(user_id, uuid.uuid4().hex)
+
+    async def get_all_messages_by_session(self, session_id):
+        await asyncio.sleep(self.latency)
+        return self._history()
+
+    async def add_messages_to_session(self, session_id, messages):
+        await asyncio.sleep(self.latency)
+        self.writes += 1
+
+# Sqlite stand-in for the mysql database, with the binary collation the document name columns use.
+# In memory by default, a file (in WAL mode, so readers don't block the writer) when sessions run concurrently.
+def create_session_factory(path=None):
+    from app.common.database import Base
+    if path is None:
+        engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _configure(connection, _):
+        connection.create_collation("utf8mb3_bin", lambda a, b: (a > b) - (a < b))
+        if path is not None:
+            connection.execute("PRAGMA journal_mode=WAL")
+
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(bind=engine, autocommit=False, autoflush=False)
+
+def add_knowledge_base_documents(session, docs):
+    from app.models.user import KnowledgeBaseDocument
+    file_names = [f"kb-document-{i}.pdf" for i in range(docs)]
+    session.add_all([KnowledgeBaseDocument(document_name=name, content_type="application/pdf", status="Completed") for name in file_names])
+    session.commit()
+    return file_names
+
+# Points the app at the fakes: both llm providers, the embeddings behind the cache, the pinecone indexes and zep
+def install(llm_config, azure_llm_config=None, embeddings=None, indexes=None, zep=None):
+    from app.common import getzep
+    from app.common.azure_openai import AzureOpenAIManager
+    from app.common.embeddings import cached_embeddings
+    from app.common.openai import OpenAIManager
+    from app.common.vectorstore import VectorStoreRegistry
+
+    azure_llm_config = azure_llm_config or llm_config
+    OpenAIManager.CHAT_PRIMARY = FakeStreamingChatModel(**llm_config)
+    OpenAIManager.CHAT_SECONDARY = FakeStreamingChatModel(**{**llm_config, "answer_tokens": 20})
+    AzureOpenAIManager.CHAT_PRIMARY = FakeStreamingChatModel(**azure_llm_config)
+    AzureOpenAIManager.CHAT_SECONDARY = FakeStreamingChatModel(**{**azure_llm_config, "answer_tokens": 20})
+
+    cached_embeddings.embeddings = embeddings or FakeEmbeddings()
+    cached_embeddings.disk_store = None
+    cached_embeddings._memory.clear()
+
+    VectorStoreRegistry._stores.clear()
+    VectorStoreRegistry._indexes.clear()
+    VectorStoreRegistry._indexes.update(indexes or {})
+
+    zep = zep or FakeZep()
+    getzep.get_session_id_of_user = zep.get_session_id_of_user
+    getzep.get_all_messages_by_session = zep.get_all_messages_by_session
+    getzep.add_messages_to_session = zep.add_messages_to_session
+    return zep
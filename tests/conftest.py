@@ -10,13 +10,15 @@ from starlette.testclient import TestClient
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.main import app
 from app.common.email import fm
 from app.common.database import Base, get_session
 from app.models.user import User, Role
 from app.common.security import hash_password
 from app.services.auth import get_login_tokens
 
+# tests run offline, the settings load a .env that may enable langsmith tracing of every chain run
+os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
 USER_NAME = "Pytest"
 USER_EMAIL = "pytest@email.com"
 USER_PASSWORD = "TestUser@123"
@@ -34,6 +36,8 @@ def test_session() -> Generator:
 
 @pytest.fixture(scope="function")
 def app_test():
+    # imported here so the unit tests under tests/test_common run without the services the app connects to
+    from app.main import app
     Base.metadata.create_all(bind=engine)
     yield app
     Base.metadata.drop_all(bind=engine)
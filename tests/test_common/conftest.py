@@ -0,0 +1,10 @@
+import pytest
+import zep_python.zep_client
+
+
+@pytest.fixture
+def getzep(monkeypatch):
+    # app.common.getzep connects to zep when it is imported, the tests replace every call they make to it
+    monkeypatch.setattr(zep_python.zep_client.ZepClient, "_healthcheck", lambda self, url: None)
+    from app.common import getzep
+    return getzep
@@ -0,0 +1,47 @@
+"""
+1. A lookup finds the most similar question above the threshold.
+2. A lookup or store under a new version drops the entries of the old one.
+3. The least recently used answer is evicted beyond maxsize, expired answers are dropped.
+.....
+"""
+
+import time
+from app.common.answercache import SemanticAnswerCache
+
+
+def test_lookup():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None, threshold=0.9)
+    cache.store([1.0, 0.0], 1, "deposit answer", {"kb": "deposit context"})
+    cache.store([0.0, 1.0], 1, "rent answer", {"kb": "rent context"})
+    answer, context, similarity = cache.lookup([0.2, 2.0], 1)
+    assert (answer, context) == ("rent answer", {"kb": "rent context"})
+    assert 0.9 < similarity <= 1.0
+    assert cache.lookup([1.0, 1.0], 1) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_version_change():
+    cache = SemanticAnswerCache(maxsize=10, ttl=None, threshold=0.9)
+    cache.store([1.0, 0.0], (1, 1), "old answer", {})
+    assert cache.lookup([1.0, 0.0], (2, 1)) is None
+    cache.store([0.0, 1.0], (2, 1), "new answer", {})
+    assert cache.lookup([1.0, 0.0], (2, 1)) is None
+    assert cache.lookup([0.0, 1.0], (2, 1))[0] == "new answer"
+    assert cache.stats()["size"] == 1
+
+
+def test_eviction_and_ttl():
+    cache = SemanticAnswerCache(maxsize=2, ttl=None, threshold=0.9)
+    cache.store([1.0, 0.0], 1, "first", {})
+    cache.store([0.0, 1.0], 1, "second", {})
+    assert cache.lookup([1.0, 0.0], 1)[0] == "first"
+    cache.store([-1.0, 0.0], 1, "third", {})
+    assert cache.lookup([0.0, 1.0], 1) is None
+    assert cache.lookup([1.0, 0.0], 1)[0] == "first"
+    assert cache.stats()["evictions"] == 1
+
+    cache = SemanticAnswerCache(maxsize=2, ttl=0.01, threshold=0.9)
+    cache.store([1.0, 0.0], 1, "first", {})
+    time.sleep(0.02)
+    assert cache.lookup([1.0, 0.0], 1) is None
+    assert cache.stats()["expirations"] == 1
@@ -0,0 +1,86 @@
+"""
+1. Text is tokenized into lowercased words and numbers without stopwords.
+2. The chunk naming the query's terms ranks first, only the documents in scope are searched.
+3. A query over a document the index does not hold (or before it is loaded) is a miss.
+4. A reloaded index answers from disk without fetching the documents again.
+5. A re-uploaded document replaces the old one, its old chunks are no longer matched.
+6. Removed rows are dropped once they outnumber the live ones.
+.....
+"""
+
+import os
+import pytest
+from app.common.bm25 import BM25Index, tokenize
+
+DOCUMENTS = {
+    "housing.pdf:1": ["Section 213 of the Housing Act 2004 covers tenancy deposits.", "Landlords must protect the deposit."],
+    "tenancy.pdf:1": ["A tenancy agreement names the landlord and the tenant.", "Rent is due monthly."],
+}
+
+
+def _fetcher(documents, fetched=None):
+    def fetch_document(file_name):
+        if fetched is not None:
+            fetched.append(file_name)
+        return [{"id": f"{file_name}#{i}", "metadata": {"text": text, "file_name": file_name}}
+                for i, text in enumerate(documents[file_name])]
+    return fetch_document
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = BM25Index(str(tmp_path))
+    index.load()
+    index.sync(frozenset(DOCUMENTS), _fetcher(DOCUMENTS))
+    return index
+
+
+def test_tokenize():
+    assert tokenize("What is s.213 of the Housing Act 2004?") == ["s", "213", "housing", "act", "2004"]
+
+
+def test_query_ranks_and_scopes(index):
+    matches = index.query("section 213 housing act", 10, frozenset(DOCUMENTS))
+    assert matches[0]["id"] == "housing.pdf:1#0"
+    assert matches[0]["metadata"]["text"].startswith("Section 213")
+    assert all(match["metadata"]["file_name"] == "tenancy.pdf:1"
+               for match in index.query("landlord tenant", 10, frozenset({"tenancy.pdf:1"})))
+    assert index.query("unrelated words", 10, frozenset(DOCUMENTS)) == []
+
+
+def test_query_miss(tmp_path, index):
+    assert index.query("deposit", 10, frozenset({"other.pdf:1"})) is None
+    assert BM25Index(str(tmp_path)).query("deposit", 10, frozenset(DOCUMENTS)) is None
+    assert index.stats()["misses"] == 1
+
+
+def test_reload_from_disk(tmp_path, index):
+    fetched = []
+    reloaded = BM25Index(str(tmp_path))
+    reloaded.load()
+    reloaded.sync(frozenset(DOCUMENTS), _fetcher(DOCUMENTS, fetched))
+    assert fetched == []
+    assert reloaded.query("deposit", 10, frozenset(DOCUMENTS)) == index.query("deposit", 10, frozenset(DOCUMENTS))
+
+
+def test_reupload_replaces_document(tmp_path, index):
+    documents = {"housing.pdf:2": ["Section 214 covers deposit disputes."], "tenancy.pdf:1": DOCUMENTS["tenancy.pdf:1"]}
+    index.sync(frozenset(documents), _fetcher(documents))
+    assert index.documents == frozenset(documents)
+    matches = index.query("deposit", 10, frozenset(documents))
+    assert [match["id"] for match in matches] == ["housing.pdf:2#0"]
+    assert len([entry for entry in os.listdir(tmp_path) if entry.endswith(".json")]) == 2
+
+    reloaded = BM25Index(str(tmp_path))
+    reloaded.load()
+    assert reloaded.documents == frozenset(documents)
+
+
+def test_removed_rows_compacted(index):
+    index.sync(frozenset({"tenancy.pdf:1"}), _fetcher(DOCUMENTS))
+    # 2 removed rows, 2 live ones
+    assert len(index._ids) == 4
+    index.sync(frozenset(), _fetcher(DOCUMENTS))
+    assert len(index._ids) == 0 and index.stats()["chunks"] == 0
+    index.sync(frozenset({"new.pdf:1"}), _fetcher({"new.pdf:1": ["Deposit returned."]}))
+    assert [match["id"] for match in index.query("deposit", 10, frozenset({"new.pdf:1"}))] == ["new.pdf:1#0"]
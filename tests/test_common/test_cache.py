@@ -0,0 +1,41 @@
+"""
+1. The least recently used entry is evicted beyond maxsize.
+2. Expired entries are misses.
+3. Entries can be popped and evicted by key.
+.....
+"""
+
+import time
+from app.common.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_ttl():
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=60)
+    time.sleep(0.02)
+    assert cache.get("a", "missing") == "missing"
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_lru_pop_and_evict_where():
+    cache = LRUCache(maxsize=10)
+    for key in ("alice:1", "alice:2", "bob:1"):
+        cache.set(key, key)
+    assert cache.pop("bob:1") == "bob:1"
+    assert cache.pop("bob:1", "missing") == "missing"
+    assert cache.evict_where(lambda key: key.startswith("alice:")) == 2
+    assert len(cache) == 0
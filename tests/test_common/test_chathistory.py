@@ -0,0 +1,112 @@
+"""
+1. The window holds the newest messages that fit the model's token budget, at most CHAT_HISTORY_MAX_MESSAGES.
+2. A last exchange over the budget is kept, the longer message is cut down to what the shorter one leaves.
+3. Messages share the budget evenly, the ones under their share are kept whole.
+4. Token counts are computed once per message and model.
+5. A cached history is only served for the version it was stored under, at most CHAT_HISTORY_CACHE_MAX_MESSAGES.
+6. An append moves the cached history to the next version, an append after another worker's change drops it.
+7. A turn's context is kept per user and answer, and dropped with the user's history.
+.....
+"""
+
+import pytest
+from zep_python.message import Message
+from app.common import tokens
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+
+@pytest.fixture
+def chathistory(monkeypatch, getzep):
+    from app.common import chathistory
+    # approximate counts (characters / 4 + 1) keep the budgets below independent of the tiktoken version
+    monkeypatch.setattr(tokens, "get_encoding", lambda model_name: None)
+    monkeypatch.setattr(settings, "CHAT_HISTORY_TOKEN_BUDGETS_JSON", '{"default": 50}')
+    monkeypatch.setattr(chathistory, "_token_counts", chathistory.LRUCache(maxsize=100))
+    monkeypatch.setattr(chathistory, "_histories", chathistory.LRUCache(maxsize=100))
+    monkeypatch.setattr(chathistory, "_turn_contexts", chathistory.LRUCache(maxsize=100))
+    return chathistory
+
+
+def _message(i, length=36, role="human"):
+    # length 36 counts as 10 tokens plus the message overhead
+    return Message(role=role, content=f"{i}".ljust(length, "x"), uuid=f"m{i}")
+
+
+def test_window_fills_budget(monkeypatch, chathistory):
+    messages = [_message(i) for i in range(6)]
+    window, older = chathistory.select_history_window(messages, "model")
+    assert (window, older) == (messages[3:], messages[:3])
+
+    monkeypatch.setattr(settings, "CHAT_HISTORY_MAX_MESSAGES", 2)
+    window, older = chathistory.select_history_window(messages, "model")
+    assert (window, older) == (messages[4:], messages[:4])
+
+
+def test_last_exchange_truncated(chathistory):
+    messages = [_message(0), _message(1, length=400), _message(2, role="ai")]
+    window, older = chathistory.select_history_window(messages, "model")
+    assert older == messages[:1]
+    # the answer takes 14 of the 50 tokens, the question is cut to the 36 left (32 after the overhead)
+    assert window[0].content == messages[1].content[:128] and window[0].role == "human"
+    assert window[1] is messages[2]
+
+
+def test_truncate_shares_budget(chathistory):
+    messages = [_message(0, length=400), _message(1), _message(2, length=400)]
+    truncated = chathistory._truncate_messages(messages, 60, "model")
+    assert truncated[1] is messages[1]
+    # 46 tokens left after the short message, 23 each, 19 after the overhead
+    assert [len(message.content) for message in truncated] == [76, 36, 76]
+
+
+def test_token_counts_cached(monkeypatch, chathistory):
+    counted = []
+    count_tokens = tokens.count_tokens
+    monkeypatch.setattr(tokens, "count_tokens", lambda text, model_name: counted.append(text) or count_tokens(text, model_name))
+    messages = [_message(i) for i in range(3)]
+    chathistory.select_history_window(messages, "model")
+    chathistory.select_history_window(messages, "model")
+    assert len(counted) == 3
+    chathistory.select_history_window(messages, "other-model")
+    assert len(counted) == 6
+
+
+def test_cached_history_versioned(monkeypatch, chathistory):
+    monkeypatch.setattr(settings, "CHAT_HISTORY_CACHE_MAX_MESSAGES", 3)
+    messages = [_message(i) for i in range(5)]
+    chathistory.set_cached_history("alice", 1, messages)
+    assert chathistory.get_cached_history("alice", 1) == messages[2:]
+    assert chathistory.get_cached_history("alice", 2) is None
+    assert chathistory.get_cached_history("bob", 1) is None
+
+    # callers get a copy
+    chathistory.get_cached_history("alice", 1).append(_message(9))
+    assert len(chathistory.get_cached_history("alice", 1)) == 3
+    chathistory.evict_cached_history("alice")
+    assert chathistory.get_cached_history("alice", 1) is None
+
+
+def test_append_cached_history(chathistory):
+    chathistory.set_cached_history("alice", 1, [_message(0)])
+    chathistory.append_cached_history("alice", 2, [("human", "q1"), ("ai", "a1")])
+    assert chathistory.get_cached_history("alice", 1) is None
+    assert [(message.role, message.content) for message in chathistory.get_cached_history("alice", 2)[1:]] == [("human", "q1"), ("ai", "a1")]
+
+    # version 3 was written by another worker
+    chathistory.append_cached_history("alice", 4, [("human", "q2"), ("ai", "a2")])
+    assert chathistory.get_cached_history("alice", 4) is None
+    # nothing cached, nothing to append to
+    chathistory.append_cached_history("bob", 1, [("human", "q1"), ("ai", "a1")])
+    assert chathistory.get_cached_history("bob", 1) is None
+
+
+def test_turn_contexts(chathistory):
+    chathistory.set_turn_context("alice", "a1", {"laws_from_kb": "section 213"})
+    chathistory.set_turn_context("bob", "a1", {"laws_from_kb": "section 21"})
+    assert chathistory.get_turn_context("alice", "a1") == {"laws_from_kb": "section 213"}
+    assert chathistory.get_turn_context("alice", "a2") is None
+    chathistory.evict_turn_contexts("alice")
+    assert chathistory.get_turn_context("alice", "a1") is None
+    assert chathistory.get_turn_context("bob", "a1") == {"laws_from_kb": "section 21"}
@@ -0,0 +1,62 @@
+"""
+1. Passages are tagged with the file name (without the consumer prefix and extension) and the page.
+2. Overlapping chunks of the same source are merged, a chunk contained in another is dropped.
+3. Chunks of different sources are not merged, even when their texts overlap.
+4. The packed context stays within the token budget, a passage is cut only when enough budget is left.
+5. Empty chunks are skipped.
+.....
+"""
+
+from langchain_core.documents import Document
+from app.common import tokens
+from app.common.contextpack import MIN_OVERLAP_CHARS, MIN_PASSAGE_TOKENS, pack_documents
+
+MODEL_NAME = "gpt-4"
+
+OVERLAP = "the deposit must be protected within thirty days of receipt"
+
+
+def _document(text, file_name="guide.pdf", page=None):
+    metadata = {"file_name": file_name}
+    if page is not None:
+        metadata["page"] = page
+    return Document(page_content=text, metadata=metadata)
+
+
+def test_source_tags():
+    packed = pack_documents([_document("First.", "alice:Lease notes.docx"), _document("Second.", "guide.pdf", page=2)],
+                            1000, MODEL_NAME, source_prefix="alice:")
+    assert packed == "[1] Lease notes\nFirst.\n\n[2] guide, p. 3\nSecond."
+
+
+def test_same_source_merged():
+    assert len(OVERLAP) >= MIN_OVERLAP_CHARS
+    documents = [
+        _document("Landlords take a deposit and " + OVERLAP, page=0),
+        _document(OVERLAP + " or they pay a penalty.", page=1),
+        _document("take a deposit", page=0),
+    ]
+    packed = pack_documents(documents, 1000, MODEL_NAME)
+    assert packed == f"[1] guide, p. 1\nLandlords take a deposit and {OVERLAP} or they pay a penalty."
+
+
+def test_different_sources_kept():
+    documents = [_document("Landlords take a deposit and " + OVERLAP), _document(OVERLAP + " or they pay a penalty.", "other.pdf")]
+    packed = pack_documents(documents, 1000, MODEL_NAME)
+    assert packed.startswith("[1] guide\n") and "\n\n[2] other\n" in packed
+
+
+def test_token_budget():
+    documents = [_document(f"Passage {i}. " + "word " * 60, f"doc{i}.pdf") for i in range(5)]
+    budget = tokens.count_tokens("[1] doc0\n" + documents[0].page_content.strip(), MODEL_NAME) + MIN_PASSAGE_TOKENS
+    packed = pack_documents(documents, budget, MODEL_NAME)
+    assert tokens.count_tokens(packed, MODEL_NAME) <= budget + 1
+    assert packed.startswith("[1] doc0\n") and "[2] doc1\n" in packed and "[3]" not in packed
+
+    # too little budget left for a useful second passage
+    packed = pack_documents(documents, budget - 1, MODEL_NAME)
+    assert packed.startswith("[1] doc0\n") and "[2]" not in packed
+
+
+def test_empty_chunks_skipped():
+    assert pack_documents([_document("  "), _document("Text.")], 1000, MODEL_NAME) == "[1] guide\nText."
@@ -0,0 +1,91 @@
+"""
+1. A document's ids are listed with one query that returns neither values nor metadata.
+2. A document's vectors are fetched by id in batches, in the order of the ids.
+3. Setting the active flag updates every vector of the document.
+4. Flag updates run in the background, updates of the same scope in the order they were requested.
+5. Nothing is updated when retrieval is scoped by file names.
+.....
+"""
+
+import asyncio
+import threading
+from app.common import docscope
+from app.common.settings import get_settings
+from app.common.vectorstore import VectorStoreRegistry
+
+settings = get_settings()
+
+
+class _Index:
+    def __init__(self, file_names, vectors_per_file=5, update_delay=None):
+        self.vectors = {f"{file_name}#{i}": {"values": [float(i), 1.0], "metadata": {"file_name": file_name, "active": True}}
+                        for file_name in file_names for i in range(vectors_per_file)}
+        self.queries = []
+        self.fetches = []
+        self.updates = []
+        self.update_delay = update_delay
+
+    def describe_index_stats(self):
+        return {"dimension": 2}
+
+    def query(self, vector, top_k, include_values, include_metadata, namespace, filter):
+        self.queries.append((top_k, include_values, include_metadata, filter))
+        file_name = filter["file_name"]["$eq"]
+        return {"matches": [{"id": vector_id} for vector_id, vector in self.vectors.items() if vector["metadata"]["file_name"] == file_name]}
+
+    def fetch(self, ids, namespace):
+        self.fetches.append(list(ids))
+        return {"vectors": {vector_id: self.vectors[vector_id] for vector_id in ids}}
+
+    def update(self, id, set_metadata, namespace):
+        if self.update_delay is not None:
+            self.update_delay.wait()
+        self.updates.append((id, set_metadata["active"]))
+        self.vectors[id]["metadata"].update(set_metadata)
+
+
+def test_find_document_ids():
+    index = _Index(["a.pdf", "b.pdf"])
+    assert docscope.find_document_ids(index, None, "a.pdf") == [f"a.pdf#{i}" for i in range(5)]
+    assert index.queries == [(docscope.MAX_VECTORS_PER_DOCUMENT, False, False, {"file_name": {"$eq": "a.pdf"}})]
+
+
+def test_find_document_vectors(monkeypatch):
+    monkeypatch.setattr(docscope, "FETCH_BATCH_SIZE", 2)
+    index = _Index(["a.pdf"])
+    matches = docscope.find_document_vectors(index, None, "a.pdf")
+    assert [match["id"] for match in matches] == [f"a.pdf#{i}" for i in range(5)]
+    assert matches[3]["values"] == [3.0, 1.0] and matches[3]["metadata"]["file_name"] == "a.pdf"
+    assert [len(ids) for ids in index.fetches] == [2, 2, 1]
+
+
+def test_set_vectors_active():
+    index = _Index(["a.pdf", "b.pdf"])
+    assert docscope.set_vectors_active(index, None, "a.pdf", False) == 5
+    assert all(vector["metadata"]["active"] is (vector_id.startswith("b.pdf")) for vector_id, vector in index.vectors.items())
+
+
+def test_flag_updates_in_background(monkeypatch):
+    monkeypatch.setattr(settings, "RETRIEVAL_DOC_SCOPE", "active_flag")
+    release = threading.Event()
+    index = _Index(["a.pdf"], vectors_per_file=2, update_delay=release)
+    monkeypatch.setattr(VectorStoreRegistry, "get_index", lambda index_name: index)
+
+    async def run():
+        deactivate = docscope.set_kb_documents_active(["a.pdf"], False)
+        reactivate = docscope.set_kb_documents_active(["a.pdf"], True)
+        # the request goes on while the updates wait on pinecone
+        await asyncio.sleep(0.05)
+        assert not deactivate.done() and index.updates == []
+        release.set()
+        await asyncio.gather(deactivate, reactivate)
+
+    asyncio.run(run())
+    assert [active for _, active in index.updates] == [False, False, True, True]
+    assert docscope._flag_updates == {}
+
+
+def test_file_names_scope_untouched(monkeypatch):
+    monkeypatch.setattr(settings, "RETRIEVAL_DOC_SCOPE", "file_names")
+    assert docscope.set_kb_documents_active(["a.pdf"], False) is None
+    assert docscope.set_consumer_documents_active("alice", ["a.pdf"], False) is None
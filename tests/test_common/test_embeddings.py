@@ -0,0 +1,75 @@
+"""
+1. Vectors put in the disk store are read back after a reopen.
+2. A store left with more keys than vectors (crash between the appends) lines up again for the next append.
+3. A store left with more vectors than keys lines up again for the next append.
+4. The store stops growing at max_entries.
+5. A batch only sends its deduplicated misses upstream, repeats are served from memory then disk.
+.....
+"""
+
+import asyncio
+import os
+import pytest
+from benchmarks.fakes import FakeEmbeddings
+from app.common.embeddings import CachedEmbeddings, DiskEmbeddingStore
+
+
+def test_disk_store_reopen(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    store.put_many([("a", [1.0, 0.0]), ("b", [0.0, 1.0])])
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    assert len(store) == 2
+    assert store.get_many(["b", "x", "a"]) == [[0.0, 1.0], None, [1.0, 0.0]]
+
+
+def test_disk_store_recovers_extra_keys(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    store.put_many([("a", [1.0, 0.0]), ("b", [0.0, 1.0])])
+    # the vector of b never made it to disk
+    with open(os.path.join(tmp_path, "vectors.f32"), "r+b") as vectors_file:
+        vectors_file.truncate(2 * 4)
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    assert store.get_many(["a", "b"]) == [[1.0, 0.0], None]
+    store.put_many([("c", [0.0, -1.0])])
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    assert store.get_many(["a", "b", "c"]) == [[1.0, 0.0], None, [0.0, -1.0]]
+
+
+def test_disk_store_recovers_extra_vectors(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    store.put_many([("a", [1.0, 0.0])])
+    # b's vector was written, its key was cut off mid write
+    with open(os.path.join(tmp_path, "vectors.f32"), "ab") as vectors_file:
+        vectors_file.write(b"\x00" * 8)
+    with open(os.path.join(tmp_path, "keys.txt"), "a") as keys_file:
+        keys_file.write("b")
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    store.put_many([("c", [0.0, -1.0])])
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=10)
+    assert len(store) == 2
+    assert store.get_many(["a", "c"]) == [[1.0, 0.0], [0.0, -1.0]]
+
+
+def test_disk_store_max_entries(tmp_path):
+    store = DiskEmbeddingStore(str(tmp_path), max_entries=2)
+    store.put_many([("a", [1.0]), ("b", [2.0]), ("c", [3.0])])
+    assert len(store) == 2
+    assert store.get_many(["c"]) == [None]
+
+
+def test_cached_embeddings_only_embeds_misses(tmp_path):
+    upstream = FakeEmbeddings(dim=4, latency=0)
+    embeddings = CachedEmbeddings(upstream, "model", maxsize=10, disk_store=DiskEmbeddingStore(str(tmp_path), 10))
+    vectors = embeddings.embed_documents(["a", "b", "a"])
+    assert vectors == upstream.embed_documents(["a", "b", "a"])
+    assert (embeddings.upstream_calls, embeddings.upstream_texts) == (1, 2)
+
+    assert asyncio.run(embeddings.aembed_query("b")) == vectors[1]
+    assert embeddings.upstream_calls == 1
+
+    # a new process only has the disk store
+    embeddings = CachedEmbeddings(upstream, "model", maxsize=10, disk_store=DiskEmbeddingStore(str(tmp_path), 10))
+    # stored as float32
+    assert embeddings.embed_documents(["a", "c"])[0] == pytest.approx(vectors[0], abs=1e-6)
+    assert (embeddings.upstream_calls, embeddings.upstream_texts) == (1, 1)
+    assert embeddings.stats()["disk_hits"] == 1
@@ -0,0 +1,71 @@
+"""
+1. A user's session id is resolved from zep once and then served from the cache.
+2. A cached session id is resolved again under another chat history version.
+3. A change of this worker moves the cached id to the new version, a change of another worker in between drops it.
+4. A new session is cached under the version it was created for.
+.....
+"""
+
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+
+@pytest.fixture
+def sessions(monkeypatch, getzep):
+    sessions = {"alice": ["s1"]}
+    lookups = []
+
+    async def get_all_sessions_of_user(user_id):
+        lookups.append(user_id)
+        return [SimpleNamespace(session_id=session_id) for session_id in sessions.get(user_id, [])]
+
+    monkeypatch.setattr(getzep, "get_all_sessions_of_user", get_all_sessions_of_user)
+    getzep.evict_session_id_of_user("alice")
+    getzep.evict_session_id_of_user("bob")
+    return sessions, lookups
+
+
+def test_session_id_cached(getzep, sessions):
+    _, lookups = sessions
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 1)) == "s1"
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 1)) == "s1"
+    # the write-behind queue has no version
+    assert asyncio.run(getzep.get_session_id_of_user("alice")) == "s1"
+    assert asyncio.run(getzep.get_session_id_of_user("bob", 1)) is None
+    assert lookups == ["alice", "bob"]
+
+
+def test_session_id_resolved_under_new_version(getzep, sessions):
+    sessions, lookups = sessions
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 1)) == "s1"
+    # another worker cleared the chat
+    sessions["alice"] = ["s2"]
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 2)) == "s2"
+    assert asyncio.run(getzep.get_session_id_of_user("alice")) == "s2"
+    assert lookups == ["alice", "alice"]
+
+
+def test_update_session_id_version(getzep, sessions):
+    _, lookups = sessions
+    asyncio.run(getzep.get_session_id_of_user("alice", 1))
+    getzep.update_session_id_version("alice", 2)
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 2)) == "s1"
+    assert lookups == ["alice"]
+
+    # version 3 was written by another worker
+    getzep.update_session_id_version("alice", 4)
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 4)) == "s1"
+    assert lookups == ["alice", "alice"]
+
+
+def test_added_session_cached(monkeypatch, getzep, sessions):
+    _, lookups = sessions
+
+    async def aadd_session(session):
+        pass
+
+    monkeypatch.setattr(getzep.zep_client.memory, "aadd_session", aadd_session)
+    asyncio.run(getzep.add_session("alice", "s3", version=5))
+    assert asyncio.run(getzep.get_session_id_of_user("alice", 5)) == "s3"
+    assert lookups == []
@@ -0,0 +1,198 @@
+"""
+1. A query returns the same top-k as a brute-force search, exactly in float32, to rounding in int8, and with
+   inverted lists when every list is probed.
+2. A query over a document the index does not hold (or before it is loaded) is a miss, fetch by id returns the values.
+3. A sync appends to the delta segment, a reloaded index replays it without writing a new snapshot.
+4. Re-added and removed documents are replayed in order.
+5. A new snapshot is written once the changed rows exceed the compact ratio, the delta segment starts over.
+6. A delta segment cut off mid append is replayed up to its last complete change.
+7. The kb indexes are built in the calling thread, a rebuild fetches every document again.
+.....
+"""
+
+import os
+import numpy as np
+import pytest
+from app.common import kbindex
+from app.common.kbindex import BackgroundSync, LocalVectorIndex, kb_document_key
+from app.common.mmr import normalize_rows
+
+DIM = 16
+
+
+def _documents(count, rows_per_document=20, seed=0):
+    rng = np.random.default_rng(seed)
+    return {f"doc{i}.pdf": rng.normal(size=(rows_per_document, DIM)).astype(np.float32) for i in range(count)}
+
+
+def _fetcher(documents, fetched=None):
+    def fetch_document(document_key):
+        if fetched is not None:
+            fetched.append(document_key)
+        # pinecone ids and metadata carry the document name, not its key
+        file_name = document_key.rsplit("@", 1)[0]
+        return [{"id": f"{file_name}#{i}", "values": vector.tolist(), "metadata": {"file_name": file_name}}
+                for i, vector in enumerate(documents[document_key])]
+    return fetch_document
+
+
+def _brute_force(documents, file_names, query, top_k):
+    ids = [f"{file_name}#{i}" for file_name in sorted(file_names) for i in range(len(documents[file_name]))]
+    vectors = normalize_rows(np.concatenate([documents[file_name] for file_name in sorted(file_names)]))
+    scores = vectors @ normalize_rows(query)
+    return [ids[row] for row in np.argsort(-scores)[:top_k]]
+
+
+def _index(tmp_path, documents, **kwargs):
+    index = LocalVectorIndex(str(tmp_path), **kwargs)
+    index.load()
+    index.sync(frozenset(documents), _fetcher(documents))
+    return index
+
+
+def _snapshot(tmp_path):
+    with open(os.path.join(str(tmp_path), "CURRENT")) as current_file:
+        return current_file.read().strip()
+
+
+@pytest.mark.parametrize("options", [{}, {"dtype": "int8"}, {"nlist": 4, "nprobe": 4}])
+def test_query_matches_brute_force(tmp_path, options):
+    documents = _documents(5)
+    index = _index(tmp_path, documents, **options)
+    rng = np.random.default_rng(1)
+    scope = frozenset(["doc1.pdf", "doc3.pdf", "doc4.pdf"])
+    for _ in range(10):
+        query = rng.normal(size=DIM).astype(np.float32)
+        matches = index.query(query, 5, scope)
+        expected = _brute_force(documents, scope, query, 5)
+        if options.get("dtype") == "int8":
+            # quantization may swap near ties, the top hit and most of the set agree
+            assert matches[0]["id"] == expected[0]
+            assert len(set(match["id"] for match in matches) & set(expected)) >= 4
+        else:
+            assert [match["id"] for match in matches] == expected
+        assert all(match["metadata"]["file_name"] in scope for match in matches)
+        assert [match["score"] for match in matches] == sorted([match["score"] for match in matches], reverse=True)
+
+
+def test_miss_and_fetch(tmp_path):
+    documents = _documents(2)
+    index = LocalVectorIndex(str(tmp_path))
+    assert index.query(np.ones(DIM), 3, frozenset(["doc0.pdf"])) is None
+    index.load()
+    index.sync(frozenset(documents), _fetcher(documents))
+    assert index.query(np.ones(DIM), 3, frozenset(["doc0.pdf", "other.pdf"])) is None
+    assert (index.hits, index.misses) == (0, 2)
+
+    fetched = index.fetch(["doc1.pdf#3", "doc0.pdf#0"])
+    assert np.allclose(fetched["doc1.pdf#3"], normalize_rows(documents["doc1.pdf"][3]), atol=1e-6)
+    assert index.fetch(["doc1.pdf#3", "missing#0"]) is None
+
+
+def test_delta_replayed_after_reload(tmp_path):
+    documents = _documents(10)
+    first = dict(list(documents.items())[:9])
+    index = _index(tmp_path, first)
+    snapshot = _snapshot(tmp_path)
+
+    # one new document is 20 of 200 rows, within the default ratio
+    index.sync(frozenset(documents), _fetcher(documents))
+    assert _snapshot(tmp_path) == snapshot
+    assert index.stats()["delta_vectors"] == 20
+
+    fetched = []
+    reloaded = LocalVectorIndex(str(tmp_path))
+    reloaded.load()
+    reloaded.sync(frozenset(documents), _fetcher(documents, fetched))
+    assert fetched == []
+    assert reloaded.documents == frozenset(documents)
+    query = documents["doc9.pdf"][0]
+    assert reloaded.query(query, 3, frozenset(documents))[0]["id"] == "doc9.pdf#0"
+    assert [match["id"] for match in reloaded.query(query, 5, frozenset(documents))] == _brute_force(documents, documents, query, 5)
+
+
+def test_readded_and_removed_replayed(tmp_path):
+    documents = _documents(10)
+    old_key, new_key = kb_document_key("doc0.pdf", 1, None), kb_document_key("doc0.pdf", 2, None)
+    documents[old_key] = documents.pop("doc0.pdf")
+    documents[new_key] = _documents(1, seed=2)["doc0.pdf"]
+    index = _index(tmp_path, {key: vectors for key, vectors in documents.items() if key != new_key}, compact_ratio=1.0)
+    snapshot = _snapshot(tmp_path)
+
+    index.sync(frozenset(documents) - {old_key, "doc1.pdf"}, _fetcher(documents))
+    assert _snapshot(tmp_path) == snapshot
+
+    reloaded = LocalVectorIndex(str(tmp_path))
+    reloaded.load()
+    assert reloaded.documents == frozenset(documents) - {old_key, "doc1.pdf"}
+    assert reloaded.query(np.ones(DIM), 3, frozenset(["doc1.pdf"])) is None
+    # the re-upload's rows answer for the ids both uploads share
+    assert np.allclose(reloaded.fetch(["doc0.pdf#2"])["doc0.pdf#2"], normalize_rows(documents[new_key][2]), atol=1e-6)
+    assert reloaded.query(documents[old_key][2], 1, frozenset([new_key]))[0]["score"] < 0.99
+    assert reloaded.query(documents[new_key][2], 1, frozenset([new_key]))[0]["id"] == "doc0.pdf#2"
+    assert reloaded.stats()["vectors"] == 180
+
+
+def test_compaction_past_ratio(tmp_path):
+    documents = _documents(12)
+    first = dict(list(documents.items())[:10])
+    index = _index(tmp_path, first, compact_ratio=0.25, nlist=4)
+    snapshot = _snapshot(tmp_path)
+
+    index.sync(frozenset(list(documents)[:11]), _fetcher(documents))
+    assert _snapshot(tmp_path) == snapshot
+    # 20 changed rows of 200 stay within the ratio, 60 (two added, one removed) do not
+    index.sync(frozenset(list(documents)[1:]), _fetcher(documents))
+    compacted = _snapshot(tmp_path)
+    assert compacted != snapshot
+    assert not os.path.exists(os.path.join(str(tmp_path), snapshot))
+    assert not os.path.exists(os.path.join(str(tmp_path), compacted, "delta.jsonl"))
+    assert index.stats()["delta_vectors"] == 0 and index.stats()["vectors"] == 220
+
+    reloaded = LocalVectorIndex(str(tmp_path), nlist=4, nprobe=4)
+    reloaded.load()
+    query = documents["doc11.pdf"][5]
+    assert [match["id"] for match in reloaded.query(query, 5, reloaded.documents)] == _brute_force(documents, reloaded.documents, query, 5)
+
+
+def test_truncated_delta_recovered(tmp_path):
+    documents = _documents(12)
+    first = dict(list(documents.items())[:10])
+    index = _index(tmp_path, first)
+    index.sync(frozenset(list(documents)[:11]), _fetcher(documents))
+    index.sync(frozenset(documents), _fetcher(documents))
+    path = os.path.join(str(tmp_path), _snapshot(tmp_path))
+
+    # the last change was cut off: its line is incomplete and half of its vectors were written
+    with open(os.path.join(path, "delta.jsonl"), "rb+") as changes_file:
+        changes_file.truncate(os.path.getsize(os.path.join(path, "delta.jsonl")) - 10)
+    with open(os.path.join(path, "delta.f32"), "rb+") as vectors_file:
+        vectors_file.truncate(30 * DIM * 4)
+
+    reloaded = LocalVectorIndex(str(tmp_path))
+    reloaded.load()
+    assert reloaded.documents == frozenset(list(documents)[:11])
+    assert os.path.getsize(os.path.join(path, "delta.f32")) == 20 * DIM * 4
+
+    # the next append lines up with the kept changes
+    reloaded.sync(frozenset(documents), _fetcher(documents))
+    again = LocalVectorIndex(str(tmp_path))
+    again.load()
+    assert again.documents == frozenset(documents)
+    assert again.query(documents["doc11.pdf"][7], 1, frozenset(["doc11.pdf"]))[0]["id"] == "doc11.pdf#7"
+
+
+def test_build_kb_indexes(monkeypatch, tmp_path):
+    documents = _documents(3)
+    fetched = []
+    monkeypatch.setattr(kbindex, "_kb_syncs", [BackgroundSync(LocalVectorIndex(str(tmp_path / "local")), _fetcher(documents, fetched), "kb-local-index")])
+    kbindex.build_kb_indexes(list(documents)[:2])
+    kbindex.build_kb_indexes(documents)
+    assert fetched == ["doc0.pdf", "doc1.pdf", "doc2.pdf"]
+
+    kbindex.build_kb_indexes(list(documents)[1:], rebuild=True)
+    assert fetched[3:] == ["doc1.pdf", "doc2.pdf"]
+    reloaded = LocalVectorIndex(str(tmp_path / "local"))
+    reloaded.load()
+    assert reloaded.documents == frozenset(list(documents)[1:])
+    assert reloaded.stats()["vectors"] == 40
@@ -0,0 +1,68 @@
+"""
+1. A qa chain is built once per user, doc-set versions, admin config version and provider.
+2. A new version of the user's documents or of the knowledge base rebuilds the chain and drops the older ones.
+3. Chains are dropped per user or all at once.
+.....
+"""
+
+import pytest
+from app.common import langchain
+from app.common.cache import LRUCache
+from app.models.user import KnowledgeBaseDocument, UserDocument
+from benchmarks.fakes import add_knowledge_base_documents, create_session_factory
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(langchain, "_qa_chain_cache", LRUCache(maxsize=10))
+    builds = []
+
+    def build_qa_chain(session, username, llm_primary, llm_secondary, has_user_docs):
+        builds.append((username, has_user_docs))
+        return object()
+
+    monkeypatch.setattr(langchain, "_build_qa_chain", build_qa_chain)
+    session = create_session_factory()()
+    add_knowledge_base_documents(session, 2)
+    session.builds = builds
+    yield session
+    session.close()
+
+
+def test_qa_chain_cached(session):
+    chain = langchain.get_qa_chain(session, "alice", None, None, "openai")
+    assert langchain.get_qa_chain(session, "alice", None, None, "openai") is chain
+    assert langchain.get_qa_chain(session, "alice", None, None, "azure") is not chain
+    assert langchain.get_qa_chain(session, "bob", None, None, "openai") is not chain
+    assert session.builds == [("alice", False), ("alice", False), ("bob", False)]
+
+
+def test_new_doc_set_version_rebuilds(session):
+    openai_chain = langchain.get_qa_chain(session, "alice", None, None, "openai")
+    bob_chain = langchain.get_qa_chain(session, "bob", None, None, "openai")
+
+    session.add(UserDocument(user_id="alice", document_name="lease.pdf", status="Completed"))
+    session.commit()
+    user_docs_chain = langchain.get_qa_chain(session, "alice", None, None, "openai")
+    assert user_docs_chain is not openai_chain
+    assert session.builds[-1] == ("alice", True)
+    # alice's chain of the older version is dropped, bob's stays
+    assert len(langchain._qa_chain_cache) == 2
+    assert langchain.get_qa_chain(session, "bob", None, None, "openai") is bob_chain
+
+    session.add(KnowledgeBaseDocument(document_name="kb-new.pdf", status="Completed"))
+    session.commit()
+    assert langchain.get_qa_chain(session, "alice", None, None, "openai") is not user_docs_chain
+    assert len(session.builds) == 4
+
+
+def test_invalidate_qa_chains(session):
+    langchain.get_qa_chain(session, "alice", None, None, "openai")
+    langchain.get_qa_chain(session, "alice", None, None, "azure")
+    bob_chain = langchain.get_qa_chain(session, "bob", None, None, "openai")
+    langchain.invalidate_user_qa_chains("alice")
+    assert len(langchain._qa_chain_cache) == 1
+    assert langchain.get_qa_chain(session, "bob", None, None, "openai") is bob_chain
+
+    langchain.invalidate_all_qa_chains()
+    assert langchain.get_qa_chain_cache_stats()["size"] == 0
@@ -0,0 +1,142 @@
+"""
+1. A provider error before the first token fails over to the next provider.
+2. A request error (not the provider's fault) gives the half-open trial slot back.
+3. A consumer that goes away mid-stream gives the winner's trial slot back and closes its stream.
+4. A successful trial closes the breaker.
+5. Quota reserved for a provider whose breaker then refuses the request is given back.
+6. A hedge loser's wait only counts towards its latency when it raises the estimate.
+.....
+"""
+
+import asyncio
+import time
+import httpx
+import openai
+import pytest
+from app.common import quota
+from app.common.llmrouter import ProviderRouter, ProviderStats
+from app.common.quota import QuotaScheduler, RollingWindow
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+
+@pytest.fixture(autouse=True)
+def providers(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", False)
+    # openai always goes first, azure is the fallback
+    providers = {"openai": ProviderStats("openai", 1.0), "azure": ProviderStats("azure", 0.0)}
+    monkeypatch.setattr(ProviderRouter, "_providers", providers)
+    return providers
+
+
+def _stream(chunks, error=None, closed=None):
+    async def stream():
+        try:
+            for chunk in chunks:
+                await asyncio.sleep(0)
+                yield chunk
+            if error is not None:
+                raise error
+            await asyncio.sleep(10)
+        finally:
+            if closed is not None:
+                closed.append(True)
+    return stream()
+
+
+def _half_open(provider):
+    provider.breaker.opened_at = time.monotonic() - provider.breaker.reset_timeout - 1
+
+
+def _connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "https://llm.invalid"))
+
+
+async def _first_chunks(count, **kwargs):
+    stream = ProviderRouter.astream(**kwargs)
+    chunks = [await stream.__anext__() for _ in range(count)]
+    await stream.aclose()
+    return chunks
+
+
+def test_provider_error_fails_over(providers):
+    streams = {"openai": lambda: _stream([], error=_connection_error()), "azure": lambda: _stream(["a", "b"])}
+    chunks = asyncio.run(_first_chunks(2, make_stream=lambda provider: streams[provider]()))
+    assert chunks == ["a", "b"]
+    assert providers["openai"].failures == 1
+    assert providers["azure"].requests == 1
+
+
+def test_request_error_releases_trial_slot(providers):
+    _half_open(providers["openai"])
+
+    async def run():
+        async for _ in ProviderRouter.astream(lambda provider: _stream([], error=ValueError("bad request"))):
+            pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+    assert providers["openai"].breaker.trial_running is False
+    assert providers["openai"].breaker.allow() is True
+
+
+def test_consumer_disconnect_releases_winner(providers):
+    _half_open(providers["openai"])
+    closed = []
+    chunks = asyncio.run(_first_chunks(1, make_stream=lambda provider: _stream(["a", "b"], closed=closed)))
+    assert chunks == ["a"]
+    assert closed == [True]
+    assert providers["openai"].breaker.trial_running is False
+    assert providers["openai"].breaker.state == "half_open"
+
+
+def test_successful_trial_closes_breaker(providers):
+    _half_open(providers["openai"])
+
+    async def finite(provider):
+        yield "a"
+
+    async def run():
+        return [chunk async for chunk in ProviderRouter.astream(finite)]
+
+    assert asyncio.run(run()) == ["a"]
+    assert providers["openai"].breaker.state == "closed"
+
+
+def test_refused_provider_gives_back_quota(monkeypatch, providers):
+    deployment = quota.DEPLOYMENTS["openai"]["primary"]
+    monkeypatch.setattr(QuotaScheduler, "_windows", {f"openai:{deployment}": RollingWindow(1000, 10)})
+    monkeypatch.setattr(QuotaScheduler, "_waiters", {})
+    # another request holds openai's trial, it is ordered first and admitted but its breaker refuses
+    _half_open(providers["openai"])
+    providers["openai"].breaker.trial_running = True
+
+    async def finite(provider):
+        yield provider
+
+    async def run():
+        return [chunk async for chunk in ProviderRouter.astream(finite, demand=[("primary", 300)])]
+
+    assert asyncio.run(run()) == ["azure"]
+    assert QuotaScheduler._get_window("openai", "primary").tokens == 0
+
+
+@pytest.mark.parametrize("ttft_ewma, expected", [(None, None), (5.0, 5.0)])
+def test_hedge_loser_latency(monkeypatch, providers, ttft_ewma, expected):
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_HEDGE_DELAY_SECONDS", 0.01)
+    providers["openai"].ttft_ewma = ttft_ewma
+    streams = {"openai": lambda: _stream([]), "azure": lambda: _stream(["a"])}
+    assert asyncio.run(_first_chunks(1, make_stream=lambda provider: streams[provider]())) == ["a"]
+    assert providers["openai"].ttft_ewma == expected
+    assert providers["azure"].hedges_won == 1
+
+
+def test_hedge_loser_latency_raised(monkeypatch, providers):
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_HEDGE_DELAY_SECONDS", 0.05)
+    providers["openai"].ttft_ewma = 0.001
+    streams = {"openai": lambda: _stream([]), "azure": lambda: _stream(["a"])}
+    asyncio.run(_first_chunks(1, make_stream=lambda provider: streams[provider]()))
+    assert providers["openai"].ttft_ewma > 0.001
@@ -0,0 +1,63 @@
+"""
+1. Rows are normalized, zero rows are left as they are.
+2. The most relevant candidate is picked first and a near duplicate of it is passed over.
+3. With lambda_mult 1 the candidates come in order of relevance.
+4. Relevance is the best similarity to any of the queries, plus the bonus when given.
+5. The picks match a reference implementation that re-scores against the whole selected set.
+6. No candidates or k <= 0 pick nothing, k beyond the candidates picks them all.
+.....
+"""
+
+import numpy as np
+from app.common.mmr import mmr_select, normalize_rows
+
+
+def _reference_mmr(query_vectors, candidate_vectors, k, lambda_mult):
+    candidates = normalize_rows(candidate_vectors)
+    relevance = (candidates @ normalize_rows(np.atleast_2d(query_vectors)).T).max(axis=1)
+    picks = [int(np.argmax(relevance))]
+    while len(picks) < min(k, len(candidates)):
+        redundancy = (candidates @ candidates[picks].T).max(axis=1)
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[picks] = -np.inf
+        picks.append(int(np.argmax(scores)))
+    return picks
+
+
+def test_normalize_rows():
+    rows = normalize_rows([[3.0, 4.0], [0.0, 0.0]])
+    assert np.allclose(rows, [[0.6, 0.8], [0.0, 0.0]])
+
+
+def test_near_duplicate_passed_over():
+    query = [1.0, 0.0]
+    candidates = [[1.0, 0.1], [1.0, 0.11], [0.7, -0.7]]
+    assert mmr_select(query, candidates, k=2) == [0, 2]
+
+
+def test_pure_relevance():
+    query = [1.0, 0.0]
+    candidates = [[0.0, 1.0], [1.0, 0.1], [1.0, 0.11], [0.7, -0.7]]
+    assert mmr_select(query, candidates, k=4, lambda_mult=1.0) == [1, 2, 3, 0]
+
+
+def test_relevance_over_queries_and_bonus():
+    candidates = [[1.0, 0.0], [0.0, 1.0]]
+    assert mmr_select([[1.0, 0.0], [0.0, 1.0]], candidates, k=1) == [0]
+    assert mmr_select([[0.9, 0.1], [0.0, 1.0]], candidates, k=1) == [1]
+    assert mmr_select([[0.0, 1.0]], candidates, k=1, relevance_bonus=[1.5, 0.0]) == [0]
+
+
+def test_matches_reference():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        queries = rng.normal(size=(3, 16))
+        candidates = rng.normal(size=(40, 16))
+        for lambda_mult in (0.0, 0.3, 0.5, 0.9):
+            assert mmr_select(queries, candidates, 8, lambda_mult) == _reference_mmr(queries, candidates, 8, lambda_mult)
+
+
+def test_edge_cases():
+    assert mmr_select([1.0, 0.0], [], k=3) == []
+    assert mmr_select([1.0, 0.0], [[1.0, 0.0]], k=0) == []
+    assert sorted(mmr_select([1.0, 0.0], [[1.0, 0.0], [0.0, 1.0]], k=5)) == [0, 1]
@@ -0,0 +1,94 @@
+"""
+1. A window refuses requests beyond its rpm and tokens beyond its tpm.
+2. A single request larger than the whole tpm is let through once the window is empty.
+3. A released reservation gives its tokens and request back.
+4. A request does not overtake requests already queued for the provider.
+5. Queued requests are admitted by priority once the window frees up.
+6. A request that waited the max wait is sent anyway and counted against the window.
+.....
+"""
+
+import asyncio
+import json
+import pytest
+from app.common import quota
+from app.common.quota import PRIORITY_FREE, PRIORITY_PAID, QuotaScheduler, RollingWindow
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch):
+    deployment = quota.DEPLOYMENTS["openai"]["primary"]
+    monkeypatch.setattr(settings, "LLM_QUOTAS_JSON", json.dumps({f"openai:{deployment}": {"tpm": 1000, "rpm": 1}}))
+    monkeypatch.setattr(QuotaScheduler, "_windows", {})
+    monkeypatch.setattr(QuotaScheduler, "_waiters", {})
+    # the condition binds to the event loop of its first use, every test runs its own loop
+    monkeypatch.setattr(QuotaScheduler, "_changed", None)
+
+
+def test_window_limits():
+    window = RollingWindow(tpm=100, rpm=2)
+    assert window.fits(60, now=0)
+    window.add(60, now=0)
+    assert not window.fits(50, now=1)
+    window.add(30, now=1)
+    assert not window.fits(1, now=2)
+    # both entries have left the window
+    assert window.fits(100, now=quota.QUOTA_WINDOW_SECONDS + 1)
+    assert window.tokens == 0
+
+
+def test_oversized_request_fits_empty_window():
+    window = RollingWindow(tpm=100, rpm=0)
+    assert window.fits(500, now=0)
+    window.add(500, now=0)
+    assert not window.fits(1, now=1)
+
+
+def test_release_gives_back_reservation():
+    demand = [("primary", 300)]
+    assert QuotaScheduler.try_reserve("openai", demand)
+    assert not QuotaScheduler.try_reserve("openai", demand)
+    asyncio.run(QuotaScheduler.release("openai", demand))
+    window = QuotaScheduler._get_window("openai", "primary")
+    assert window.tokens == 0 and len(window.entries) == 0
+    assert QuotaScheduler.try_reserve("openai", demand)
+
+
+def test_try_reserve_does_not_overtake_queue():
+    QuotaScheduler._waiters["openai"] = [(PRIORITY_FREE, 0)]
+    assert not QuotaScheduler.try_reserve("openai", [("primary", 1)])
+    # the queue is per provider, and deployments without a quota are not limited
+    assert QuotaScheduler.try_reserve("azure", [("primary", 1)])
+
+
+def test_queued_requests_admitted_by_priority(monkeypatch):
+    monkeypatch.setattr(quota, "QUOTA_WINDOW_SECONDS", 0.05)
+    demand = [("primary", 10)]
+    admitted = []
+
+    async def request(name, priority):
+        await QuotaScheduler.wait_reserve("openai", demand, priority)
+        admitted.append(name)
+
+    async def run():
+        QuotaScheduler.reserve("openai", demand)
+        free = asyncio.create_task(request("free", PRIORITY_FREE))
+        await asyncio.sleep(0)
+        paid = asyncio.create_task(request("paid", PRIORITY_PAID))
+        await asyncio.gather(free, paid)
+
+    asyncio.run(run())
+    assert admitted == ["paid", "free"]
+    assert QuotaScheduler._waiters["openai"] == []
+
+
+def test_wait_times_out_and_reserves(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_QUOTA_MAX_WAIT_SECONDS", 0.05)
+    demand = [("primary", 10)]
+    QuotaScheduler.reserve("openai", demand)
+    asyncio.run(QuotaScheduler.wait_reserve("openai", demand, PRIORITY_FREE))
+    window = QuotaScheduler._get_window("openai", "primary")
+    assert len(window.entries) == 2 and window.tokens == 20
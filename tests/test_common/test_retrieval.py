@@ -0,0 +1,109 @@
+"""
+1. Rewritten queries are split into lines without list markers and duplicates, up to max_queries.
+2. Reciprocal rank fusion ranks a match found by several lists first and keeps the first list's copy.
+3. A message that skipped the rewrite is searched as one query, whatever lines it has.
+4. A list of queries is searched up to max_queries, each against the index.
+5. A chunk stored under several ids is returned once.
+6. The local index answers when it holds the documents in scope, pinecone answers when it doesn't.
+7. Lexical matches join the pool with their fetched vectors.
+.....
+"""
+
+import asyncio
+import pytest
+from langchain_pinecone import PineconeVectorStore
+from benchmarks.fakes import FakeEmbeddings, FakePineconeIndex
+from app.common.retrieval import MultiQueryFusionRetriever, reciprocal_rank_fusion, split_search_queries
+
+FILE_NAMES = ["guide.pdf", "lease.pdf"]
+
+
+class _LocalIndex:
+    def __init__(self, index, file_names):
+        self.index = index
+        self.file_names = file_names
+        self.queries = 0
+
+    def query(self, vector, top_k, file_names):
+        if not file_names <= self.file_names:
+            return None
+        self.queries += 1
+        return self.index.query(vector, top_k, include_values=True, include_metadata=True)["matches"]
+
+    def fetch(self, ids):
+        return None
+
+
+class _LexicalIndex:
+    def __init__(self, matches):
+        self.matches = matches
+        self.queries = []
+
+    def query(self, text, top_k, file_names):
+        self.queries.append(text)
+        return self.matches
+
+
+@pytest.fixture
+def index():
+    return FakePineconeIndex(FILE_NAMES, chunks_per_doc=10, dim=8, latency=0)
+
+
+def _retriever(index, **kwargs):
+    vectorstore = PineconeVectorStore(index=index, embedding=FakeEmbeddings(dim=8, latency=0))
+    return MultiQueryFusionRetriever(vectorstore=vectorstore, k=4, fetch_k=10, **kwargs)
+
+
+def test_split_search_queries():
+    text = '1. Deposit rules\n2) "deposit rules"\n- Section 213\n\n* Rent increases\n• Notice periods'
+    assert split_search_queries(text, 3) == ["Deposit rules", "Section 213", "Rent increases"]
+    assert split_search_queries("deposit", 3) == ["deposit"]
+
+
+def test_reciprocal_rank_fusion():
+    first = [{"id": "a", "list": 1}, {"id": "b", "list": 1}]
+    second = [{"id": "b", "list": 2}, {"id": "c", "list": 2}]
+    fused = reciprocal_rank_fusion([first, second], rrf_k=60)
+    assert [match["id"] for match, _ in fused] == ["b", "a", "c"]
+    assert fused[0][0]["list"] == 1
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+
+
+def test_raw_message_is_one_query(index):
+    retriever = _retriever(index)
+    documents = retriever.invoke("What is a deposit?\nAnd how is it protected?\nIs there a penalty?\nWho pays it?")
+    assert index.queries == 1
+    assert len(documents) == 4
+
+
+def test_queries_capped(index):
+    retriever = _retriever(index, max_queries=2)
+    asyncio.run(retriever.ainvoke(["deposit", "rent", "notice", "repairs"]))
+    assert index.queries == 2
+
+
+def test_duplicate_chunks_returned_once(index):
+    index.texts = ["same text"] * len(index.texts)
+    documents = _retriever(index).invoke(["deposit"])
+    assert [document.page_content for document in documents] == ["same text"]
+
+
+def test_local_index_first(index):
+    # the local index answers from the fake index too, its queries are counted there as well
+    local_index = _LocalIndex(index, frozenset(FILE_NAMES))
+    _retriever(index, local_index=local_index, local_documents=frozenset(FILE_NAMES)).invoke(["deposit"])
+    assert (local_index.queries, index.queries) == (1, 1)
+
+    _retriever(index, local_index=local_index, local_documents=frozenset(FILE_NAMES + ["new.pdf"])).invoke(["deposit"])
+    assert (local_index.queries, index.queries) == (1, 2)
+
+
+def test_lexical_matches_join_pool(index):
+    # the vector search returns nothing, the documents come from the lexical matches
+    index.file_names[:] = "other.pdf"
+    lexical_index = _LexicalIndex([{"id": "3", "score": 2.0, "metadata": {"text": "section 213 deposit"}},
+                                   {"id": "7", "score": 1.0, "metadata": {"text": "deposit protection"}}])
+    retriever = _retriever(index, lexical_index=lexical_index, filter={"file_name": {"$in": FILE_NAMES}})
+    documents = retriever.invoke(["section 213", "deposit"])
+    assert lexical_index.queries == ["section 213", "deposit"]
+    assert sorted(document.page_content for document in documents) == ["deposit protection", "section 213 deposit"]
@@ -0,0 +1,75 @@
+"""
+1. Multi-line payloads become one data field per line, whatever the line terminator.
+2. Deltas are coalesced into one chunk until max_bytes are buffered.
+3. A quiet source yields heartbeats while nothing is buffered.
+4. A stream ends with a done event carrying its metadata.
+5. A failing source delivers what it produced, then an error event.
+.....
+"""
+
+import asyncio
+import json
+import pytest
+from app.common import sse
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+
+async def _source(chunks, delay=0, error=None):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+async def _collect(stream):
+    return [item async for item in stream]
+
+
+def _parse(events):
+    # (event name, data) per event, comments left out
+    parsed = []
+    for event in events:
+        if event.startswith(":"):
+            continue
+        lines = event.strip("\n").split("\n")
+        name = next((line[len("event: "):] for line in lines if line.startswith("event: ")), "message")
+        parsed.append((name, "\n".join(line[len("data: "):] for line in lines if line.startswith("data: "))))
+    return parsed
+
+
+@pytest.mark.parametrize("data", ["first\nsecond", "first\r\nsecond", "first\rsecond"])
+def test_format_event_splits_every_line_terminator(data):
+    event = sse.format_event(data, event_id=3)
+    assert event == "id: 3\ndata: first\ndata: second\n\n"
+
+
+def test_coalesce_flushes_at_max_bytes():
+    chunks = asyncio.run(_collect(sse.coalesce(_source(["ab", "cd", "ef", "g"]), interval=10, max_bytes=4)))
+    assert chunks == ["abcd", "efg"]
+
+
+def test_coalesce_heartbeat_while_quiet():
+    chunks = asyncio.run(_collect(sse.coalesce(_source(["a"], delay=0.05), interval=0.001, max_bytes=100, heartbeat_seconds=0.01)))
+    assert chunks[-1] == "a"
+    assert len(chunks) > 1 and all(chunk is None for chunk in chunks[:-1])
+
+
+def test_encode_stream_done_event(monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_STREAM_COALESCE_BYTES", 1)
+    events = _parse(asyncio.run(_collect(sse.encode_stream(_source(["Hello", " world"]), metadata={"mode": "chat"}))))
+    assert events[:2] == [("message", "Hello"), ("message", " world")]
+    name, data = events[-1]
+    done = json.loads(data)
+    assert name == "done"
+    assert done["mode"] == "chat" and done["events"] == 2 and done["characters"] == 11
+
+
+def test_encode_stream_error_event():
+    events = _parse(asyncio.run(_collect(sse.encode_stream(_source(["partial"], error=RuntimeError("boom"))))))
+    assert events[0] == ("message", "partial")
+    name, data = events[-1]
+    assert name == "error"
+    assert "detail" in json.loads(data)
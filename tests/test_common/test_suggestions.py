@@ -0,0 +1,97 @@
+"""
+1. Suggestions are keyed by the latest messages only.
+2. Suggestions generated after a turn are served from the store, requests for the same history share one generation.
+3. A history the stored suggestions were not generated from waits for a new generation.
+4. Users without history get a set from the pool, generated once.
+5. A failed generation returns no suggestions and is retried by the next request.
+.....
+"""
+
+import asyncio
+import pytest
+from zep_python.message import Message
+from app.common import tokens
+
+
+@pytest.fixture
+def suggestions(monkeypatch, getzep):
+    from app.common import suggestions
+    monkeypatch.setattr(tokens, "get_encoding", lambda model_name: None)
+    monkeypatch.setattr(suggestions, "_suggestions", suggestions.LRUCache(maxsize=10))
+    monkeypatch.setattr(suggestions, "_tasks", {})
+    monkeypatch.setattr(suggestions, "_pool", [])
+    monkeypatch.setattr(suggestions, "_pool_task", None)
+    return suggestions
+
+
+def _install(monkeypatch, suggestions, failures=0):
+    generations = []
+
+    async def ainvoke(make_stream, demand=None, priority=None):
+        generations.append(demand)
+        await asyncio.sleep(0.01)
+        if len(generations) <= failures:
+            raise ConnectionError("llm unavailable")
+        return f"1. Question {len(generations)}? Because\n\n2. - Another one?"
+
+    monkeypatch.setattr(suggestions.ProviderRouter, "ainvoke", ainvoke)
+    return generations
+
+
+def _messages(count):
+    return [Message(role="User" if i % 2 == 0 else "AI", content=f"message {i}") for i in range(count)]
+
+
+def test_history_hash(suggestions):
+    messages = _messages(6)
+    assert suggestions.history_hash(messages) == suggestions.history_hash(messages[2:])
+    assert suggestions.history_hash(messages) != suggestions.history_hash(messages[:5])
+
+
+def test_served_from_store(monkeypatch, suggestions):
+    generations = _install(monkeypatch, suggestions)
+    messages = _messages(2)
+
+    async def run():
+        suggestions.schedule_refresh("alice", messages)
+        first, second = await asyncio.gather(suggestions.get_suggested_questions("alice", messages),
+                                             suggestions.get_suggested_questions("alice", messages))
+        return first, second, await suggestions.get_suggested_questions("alice", messages)
+
+    first, second, third = asyncio.run(run())
+    assert first == second == third == ["Question 1?", "Another one?"]
+    assert len(generations) == 1
+    assert suggestions._tasks == {}
+
+
+def test_new_history_regenerated(monkeypatch, suggestions):
+    generations = _install(monkeypatch, suggestions)
+
+    async def run():
+        await suggestions.get_suggested_questions("alice", _messages(2))
+        return await suggestions.get_suggested_questions("alice", _messages(4))
+
+    assert asyncio.run(run()) == ["Question 2?", "Another one?"]
+    assert len(generations) == 2
+
+
+def test_pool_for_empty_history(monkeypatch, suggestions):
+    monkeypatch.setattr(suggestions.settings, "SUGGESTED_QUESTIONS_POOL_SIZE", 3)
+    generations = _install(monkeypatch, suggestions)
+
+    async def run():
+        return [await suggestions.get_suggested_questions(username, []) for username in ("alice", "bob")]
+
+    for questions in asyncio.run(run()):
+        assert questions in [[f"Question {i}?", "Another one?"] for i in (1, 2, 3)]
+    assert len(generations) == 3 and len(suggestions._pool) == 3
+
+
+def test_failed_generation_retried(monkeypatch, suggestions):
+    generations = _install(monkeypatch, suggestions, failures=1)
+
+    async def run():
+        return [await suggestions.get_suggested_questions("alice", _messages(2)) for _ in range(3)]
+
+    assert asyncio.run(run()) == [[], ["Question 2?", "Another one?"], ["Question 2?", "Another one?"]]
+    assert len(generations) == 2
@@ -0,0 +1,129 @@
+"""
+1. The message count is read from the user row, accounts without one are backfilled once from their zep history.
+2. Increments and resets are applied in the database, rows still waiting for the backfill stay NULL.
+3. The chat history is loaded from zep once per history version, turns not saved to zep yet included.
+4. A follow-up mode answers from the context kept for the last answer, without the qa chain and the query rewrite.
+.....
+"""
+
+import asyncio
+from types import SimpleNamespace
+import pytest
+from app.common import tokens
+from app.models.user import Role, User
+from app.schemas.requests.user_chat import Mode
+from benchmarks.fakes import create_session_factory
+
+
+@pytest.fixture
+def user_chat(getzep):
+    from app.services import user_chat
+    return user_chat
+
+
+@pytest.fixture
+def db_session():
+    db_session = create_session_factory()()
+    db_session.add_all([User(email="alice@example.com", role=Role.User, message_count=3),
+                        User(email="bob@example.com", role=Role.User)])
+    db_session.commit()
+    # an account from before the counter, inserting None would take the column default
+    db_session.query(User).filter_by(email="bob@example.com").update({User.message_count: None})
+    db_session.commit()
+    yield db_session
+    db_session.close()
+
+
+def _user(db_session, email):
+    db_session.expire_all()
+    return db_session.query(User).filter_by(email=email).one()
+
+
+def test_message_count_backfilled_once(monkeypatch, user_chat, db_session):
+    loads = []
+
+    async def get_chat_history(username, db_session, version=None):
+        loads.append(username)
+        return [SimpleNamespace(role=role) for role in ("User", "AI", "User", "AI", "User")]
+
+    monkeypatch.setattr(user_chat, "get_chat_history", get_chat_history)
+    assert asyncio.run(user_chat._get_user_message_count(_user(db_session, "alice@example.com"), db_session)) == 3
+    assert asyncio.run(user_chat._get_user_message_count(_user(db_session, "bob@example.com"), db_session)) == 3
+    assert asyncio.run(user_chat._get_user_message_count(_user(db_session, "bob@example.com"), db_session)) == 3
+    assert loads == ["bob@example.com"]
+    assert _user(db_session, "bob@example.com").message_count == 3
+
+
+def test_increment_and_reset(user_chat, db_session):
+    user_chat._increment_user_message_count(_user(db_session, "alice@example.com"), db_session)
+    user_chat._increment_user_message_count(_user(db_session, "bob@example.com"), db_session)
+    assert _user(db_session, "alice@example.com").message_count == 4
+    assert _user(db_session, "bob@example.com").message_count is None
+
+    user_chat._reset_user_message_count("alice@example.com", db_session)
+    user_chat._reset_user_message_count("bob@example.com", db_session)
+    assert _user(db_session, "alice@example.com").message_count == 0
+    assert _user(db_session, "bob@example.com").message_count is None
+
+
+def test_chat_history_read_through(monkeypatch, user_chat, db_session):
+    chathistory = user_chat.chathistory
+    monkeypatch.setattr(chathistory, "_histories", chathistory.LRUCache(maxsize=10))
+    loads = []
+
+    async def get_session_id(username, version=None):
+        return f"session-{username}"
+
+    async def get_all_messages_by_session(session_id):
+        loads.append(session_id)
+        return [SimpleNamespace(role="User", content="q1"), SimpleNamespace(role="AI", content="a1")]
+
+    monkeypatch.setattr(user_chat, "_get_zep_session_id_by_username", get_session_id)
+    monkeypatch.setattr(user_chat.getzep, "get_all_messages_by_session", get_all_messages_by_session)
+    monkeypatch.setattr(user_chat.ChatTurnWriter, "pending_messages", lambda username: [SimpleNamespace(role="User", content="q2")])
+
+    history = asyncio.run(user_chat.get_chat_history("alice@example.com", db_session))
+    assert [message.content for message in history] == ["q1", "a1", "q2"]
+    asyncio.run(user_chat.get_chat_history("alice@example.com", db_session))
+    assert loads == ["session-alice@example.com"]
+
+    # another worker changed the history
+    db_session.query(User).filter_by(email="alice@example.com").update({User.chat_history_version: User.chat_history_version + 1})
+    db_session.commit()
+    asyncio.run(user_chat.get_chat_history("alice@example.com", db_session))
+    assert len(loads) == 2
+
+
+def test_follow_up_reuses_turn_context(monkeypatch, user_chat, db_session):
+    chathistory = user_chat.chathistory
+    monkeypatch.setattr(tokens, "get_encoding", lambda model_name: None)
+    monkeypatch.setattr(chathistory, "_turn_contexts", chathistory.LRUCache(maxsize=10))
+    contexts = []
+
+    async def get_chat_history(username, db_session, version=None):
+        return [SimpleNamespace(role="User", content="q1", uuid="m1"), SimpleNamespace(role="AI", content="a1", uuid="m2")]
+
+    async def stream_answer(db_session, user, user_msg, chat_history, context, retrieved_context):
+        contexts.append(context)
+        retrieved_context.update(context or {})
+        yield "a2"
+
+    monkeypatch.setattr(user_chat, "get_chat_history", get_chat_history)
+    monkeypatch.setattr(user_chat, "_stream_answer", stream_answer)
+    chathistory.set_turn_context("alice@example.com", "a1", {"laws_from_kb": "section 213"})
+
+    async def run():
+        return [content async for content in user_chat.get_ai_response(_user(db_session, "alice@example.com"), db_session, "", True, Mode.Simplify)]
+
+    assert asyncio.run(run()) == ["a2"]
+    assert contexts == [{"laws_from_kb": "section 213"}]
+
+    chains = []
+    monkeypatch.setattr(user_chat, "get_chat_llm", lambda provider, role: role)
+    monkeypatch.setattr(user_chat.langchain, "construct_context_answer_chain", lambda username, llm, has_user_docs: chains.append(("context", llm, has_user_docs)))
+    monkeypatch.setattr(user_chat.langchain, "get_qa_chain", lambda *args: chains.append(("qa",)))
+    user_chat._get_answer_chain(db_session, "alice@example.com", contexts[0], "openai")
+    user_chat._get_answer_chain(db_session, "alice@example.com", None, "openai")
+    assert chains == [("context", "primary", False), ("qa",)]
+    # the secondary model only rewrites queries, a follow-up needs the primary one alone
+    assert [role for role, _ in user_chat._estimate_token_demand("q", [SimpleNamespace(content="a1")], contexts[0])] == ["primary"]
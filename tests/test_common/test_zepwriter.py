@@ -0,0 +1,121 @@
+"""
+1. Queued turns are saved with one call per turn, in order.
+2. A failed write is retried, after the last attempt the turn is spooled and replayed on the next start.
+3. A discarded turn is neither saved nor spooled.
+4. At shutdown queued turns are spooled, a write in flight finishes and its turn is not spooled again.
+.....
+"""
+
+import asyncio
+import json
+import pytest
+from app.common.settings import get_settings
+
+settings = get_settings()
+
+
+class _Zep:
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.saved = []
+
+    async def get_session_id_of_user(self, user_id):
+        return f"session-{user_id}"
+
+    async def add_messages_to_session(self, session_id, messages):
+        await asyncio.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("zep unavailable")
+        self.saved.append((session_id, messages))
+
+
+@pytest.fixture
+def writer(monkeypatch, getzep, tmp_path):
+    from app.common import zepwriter
+    monkeypatch.setattr(settings, "ZEP_WRITER_WORKERS", 1)
+    monkeypatch.setattr(settings, "ZEP_WRITER_SPOOL_PATH", str(tmp_path / "spool.jsonl"))
+    monkeypatch.setattr(zepwriter.ChatTurnWriter, "_pending", {})
+    monkeypatch.setattr(zepwriter.ChatTurnWriter, "_writes", set())
+    return zepwriter
+
+
+def _install(monkeypatch, writer, zep):
+    monkeypatch.setattr(writer.getzep, "get_session_id_of_user", zep.get_session_id_of_user)
+    monkeypatch.setattr(writer.getzep, "add_messages_to_session", zep.add_messages_to_session)
+
+
+def _spooled():
+    with open(settings.ZEP_WRITER_SPOOL_PATH) as spool_file:
+        return [json.loads(line) for line in spool_file]
+
+
+def test_turns_saved_in_order(monkeypatch, writer):
+    zep = _Zep()
+    _install(monkeypatch, writer, zep)
+
+    async def run():
+        await writer.ChatTurnWriter.start()
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q1"), ("ai", "a1")])
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q2"), ("ai", "a2")])
+        assert [message.content for message in writer.ChatTurnWriter.pending_messages("alice")] == ["q1", "a1", "q2", "a2"]
+        await writer.ChatTurnWriter.stop()
+
+    asyncio.run(run())
+    assert zep.saved == [("session-alice", [("human", "q1"), ("ai", "a1")]), ("session-alice", [("human", "q2"), ("ai", "a2")])]
+    assert writer.ChatTurnWriter.get_stats()["pending_turns"] == 0
+
+
+def test_retry_spool_and_replay(monkeypatch, writer):
+    monkeypatch.setattr(settings, "ZEP_WRITER_MAX_ATTEMPTS", 2)
+    sleep = asyncio.sleep
+    # no backoff between the attempts
+    monkeypatch.setattr(writer.asyncio, "sleep", lambda delay: sleep(0))
+    zep = _Zep(failures=2)
+    _install(monkeypatch, writer, zep)
+
+    async def run():
+        await writer.ChatTurnWriter.start()
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q1"), ("ai", "a1")])
+        await writer.ChatTurnWriter.stop()
+
+    asyncio.run(run())
+    assert zep.saved == []
+    assert [turn["user_id"] for turn in _spooled()] == ["alice"]
+
+    asyncio.run(run())
+    # the spooled turn is saved before the new one
+    assert [messages[0][1] for _, messages in zep.saved] == ["q1", "q1"]
+
+
+def test_discarded_turn_dropped(monkeypatch, writer):
+    zep = _Zep(delay=0.05)
+    _install(monkeypatch, writer, zep)
+
+    async def run():
+        await writer.ChatTurnWriter.start()
+        writer.ChatTurnWriter.enqueue("bob", [("human", "q0"), ("ai", "a0")])
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q1"), ("ai", "a1")])
+        writer.ChatTurnWriter.discard_pending("alice")
+        await writer.ChatTurnWriter.stop()
+
+    asyncio.run(run())
+    assert zep.saved == [("session-bob", [("human", "q0"), ("ai", "a0")])]
+    assert writer.ChatTurnWriter.pending_messages("alice") == []
+
+
+def test_stop_spools_only_unsaved_turns(monkeypatch, writer):
+    monkeypatch.setattr(settings, "ZEP_WRITER_SHUTDOWN_TIMEOUT_SECONDS", 0.1)
+    zep = _Zep(delay=0.15)
+    _install(monkeypatch, writer, zep)
+
+    async def run():
+        await writer.ChatTurnWriter.start()
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q1"), ("ai", "a1")])
+        writer.ChatTurnWriter.enqueue("alice", [("human", "q2"), ("ai", "a2")])
+        await writer.ChatTurnWriter.stop()
+
+    asyncio.run(run())
+    assert zep.saved == [("session-alice", [("human", "q1"), ("ai", "a1")])]
+    assert [turn["messages"][0]["content"] for turn in _spooled()] == ["q2"]